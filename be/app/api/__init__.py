@@ -1,5 +1,5 @@
 # API routes package
 
-from . import messages, threads
+from . import messages, phones, threads
 
-__all__ = ["messages", "threads"]
+__all__ = ["messages", "phones", "threads"]
@@ -0,0 +1,64 @@
+import hmac
+import logging
+from datetime import date
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from pymongo.errors import BulkWriteError
+
+from app.config import settings
+from app.models.phone import PhoneBulkUpsertRequest, PhoneBulkUpsertResult
+from app.models.usage import UsageReport
+from app.services.phone_service import phone_service
+from app.services.usage_service import usage_service
+
+logger = logging.getLogger(__name__)
+
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)) -> None:
+    """校验 X-Admin-Token；未配置 ADMIN_TOKEN 时管理接口不可用"""
+    if not settings.admin_token:
+        raise HTTPException(status_code=403, detail="Admin API is disabled")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, settings.admin_token):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+
+router = APIRouter(prefix="/api/admin", tags=["admin"], dependencies=[Depends(require_admin)])
+
+
+@router.post("/phones:bulkUpsert", response_model=PhoneBulkUpsertResult)
+async def bulk_upsert_phones(request: PhoneBulkUpsertRequest):
+    """
+    批量更新手机与 SKU（价格、库存状态、新 SKU 等）
+
+    按请求顺序执行，某个操作失败时之前的写入已生效，返回 400 和失败的位置。
+    """
+    try:
+        return await phone_service.bulk_upsert(request.items)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors") or [{}]
+        logger.warning("Bulk upsert failed: %s", errors[0])
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "message": errors[0].get("errmsg", "Bulk write failed"),
+                "operation_index": errors[0].get("index"),
+                "matched": e.details.get("nMatched", 0),
+                "modified": e.details.get("nModified", 0),
+                "upserted": e.details.get("nUpserted", 0),
+            },
+        )
+
+
+@router.get("/usage", response_model=UsageReport)
+async def usage_report(
+    since: Optional[date] = Query(None, description="起始日期（含），默认为 30 天前"),
+    until: Optional[date] = Query(None, description="结束日期（含），默认为今天"),
+    user: Optional[str] = Query(None, description="只统计某个用户（X-User-Id，未带该请求头的生成按线程 ID 统计）"),
+):
+    """按天、按模型汇总 token 用量与费用；费用按 LLM_PRICES 计算，未配置价格的模型费用为空"""
+    default_since, default_until = usage_service.default_range()
+    since, until = since or default_since, until or default_until
+    if since > until:
+        raise HTTPException(status_code=400, detail="since must not be after until")
+    return await usage_service.report(since, until, user)
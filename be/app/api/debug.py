@@ -0,0 +1,39 @@
+from typing import Literal
+
+from fastapi import APIRouter, Depends, Query
+
+from app.api.admin import require_admin
+from app.query_monitor import query_monitor
+from app.services.index_service import index_service
+
+router = APIRouter(prefix="/debug", tags=["debug"], dependencies=[Depends(require_admin)])
+
+
+@router.get("/indexes")
+async def index_report():
+    """
+    索引诊断
+
+    列出每个集合已存在和缺失的声明索引，并 explain 代表性查询，标出全表扫描。
+    """
+    return await index_service.report()
+
+
+@router.get("/queries")
+async def query_report(
+    limit: int = Query(20, ge=1, le=500),
+    sort: Literal["total_ms", "count", "mean_ms", "p95_ms", "max_ms", "slow", "errors"] = "total_ms",
+):
+    """
+    查询形状统计
+
+    按形状汇总进程启动以来的 Mongo 命令次数、耗时分位数和慢查询次数，返回前 limit 个；
+    last_plan 为最近一次慢查询的 explain 摘要。
+    """
+    return {"shapes": query_monitor.top(limit, sort)}
+
+
+@router.delete("/queries", status_code=204)
+async def reset_query_report():
+    """清空查询形状统计"""
+    query_monitor.reset()
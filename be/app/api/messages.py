@@ -1,63 +1,184 @@
 import json
 import logging
-from typing import AsyncIterator
+import math
+from datetime import datetime
+from typing import AsyncIterator, Optional
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException, Query, Response
 from fastapi.responses import StreamingResponse
 
 from app.models.message import Message, MessageCreate
 from app.services.chat_service import chat_service
+from app.services.generation_service import Generation, GenerationGapError, generation_manager
+from app.services.llm_service import llm_service
+from app.services.scheduler import AdmissionRejected
+from app.services.thread_coordinator import thread_coordinator
+from app.utils.http import conditional_headers, is_not_modified, weak_etag
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/threads/{thread_id}/messages", tags=["messages"])
 
 
-@router.post("")
-async def send_message(thread_id: str, message_data: MessageCreate):
-    """
-    发送消息并获取 AI 响应（SSE 流式响应）
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+}
 
-    首先添加用户消息，然后流式返回 AI 响应
-    """
-    logger.info("Received message for thread %s", thread_id)
-    # 添加用户消息
-    await chat_service.add_message(thread_id, message_data)
 
-    # 生成流式响应
+def sse_response(generation: Generation, last_event_id: int = 0) -> StreamingResponse:
+    """把生成任务的事件流转换为带 id 的 SSE 响应"""
+
     async def generate_sse() -> AsyncIterator[str]:
         """生成 SSE 格式的流式响应"""
         try:
-            async for chunk in chat_service.generate_response_stream(thread_id):
-                logger.debug("Streaming chunk for thread %s", thread_id)
-                # SSE 格式: data: {content}\n\n
-                data = json.dumps({"content": chunk}, ensure_ascii=False)
-                yield f"data: {data}\n\n"
-
-            # 发送结束标记
-            logger.debug("Completed streaming for thread %s", thread_id)
-            yield f"data: {json.dumps({'done': True}, ensure_ascii=False)}\n\n"
-        except Exception as e:
-            # 发送错误信息
-            logger.exception("SSE streaming error for thread %s", thread_id)
-            error_data = json.dumps({"error": str(e)}, ensure_ascii=False)
+            async for event in generation_manager.subscribe(generation, last_event_id):
+                # SSE 格式: id: {seq}\ndata: {content}\n\n
+                data = json.dumps(event.data, ensure_ascii=False)
+                yield f"id: {event.seq}\ndata: {data}\n\n"
+        except GenerationGapError as e:
+            logger.warning("Cannot resume generation %s: %s", generation.id, e)
+            error_data = json.dumps({"error": "事件已过期，请重新加载对话", "code": "gap"}, ensure_ascii=False)
             yield f"data: {error_data}\n\n"
 
     return StreamingResponse(
         generate_sse(),
         media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        },
+        headers={**SSE_HEADERS, "X-Generation-Id": generation.id},
     )
 
 
+@router.post("")
+async def send_message(
+    thread_id: str,
+    message_data: MessageCreate,
+    x_user_id: Optional[str] = Header(None),
+):
+    """
+    发送消息并获取 AI 响应（SSE 流式响应）
+
+    短时间内重复提交的相同消息（双击发送、多个标签页）不再生成，直接附加到第一次提交的事件流。
+    先申请生成排队名额（队列满时返回 429 和 Retry-After），保存用户消息后在后台启动生成任务并流式返回 AI 响应；
+    同一线程的生成逐个执行，排队期间取消也不会丢失已保存的用户消息。
+    第一条事件携带 generation_id，断线后可通过 stream 接口续传。
+    """
+    logger.info("Received message for thread %s", thread_id)
+    # 在第一个 await 之前登记，并发的重复请求中只有一个继续执行
+    claim, first = thread_coordinator.claim(thread_id, message_data.content)
+    if not first:
+        return sse_response(await claim.wait())
+
+    try:
+        generation = await _start_reply(thread_id, message_data, x_user_id)
+    except BaseException as e:
+        thread_coordinator.abandon(claim, e)
+        raise
+    thread_coordinator.resolve(claim, generation)
+    return sse_response(generation)
+
+
+async def _start_reply(thread_id: str, message_data: MessageCreate, x_user_id: Optional[str]) -> Generation:
+    scheduler = llm_service.scheduler
+    try:
+        ticket = scheduler.enqueue(x_user_id or thread_id, llm_service.estimate_generation_tokens())
+    except AdmissionRejected as e:
+        logger.warning("Rejected message for thread %s: %s", thread_id, e)
+        retry_after = max(1, math.ceil(e.retry_after))
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(retry_after)})
+
+    # 用户消息在排队前写入并记录回答它的生成，生成轮次只包住 assistant 消息的写入
+    generation_id = generation_manager.new_id()
+    try:
+        await chat_service.add_message(thread_id, message_data, generation_id)
+    except BaseException:
+        scheduler.cancel(ticket)
+        raise
+
+    return generation_manager.start(
+        thread_id,
+        lambda: chat_service.generate_response_stream(thread_id, ticket, generation_id),
+        scheduler=scheduler,
+        ticket=ticket,
+        generation_id=generation_id,
+        turn=lambda: thread_coordinator.turn(thread_id),
+    )
+
+
+@router.post("/generations/{generation_id}/retry")
+async def retry_generation(
+    thread_id: str,
+    generation_id: str,
+    x_user_id: Optional[str] = Header(None),
+):
+    """
+    重试中断的生成（SSE 流式响应）
+
+    已完成的步骤不再调用模型和工具，从最后一个检查点继续；只能重试线程中最新的一次生成。
+    """
+    checkpoint = await chat_service.get_checkpoint(thread_id, generation_id)
+    # 在检查点读取之后检查，此后到 start 之间没有 await，不会并发启动两个相同的生成
+    existing = generation_manager.get(generation_id)
+    if existing is None and checkpoint is None:
+        # 既不在运行也没有留下消息，不能用客户端给的 id 重新生成整段对话
+        raise HTTPException(status_code=404, detail="Generation not found")
+    if existing is not None and (existing.thread_id != thread_id or not existing.done):
+        raise HTTPException(status_code=409, detail="Generation is still running")
+    logger.info("Retrying generation %s with %d completed steps", generation_id, len(checkpoint or []))
+
+    scheduler = llm_service.scheduler
+    try:
+        ticket = scheduler.enqueue(x_user_id or thread_id, llm_service.estimate_generation_tokens())
+    except AdmissionRejected as e:
+        logger.warning("Rejected retry for thread %s: %s", thread_id, e)
+        retry_after = max(1, math.ceil(e.retry_after))
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(retry_after)})
+
+    generation = generation_manager.start(
+        thread_id,
+        lambda: chat_service.generate_response_stream(thread_id, ticket, generation_id),
+        scheduler=scheduler,
+        ticket=ticket,
+        generation_id=generation_id,
+        turn=lambda: thread_coordinator.turn(thread_id),
+    )
+    return sse_response(generation)
+
+
+@router.get("/stream/{generation_id}")
+async def resume_stream(
+    thread_id: str,
+    generation_id: str,
+    last_event_id: Optional[int] = Header(None),
+):
+    """按 Last-Event-ID 回放缓冲事件并继续跟随生成任务"""
+    generation = generation_manager.get(generation_id)
+    if not generation or generation.thread_id != thread_id:
+        raise HTTPException(status_code=404, detail="Generation not found")
+    logger.info("Resuming generation %s from event %s", generation_id, last_event_id or 0)
+    return sse_response(generation, last_event_id or 0)
+
+
 @router.get("", response_model=list[Message])
-async def get_messages(thread_id: str):
-    """获取对话消息列表"""
-    thread = await chat_service.get_thread(thread_id)
-    if not thread:
+async def get_messages(
+    thread_id: str,
+    response: Response,
+    since: Optional[datetime] = Query(None, description="只返回此时间之后创建的消息，用于增量拉取"),
+    if_none_match: Optional[str] = Header(None),
+    if_modified_since: Optional[str] = Header(None),
+):
+    """获取对话消息列表，支持条件请求与增量拉取"""
+    updated_at = await chat_service.get_thread_version(thread_id)
+    if updated_at is None:
+        raise HTTPException(status_code=404, detail="Thread not found")
+
+    etag = weak_etag("messages", thread_id, updated_at, since)
+    headers = conditional_headers(etag, updated_at)
+    if is_not_modified(etag, updated_at, if_none_match, if_modified_since):
+        return Response(status_code=304, headers=headers)
+
+    messages = await chat_service.get_messages(thread_id, since=since)
+    if messages is None:
         raise HTTPException(status_code=404, detail="Thread not found")
-    return thread.messages
+    response.headers.update(headers)
+    return messages
@@ -0,0 +1,96 @@
+import hashlib
+from typing import Any, Dict, List, Optional
+
+from fastapi import APIRouter, Header, HTTPException, Query, Response
+
+from app.config import settings
+from app.models.phone import Phone, PhoneBatchSearchRequest, PhoneFacetResult, PhonePage, PhoneSearchParams
+from app.services.phone_service import PHONE_FIELDS, InvalidCursorError, phone_service
+from app.utils.http import etag_matches
+
+router = APIRouter(prefix="/api/phones", tags=["phones"])
+
+
+def _parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """解析逗号分隔的 fields 参数"""
+    if not fields:
+        return None
+    parsed = sorted({field.strip() for field in fields.split(",") if field.strip()})
+    unknown = [field for field in parsed if field not in PHONE_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return parsed or None
+
+
+def _catalog_etag(version: str, *parts: Any) -> str:
+    """由目录版本和请求参数派生的强 ETag"""
+    digest = hashlib.sha1(repr((version, *parts)).encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def _cache_headers(etag: str) -> Dict[str, str]:
+    return {
+        "ETag": etag,
+        "Cache-Control": (
+            f"public, max-age={settings.catalog_cache_max_age}, "
+            f"stale-while-revalidate={settings.catalog_cache_stale_while_revalidate}"
+        ),
+    }
+
+
+@router.get("", response_model=PhonePage)
+async def list_phones(
+    response: Response,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = Query(None, description="逗号分隔的返回字段，例如 brand,model,skus"),
+    brand: Optional[str] = None,
+    tag: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+):
+    """分页获取手机列表（按更新时间倒序，使用 next_cursor 翻页）"""
+    field_list = _parse_fields(fields)
+    etag = _catalog_etag(await phone_service.catalog_version(), limit, cursor, field_list, brand, tag)
+    headers = _cache_headers(etag)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    try:
+        page = await phone_service.list_phones(limit=limit, cursor=cursor, fields=field_list, brand=brand, tag=tag)
+    except InvalidCursorError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    response.headers.update(headers)
+    return page
+
+
+@router.get("/{phone_id}", response_model=Dict[str, Any])
+async def get_phone(
+    phone_id: str,
+    response: Response,
+    fields: Optional[str] = Query(None, description="逗号分隔的返回字段"),
+    if_none_match: Optional[str] = Header(None),
+):
+    """获取单个手机详情"""
+    field_list = _parse_fields(fields)
+    etag = _catalog_etag(await phone_service.catalog_version(), phone_id, field_list)
+    headers = _cache_headers(etag)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    phone = await phone_service.get_phone(phone_id, fields=field_list)
+    if not phone:
+        raise HTTPException(status_code=404, detail="Phone not found")
+    response.headers.update(headers)
+    return phone
+
+
+@router.post("/facets", response_model=PhoneFacetResult)
+async def facet_phones(params: PhoneSearchParams):
+    """按条件搜索手机，同时返回品牌/标签计数与价格、电池分布"""
+    return await phone_service.facet_search(params)
+
+
+@router.post("/search:batch", response_model=List[List[Phone]])
+async def batch_search_phones(request: PhoneBatchSearchRequest):
+    """批量搜索手机，结果与请求中的 queries 一一对应"""
+    return await phone_service.search_phones_batch(request.queries)
@@ -1,7 +1,8 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException, Response
 from app.models.thread import Thread, ThreadCreate, ThreadUpdate
 from app.services.chat_service import chat_service
-from typing import List
+from app.utils.http import conditional_headers, is_not_modified, weak_etag
+from typing import List, Optional
 
 router = APIRouter(prefix="/api/threads", tags=["threads"])
 
@@ -25,11 +26,26 @@ async def update_thread(thread_id: str, thread_data: ThreadUpdate):
 
 
 @router.get("/{thread_id}", response_model=Thread)
-async def get_thread(thread_id: str):
-    """获取单个对话线程"""
+async def get_thread(
+    thread_id: str,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    if_modified_since: Optional[str] = Header(None),
+):
+    """获取单个对话线程，支持 ETag / Last-Modified 条件请求"""
+    updated_at = await chat_service.get_thread_version(thread_id)
+    if updated_at is None:
+        raise HTTPException(status_code=404, detail="Thread not found")
+
+    etag = weak_etag("thread", thread_id, updated_at)
+    headers = conditional_headers(etag, updated_at)
+    if is_not_modified(etag, updated_at, if_none_match, if_modified_since):
+        return Response(status_code=304, headers=headers)
+
     thread = await chat_service.get_thread(thread_id)
     if not thread:
         raise HTTPException(status_code=404, detail="Thread not found")
+    response.headers.update(headers)
     return thread
 
 
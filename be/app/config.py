@@ -1,5 +1,23 @@
+from pydantic import BaseModel
 from pydantic_settings import BaseSettings
-from typing import List, Optional
+from typing import Dict, List, Optional
+
+
+class LLMBackendConfig(BaseModel):
+    """一个 OpenAI 兼容的 LLM 后端"""
+
+    name: str
+    base_url: Optional[str] = None
+    api_key: Optional[str] = None  # 为空时使用 openai_api_key
+    model: Optional[str] = None  # 为空时使用 openai_model
+    weight: float = 1.0
+
+
+class ModelPrice(BaseModel):
+    """模型单价，按每百万 token 计"""
+
+    input_per_million: float = 0.0
+    output_per_million: float = 0.0
 
 
 class Settings(BaseSettings):
@@ -10,9 +28,69 @@ class Settings(BaseSettings):
     openai_model: str
     openai_api_base: str
 
+    # LLM 后端池配置，为空时只使用 openai_api_base
+    llm_backends: List[LLMBackendConfig] = []
+    llm_backend_max_retries: int = 1
+    llm_backend_cooldown_seconds: float = 30.0
+    llm_request_timeout_seconds: float = 120.0
+    llm_http_max_connections: int = 100
+    llm_http_max_keepalive_connections: int = 20
+    llm_hedge_enabled: bool = False
+    llm_hedge_percentile: float = 0.95
+    llm_hedge_min_delay_seconds: float = 0.5
+    llm_hedge_max_delay_seconds: float = 5.0
+
+    # 模型分级路由：工具选择/参数抽取走小模型，最终回答走大模型；小模型为空时不路由
+    llm_small_model: Optional[str] = None
+    llm_large_model: Optional[str] = None  # 为空时使用 openai_model
+    llm_router_max_history_messages: int = 12
+    llm_router_escalate_on_answer: bool = True
+
+    # LLM 响应缓存（本地 SQLite），目录版本变化时失效
+    llm_response_cache_enabled: bool = False
+    llm_response_cache_path: str = "data/llm_response_cache.sqlite3"
+    llm_response_cache_ttl_seconds: float = 86400.0
+    llm_response_cache_max_bytes: int = 64 * 1024 * 1024
+    llm_response_cache_replay_chars_per_second: float = 0.0  # 0 表示不模拟生成速度
+
+    # 相同的并发 LLM 生成和手机搜索只执行一次
+    single_flight_enabled: bool = True
+
+    # 用量计量与预算；上限为 0 表示不限制
+    llm_prices: Dict[str, ModelPrice] = {}  # 模型名 -> 单价，也按前缀匹配带版本号的模型名
+    usage_max_tokens_per_turn: int = 0  # 单次生成（含工具循环）的 token 上限
+    usage_max_tokens_per_day: int = 0  # 每个用户（X-User-Id，缺省按线程）每天（北京时间）的 token 上限（标识由客户端提供，仅作提示）
+    usage_max_tokens_per_day_total: int = 0  # 所有用户合计每天（北京时间）的 token 上限，不依赖客户端提供的标识
+    usage_max_model_calls_per_turn: int = 10  # 单次生成的模型调用次数上限，防止工具调用循环失控
+
     # MongoDB 配置
     mongodb_url: str = "mongodb://localhost:27017"
     mongodb_db_name: str = "phone_recommend"
+    mongodb_driver: str = "motor"  # motor / pymongo（原生异步 AsyncMongoClient）/ memory（进程内，测试用）
+    # 连接池与超时；未设置时使用连接 URL 中的同名参数或驱动默认值，设置后优先于 URL
+    mongodb_max_pool_size: Optional[int] = None  # 驱动默认 100
+    mongodb_min_pool_size: Optional[int] = None
+    mongodb_max_connecting: Optional[int] = None  # 每个连接池同时建立的连接数，驱动默认 2
+    mongodb_max_idle_time_ms: Optional[int] = None
+    mongodb_wait_queue_timeout_ms: Optional[int] = None  # 连接池耗尽时签出连接的最长等待
+    mongodb_connect_timeout_ms: Optional[int] = None  # 驱动默认 20000
+    mongodb_server_selection_timeout_ms: Optional[int] = None  # 驱动默认 30000
+    mongodb_socket_timeout_ms: Optional[int] = None
+    mongodb_compressors: Optional[str] = None  # 例如 "zstd,zlib"；zstd/snappy 需要额外安装依赖
+    # 目录（phones）读取使用独立的连接池和读偏好，可路由到从节点
+    mongodb_catalog_url: str = ""  # 为空时与 mongodb_url 相同
+    mongodb_catalog_separate_pool: bool = True
+    mongodb_catalog_max_pool_size: Optional[int] = None
+    mongodb_catalog_min_pool_size: Optional[int] = None
+    mongodb_catalog_read_preference: str = "primary"  # primary/primaryPreferred/secondary/secondaryPreferred/nearest
+    mongodb_catalog_max_staleness_seconds: int = -1  # -1 不限制，否则至少 90
+    mongodb_ensure_indexes: bool = True  # 启动时在后台创建声明的索引
+    mongodb_index_diagnostics: bool = False  # 启动时 explain 热点查询并告警全表扫描
+    mongodb_command_monitoring: bool = True  # 按查询形状统计次数与耗时
+    mongodb_slow_query_ms: float = 100  # 超过该耗时的命令记录慢查询日志
+    mongodb_slow_query_explain: bool = True  # 慢查询日志附带 explain 摘要
+    mongodb_slow_query_explain_interval: float = 60  # 同一形状两次 explain 的最小间隔（秒）
+    mongodb_query_shapes_max: int = 500  # 超出后新形状计入 (other)
 
     # 服务器配置
     host: str = "0.0.0.0"
@@ -25,6 +103,57 @@ class Settings(BaseSettings):
     # CORS 配置
     cors_origins: List[str] = ["*"]
 
+    # 生成调度配置
+    llm_max_concurrent_generations: int = 8
+    llm_max_queued_generations: int = 64
+    llm_max_queued_per_key: int = 2
+    llm_tokens_per_minute: int = 0  # 0 表示不限制
+    llm_estimated_tokens_per_generation: int = 4000
+    llm_queue_update_interval_seconds: float = 1.0
+
+    # 消息写入 write-behind 队列
+    write_behind_enabled: bool = True
+    write_behind_flush_interval_seconds: float = 0.1
+    write_behind_max_batch: int = 500
+    write_behind_max_pending: int = 10000
+    write_behind_journal_path: str = "data/write_behind.journal"  # 每个进程写 <路径>.<主机名>.<pid>
+    write_behind_fsync: bool = True
+
+    # 生成任务配置
+    generation_buffer_size: int = 1024
+    generation_retention_seconds: float = 300.0
+    generation_cancel_on_disconnect: bool = True
+    generation_disconnect_grace_seconds: float = 15.0
+    # 同一线程的生成逐个执行；窗口内重复提交的相同消息附加到第一次提交的生成
+    generation_dedupe_window_seconds: float = 5.0  # 0 表示不合并
+    generation_thread_lease: bool = False  # 多 worker 部署时开启，用 Mongo 租约跨进程串行化
+    generation_thread_lease_ttl_seconds: float = 30.0  # 持有期间每 1/3 TTL 续期一次
+
+    # 手机目录配置
+    skyline_refresh_seconds: float = 300.0
+    catalog_version_ttl_seconds: float = 5.0
+    catalog_cache_max_age: int = 60
+    catalog_cache_stale_while_revalidate: int = 300
+    phone_search_cache_max_entries: int = 1024  # 0 表示不缓存
+    phone_search_cache_ttl_seconds: float = 60.0
+    catalog_snapshot_enabled: bool = True
+    catalog_snapshot_dir: str = "data/catalog"
+    catalog_snapshot_check_seconds: float = 1.0
+
+    # 管理接口
+    admin_token: str = ""  # 为空时关闭管理接口
+
+    # 目录增量同步
+    catalog_sync_mode: str = "auto"  # auto / change_stream / poll / off
+    catalog_sync_poll_seconds: float = 2.0
+    catalog_sync_batch_size: int = 500
+
+    # 追问搜索预取
+    prefetch_enabled: bool = True
+    prefetch_max_queries_per_turn: int = 3
+    prefetch_max_queries_per_minute: int = 30
+    prefetch_max_time_ms: int = 200
+
     class Config:
         env_file = ".env"
         case_sensitive = False
@@ -1,67 +1,253 @@
+import inspect
 import logging
-from typing import Optional
-
-from motor.motor_asyncio import (
-    AsyncIOMotorClient,
-    AsyncIOMotorDatabase,
-    AsyncIOMotorCollection,
+from typing import Any, Dict, Optional
+
+from pymongo import monitoring
+from pymongo.read_preferences import (
+    Nearest,
+    Primary,
+    PrimaryPreferred,
+    Secondary,
+    SecondaryPreferred,
 )
 
 from app.config import settings
+from app.metrics import registry
+from app.query_monitor import query_monitor
+from app.repository import MotorRepository, PyMongoRepository, Repository
 
 logger = logging.getLogger("app.database")
 
+POOL_CHECKOUT_WAIT = registry.histogram(
+    "mongodb_pool_checkout_wait_seconds",
+    "Time spent waiting to check out a connection from the MongoDB pool",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+POOL_CHECKOUT_FAILURES = registry.counter(
+    "mongodb_pool_checkout_failures_total", "Connection checkouts that failed, by reason"
+)
+POOL_CONNECTIONS = registry.gauge("mongodb_pool_connections", "Open connections per MongoDB pool and server")
+POOL_IN_USE = registry.gauge("mongodb_pool_connections_in_use", "Checked-out connections per MongoDB pool and server")
+POOL_WAITING = registry.gauge("mongodb_pool_checkouts_waiting", "Connection checkouts waiting per MongoDB pool")
+
+_READ_PREFERENCES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """把连接池事件导出为指标：签出等待时间、打开/占用的连接数和排队的签出"""
+
+    def __init__(self, pool: str) -> None:
+        self.pool = pool
+
+    def _labels(self, event: Any) -> Dict[str, str]:
+        host, port = event.address
+        return {"pool": self.pool, "address": f"{host}:{port}"}
+
+    def pool_created(self, event: monitoring.PoolCreatedEvent) -> None:
+        pass
+
+    def pool_ready(self, event: monitoring.PoolReadyEvent) -> None:
+        pass
+
+    def pool_cleared(self, event: monitoring.PoolClearedEvent) -> None:
+        logger.warning("MongoDB pool %s for %s:%s cleared", self.pool, *event.address)
+
+    def pool_closed(self, event: monitoring.PoolClosedEvent) -> None:
+        pass
+
+    def connection_created(self, event: monitoring.ConnectionCreatedEvent) -> None:
+        POOL_CONNECTIONS.inc(**self._labels(event))
+
+    def connection_ready(self, event: monitoring.ConnectionReadyEvent) -> None:
+        pass
+
+    def connection_closed(self, event: monitoring.ConnectionClosedEvent) -> None:
+        POOL_CONNECTIONS.dec(**self._labels(event))
+
+    def connection_check_out_started(self, event: monitoring.ConnectionCheckOutStartedEvent) -> None:
+        POOL_WAITING.inc(pool=self.pool)
+
+    def connection_check_out_failed(self, event: monitoring.ConnectionCheckOutFailedEvent) -> None:
+        POOL_WAITING.dec(pool=self.pool)
+        POOL_CHECKOUT_FAILURES.inc(pool=self.pool, reason=str(event.reason))
+        POOL_CHECKOUT_WAIT.observe(event.duration, pool=self.pool)
+
+    def connection_checked_out(self, event: monitoring.ConnectionCheckedOutEvent) -> None:
+        POOL_WAITING.dec(pool=self.pool)
+        POOL_IN_USE.inc(**self._labels(event))
+        POOL_CHECKOUT_WAIT.observe(event.duration, pool=self.pool)
+
+    def connection_checked_in(self, event: monitoring.ConnectionCheckedInEvent) -> None:
+        POOL_IN_USE.dec(**self._labels(event))
+
 
 class Database:
-    client: Optional[AsyncIOMotorClient] = None
-    threads_collection: Optional[AsyncIOMotorCollection] = None
-    phones_collection: Optional[AsyncIOMotorCollection] = None
+    client: Any = None
+    catalog_client: Any = None
+    threads_collection: Optional[Repository] = None
+    phones_collection: Optional[Repository] = None
 
 
 db = Database()
 
 
+def read_preference(name: str, max_staleness_seconds: int = -1) -> Any:
+    """按名称构造读偏好；primary 不支持 max staleness"""
+    if name not in _READ_PREFERENCES:
+        raise ValueError(f"Unknown read preference: {name}")
+    if name == "primary":
+        return Primary()
+    return _READ_PREFERENCES[name](max_staleness=max_staleness_seconds)
+
+
+def _client_options(pool: str, max_pool_size: Optional[int], min_pool_size: Optional[int]) -> Dict[str, Any]:
+    """连接池、超时和压缩选项；只传入显式设置的项，其余沿用连接 URL 中的参数或驱动默认值"""
+    listeners: list = [PoolMonitor(pool)]
+    if settings.mongodb_command_monitoring:
+        listeners.append(query_monitor)
+    options: Dict[str, Any] = {
+        "appname": f"phone-recommend-{pool}",
+        "event_listeners": listeners,
+    }
+    configured = {
+        "maxPoolSize": max_pool_size,
+        "minPoolSize": min_pool_size,
+        "maxConnecting": settings.mongodb_max_connecting,
+        "connectTimeoutMS": settings.mongodb_connect_timeout_ms,
+        "serverSelectionTimeoutMS": settings.mongodb_server_selection_timeout_ms,
+        "maxIdleTimeMS": settings.mongodb_max_idle_time_ms,
+        "waitQueueTimeoutMS": settings.mongodb_wait_queue_timeout_ms,
+        "socketTimeoutMS": settings.mongodb_socket_timeout_ms,
+        "compressors": settings.mongodb_compressors,
+    }
+    options.update({name: value for name, value in configured.items() if value is not None})
+    return options
+
+
+def _create_client(url: str, options: Dict[str, Any]) -> Any:
+    """按 mongodb_driver 创建客户端；驱动按需导入，未选用的驱动不必安装"""
+    if settings.mongodb_driver == "motor":
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        return AsyncIOMotorClient(url, **options)
+    if settings.mongodb_driver == "pymongo":
+        from pymongo import AsyncMongoClient
+
+        return AsyncMongoClient(url, **options)
+    raise ValueError(f"Unknown MongoDB driver: {settings.mongodb_driver}")
+
+
+def _repository(collection: Any) -> Repository:
+    if settings.mongodb_driver == "memory":
+        return collection
+    if settings.mongodb_driver == "pymongo":
+        return PyMongoRepository(collection)
+    return MotorRepository(collection)
+
+
+async def _close_client(client: Any) -> None:
+    # Motor 的 close 是同步的，PyMongo 原生异步客户端需要 await
+    result = client.close()
+    if inspect.isawaitable(result):
+        await result
+
+
 async def connect_to_mongo() -> None:
-    """连接 MongoDB"""
-    db.client = AsyncIOMotorClient(settings.mongodb_url)
+    """连接 MongoDB；目录读取可使用独立的连接池和读偏好，避免与对话写入争用连接"""
+    if settings.mongodb_driver == "memory":
+        from app.memory_store import MemoryClient
+
+        db.client = db.catalog_client = MemoryClient()
+    else:
+        db.client = _create_client(
+            settings.mongodb_url,
+            _client_options("default", settings.mongodb_max_pool_size, settings.mongodb_min_pool_size),
+        )
+        if settings.mongodb_command_monitoring:
+            query_monitor.attach(db.client)
+        if settings.mongodb_catalog_separate_pool or settings.mongodb_catalog_url:
+            db.catalog_client = _create_client(
+                settings.mongodb_catalog_url or settings.mongodb_url,
+                _client_options(
+                    "catalog", settings.mongodb_catalog_max_pool_size, settings.mongodb_catalog_min_pool_size
+                ),
+            )
+        else:
+            db.catalog_client = db.client
     database = db.client[settings.mongodb_db_name]
-    db.threads_collection = database.get_collection("threads")
-    db.phones_collection = database.get_collection("phones")
-    logger.info("Connected to MongoDB database '%s'", settings.mongodb_db_name)
+    db.threads_collection = _repository(database.get_collection("threads"))
+    db.phones_collection = _catalog_collection()
+    logger.info(
+        "Connected to MongoDB database '%s' with %s (catalog pool: %s, read preference: %s)",
+        settings.mongodb_db_name,
+        settings.mongodb_driver,
+        "separate" if db.catalog_client is not db.client else "shared",
+        settings.mongodb_catalog_read_preference,
+    )
 
 
 async def close_mongo_connection() -> None:
     """关闭 MongoDB 连接"""
     if db.client:
-        db.client.close()
+        if db.catalog_client is not None and db.catalog_client is not db.client:
+            await _close_client(db.catalog_client)
+        await _close_client(db.client)
         db.client = None
+        db.catalog_client = None
+        query_monitor.detach()
         db.threads_collection = None
         db.phones_collection = None
         logger.info("Disconnected from MongoDB")
 
 
-def get_database() -> AsyncIOMotorDatabase:
-    """获取数据库实例"""
+def _catalog_collection() -> Repository:
+    client = db.catalog_client or db.client
+    collection = client[settings.mongodb_db_name].get_collection(
+        "phones",
+        read_preference=read_preference(
+            settings.mongodb_catalog_read_preference, settings.mongodb_catalog_max_staleness_seconds
+        ),
+    )
+    return _repository(collection)
+
+
+def get_database() -> Any:
+    """获取驱动的数据库对象，供索引管理等需要驱动原生接口的场景使用"""
     if not db.client:
         raise RuntimeError("MongoDB client is not initialized")
     return db.client[settings.mongodb_db_name]
 
 
-def get_threads_collection() -> AsyncIOMotorCollection:
+def get_threads_collection() -> Repository:
     """获取对话线程集合"""
     if db.threads_collection is None:
         if not db.client:
             raise RuntimeError("MongoDB client is not initialized")
         database = db.client[settings.mongodb_db_name]
-        db.threads_collection = database.get_collection("threads")
+        db.threads_collection = _repository(database.get_collection("threads"))
     return db.threads_collection
 
 
-def get_phones_collection() -> AsyncIOMotorCollection:
-    """获取手机数据集合"""
+def get_phones_collection() -> Repository:
+    """获取手机数据集合（目录连接池，按配置的读偏好读取）"""
     if db.phones_collection is None:
         if not db.client:
             raise RuntimeError("MongoDB client is not initialized")
-        database = db.client[settings.mongodb_db_name]
-        db.phones_collection = database.get_collection("phones")
+        db.phones_collection = _catalog_collection()
     return db.phones_collection
+
+
+def get_thread_leases_collection() -> Repository:
+    """获取线程生成租约集合（多 worker 部署时串行化同一线程的生成）"""
+    return _repository(get_database().get_collection("thread_leases"))
+
+
+def get_usage_collection() -> Repository:
+    """获取按天、用户和模型汇总的 token 用量集合"""
+    return _repository(get_database().get_collection("usage_daily"))
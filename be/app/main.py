@@ -2,13 +2,20 @@ import logging
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 
 from app.config import settings
 from app.database import connect_to_mongo, close_mongo_connection
-from app.api import threads, messages
+from app.api import admin, debug, threads, messages, phones
 from app.logging_config import setup_logging
+from app.metrics import registry
+from app.services.generation_service import generation_manager
+from app.services.index_service import index_service
 from app.services.llm_service import llm_service
-from app.tools import search_phones
+from app.services.phone_service import catalog_sync
+from app.services.prefetch_service import prefetch_service
+from app.services.write_behind import message_writes
+from app.tools import facet_phones, search_phones
 
 setup_logging()
 logger = logging.getLogger("app.main")
@@ -31,21 +38,34 @@ app.add_middleware(
 # 注册路由
 app.include_router(threads.router)
 app.include_router(messages.router)
+app.include_router(phones.router)
+app.include_router(admin.router)
+app.include_router(debug.router)
 
 
 @app.on_event("startup")
 async def startup_event():
-    """应用启动时连接数据库并初始化工具"""
-    await connect_to_mongo()
-
+    """应用启动时连接数据库并初始化工具；模型客户端在后台预热，不阻塞启动"""
     # 绑定工具到 LLM 服务
-    llm_service.bind_tools([search_phones])
+    llm_service.bind_tools([search_phones, facet_phones])
+    llm_service.start_warm_up()
+
+    await connect_to_mongo()
+    await index_service.start()
+    await message_writes.start()
+    await catalog_sync.start()
     logger.info("AI tools initialized successfully")
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    """应用关闭时断开数据库连接"""
+    """应用关闭时停止生成任务并断开数据库连接"""
+    await generation_manager.shutdown()
+    await prefetch_service.shutdown()
+    await llm_service.aclose()
+    await message_writes.stop()
+    await catalog_sync.stop()
+    await index_service.stop()
     await close_mongo_connection()
 
 
@@ -63,3 +83,9 @@ async def root():
 async def health():
     """健康检查"""
     return {"status": "healthy"}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus 格式的进程内指标"""
+    return registry.render()
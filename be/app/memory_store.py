@@ -0,0 +1,764 @@
+"""内存中的 Repository 实现 - 用于测试、本地演示和驱动基准的对照组
+
+只实现服务用到的查询、更新、投影和聚合子集，遇到不支持的操作符时抛出 NotImplementedError，
+不会静默返回错误结果。文档读写时深拷贝，调用方修改返回值不会影响存储。没有 change stream，
+hello 不返回副本集名称，目录同步因此走轮询；watch 与单机 mongod 一样抛出 OperationFailure。
+"""
+
+import copy
+import re
+from collections import Counter
+from datetime import datetime
+from functools import cmp_to_key
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from bson import ObjectId
+from pymongo import DeleteMany, DeleteOne, IndexModel, InsertOne, ReplaceOne, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+from app.repository import Document, Repository
+
+_MISSING = object()
+# 单机 mongod 上打开 change stream 时的错误码
+CHANGE_STREAM_NOT_SUPPORTED = 40573
+
+
+# ---------------------------------------------------------------- 路径与比较
+
+
+def _resolve(value: Any, parts: Sequence[str]) -> List[Any]:
+    """按点分路径取值，遇到数组时展开到每个元素；缺失时返回空列表"""
+    if not parts:
+        return [value]
+    head, rest = parts[0], parts[1:]
+    if isinstance(value, dict):
+        return _resolve(value[head], rest) if head in value else []
+    if isinstance(value, list):
+        if head.isdigit():
+            index = int(head)
+            return _resolve(value[index], rest) if index < len(value) else []
+        resolved: List[Any] = []
+        for item in value:
+            if isinstance(item, dict):
+                resolved.extend(_resolve(item, parts))
+        return resolved
+    return []
+
+
+def _candidates(doc: Document, path: str) -> List[Any]:
+    """查询比较的候选值：路径上的值，以及数组值中的每个元素"""
+    candidates: List[Any] = []
+    for value in _resolve(doc, path.split(".")):
+        candidates.append(value)
+        if isinstance(value, list):
+            candidates.extend(value)
+    return candidates
+
+
+# BSON 类型顺序：null < 数字 < 字符串 < 对象 < 数组 < ObjectId < 布尔 < 日期
+_TYPE_ORDER = ((type(None), 0), (bool, 6), ((int, float), 1), (str, 2), (dict, 3), (list, 4), (ObjectId, 5))
+
+
+def _type_rank(value: Any) -> int:
+    if isinstance(value, datetime):
+        return 7
+    for types, rank in _TYPE_ORDER:
+        if isinstance(value, types):
+            return rank
+    return 8
+
+
+def _compare(left: Any, right: Any) -> int:
+    """BSON 比较顺序的简化版：先比较类型，再比较值"""
+    left_rank, right_rank = _type_rank(left), _type_rank(right)
+    if left_rank != right_rank:
+        return -1 if left_rank < right_rank else 1
+    if left_rank in (3, 4):
+        left, right = repr(left), repr(right)
+    if left == right:
+        return 0
+    return -1 if left < right else 1
+
+
+def _comparable(left: Any, right: Any) -> bool:
+    return _type_rank(left) == _type_rank(right) and _type_rank(left) not in (0, 3, 4)
+
+
+# ---------------------------------------------------------------- 查询
+
+
+def matches(doc: Document, query: Optional[Document]) -> bool:
+    """判断文档是否满足查询条件"""
+    for key, condition in (query or {}).items():
+        if key == "$or":
+            if not any(matches(doc, clause) for clause in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(doc, clause) for clause in condition):
+                return False
+        elif key == "$nor":
+            if any(matches(doc, clause) for clause in condition):
+                return False
+        elif key.startswith("$"):
+            raise NotImplementedError(f"Unsupported query operator: {key}")
+        elif not _field_matches(doc, key, condition):
+            return False
+    return True
+
+
+def _is_operator_spec(condition: Any) -> bool:
+    return isinstance(condition, dict) and bool(condition) and all(key.startswith("$") for key in condition)
+
+
+def _field_matches(doc: Document, path: str, condition: Any) -> bool:
+    if _is_operator_spec(condition):
+        options = condition.get("$options", "")
+        return all(
+            _operator_matches(doc, path, operator, operand, options)
+            for operator, operand in condition.items()
+            if operator != "$options"
+        )
+    return _equals(_candidates(doc, path), condition)
+
+
+def _equals(candidates: List[Any], value: Any) -> bool:
+    if isinstance(value, re.Pattern):
+        return any(isinstance(candidate, str) and value.search(candidate) for candidate in candidates)
+    if value is None and not candidates:
+        return True
+    return any(candidate == value for candidate in candidates)
+
+
+_COMPARISONS: Dict[str, Callable[[int], bool]] = {
+    "$gt": lambda result: result > 0,
+    "$gte": lambda result: result >= 0,
+    "$lt": lambda result: result < 0,
+    "$lte": lambda result: result <= 0,
+}
+
+
+def _operator_matches(doc: Document, path: str, operator: str, operand: Any, options: str) -> bool:
+    candidates = _candidates(doc, path)
+    if operator == "$eq":
+        return _equals(candidates, operand)
+    if operator == "$ne":
+        return not _equals(candidates, operand)
+    if operator in _COMPARISONS:
+        check = _COMPARISONS[operator]
+        return any(
+            _comparable(candidate, operand) and check(_compare(candidate, operand)) for candidate in candidates
+        )
+    if operator == "$in":
+        return any(_equals(candidates, value) for value in operand)
+    if operator == "$nin":
+        return not any(_equals(candidates, value) for value in operand)
+    if operator == "$all":
+        return bool(operand) and all(_equals(candidates, value) for value in operand)
+    if operator == "$exists":
+        return bool(_resolve(doc, path.split("."))) == bool(operand)
+    if operator == "$size":
+        return any(isinstance(value, list) and len(value) == operand for value in _resolve(doc, path.split(".")))
+    if operator == "$regex":
+        flags = re.IGNORECASE if "i" in options else 0
+        pattern = operand if isinstance(operand, re.Pattern) else re.compile(operand, flags)
+        return _equals(candidates, pattern)
+    if operator == "$not":
+        return not _field_matches(doc, path, operand)
+    if operator == "$elemMatch":
+        for value in _resolve(doc, path.split(".")):
+            if not isinstance(value, list):
+                continue
+            for item in value:
+                if _is_operator_spec(operand) and "$elemMatch" not in operand:
+                    if _field_matches({"v": item}, "v", operand):
+                        return True
+                elif isinstance(item, dict) and matches(item, operand):
+                    return True
+        return False
+    raise NotImplementedError(f"Unsupported query operator: {operator}")
+
+
+# ---------------------------------------------------------------- 投影与排序
+
+
+def project(doc: Document, projection: Optional[Any]) -> Document:
+    """find 的投影：包含或排除字段，支持点分路径"""
+    if not projection:
+        return copy.deepcopy(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    for value in projection.values():
+        if isinstance(value, dict):
+            raise NotImplementedError("Projection operators are not supported")
+    fields = {key: bool(value) for key, value in projection.items() if key != "_id"}
+    include_id = bool(projection.get("_id", True))
+    if any(fields.values()) or (not fields and include_id and "_id" in projection):
+        result = _include(doc, [key.split(".") for key, keep in fields.items() if keep])
+        if include_id and "_id" in doc:
+            result["_id"] = doc["_id"]
+        return copy.deepcopy(result)
+    result = copy.deepcopy(doc)
+    for key in fields:
+        _unset(result, key.split("."))
+    if not include_id:
+        result.pop("_id", None)
+    return result
+
+
+def _include(value: Any, paths: List[List[str]]) -> Any:
+    if isinstance(value, list):
+        return [_include(item, paths) for item in value if isinstance(item, dict)]
+    if not isinstance(value, dict):
+        return value
+    result: Dict[str, Any] = {}
+    for key in dict.fromkeys(path[0] for path in paths):
+        if key not in value:
+            continue
+        rest = [path[1:] for path in paths if path[0] == key]
+        result[key] = value[key] if any(not path for path in rest) else _include(value[key], rest)
+    return result
+
+
+def _sort_spec(key_or_list: Any, direction: Optional[int] = None) -> List[Tuple[str, int]]:
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction or 1)]
+    if isinstance(key_or_list, dict):
+        return list(key_or_list.items())
+    return [(key, value) for key, value in key_or_list]
+
+
+def sort_documents(docs: List[Document], spec: Sequence[Tuple[str, int]]) -> List[Document]:
+    def sort_value(doc: Document, path: str, direction: int) -> Any:
+        values = _candidates(doc, path)
+        scalars = [value for value in values if not isinstance(value, list)] or [None]
+        # 数组字段升序按最小元素、降序按最大元素排序
+        return sorted(scalars, key=cmp_to_key(_compare))[0 if direction > 0 else -1]
+
+    def compare(left: Document, right: Document) -> int:
+        for path, direction in spec:
+            result = _compare(sort_value(left, path, direction), sort_value(right, path, direction))
+            if result:
+                return result * (1 if direction > 0 else -1)
+        return 0
+
+    return sorted(docs, key=cmp_to_key(compare))
+
+
+# ---------------------------------------------------------------- 更新
+
+
+def _set_path(doc: Document, parts: Sequence[str], value: Any) -> None:
+    target: Any = doc
+    for part in parts[:-1]:
+        if isinstance(target, list):
+            target = target[int(part)]
+        else:
+            target = target.setdefault(part, {})
+    if isinstance(target, list):
+        target[int(parts[-1])] = value
+    else:
+        target[parts[-1]] = value
+
+
+def _unset(value: Any, parts: Sequence[str]) -> None:
+    if isinstance(value, list):
+        for item in value:
+            _unset(item, parts)
+    elif isinstance(value, dict):
+        if len(parts) == 1:
+            value.pop(parts[0], None)
+        elif parts[0] in value:
+            _unset(value[parts[0]], parts[1:])
+
+
+def _positional_path(doc: Document, path: str, query: Document) -> List[str]:
+    """把 `array.$.field` 中的 $ 替换为查询条件匹配到的第一个数组元素下标"""
+    if ".$." not in path and not path.endswith(".$"):
+        return path.split(".")
+    array_path, _, rest = path.partition(".$")
+    prefix = array_path + "."
+    conditions = {key[len(prefix) :]: value for key, value in query.items() if key.startswith(prefix)}
+    for key, value in query.items():
+        if key == array_path and isinstance(value, dict) and "$elemMatch" in value:
+            conditions.update(value["$elemMatch"])
+    array = (_resolve(doc, array_path.split(".")) or [None])[0]
+    if isinstance(array, list):
+        for index, item in enumerate(array):
+            if isinstance(item, dict) and matches(item, conditions):
+                return [*array_path.split("."), str(index), *[part for part in rest.split(".") if part]]
+    raise ValueError(f"The positional operator did not find the match needed from the query: {path}")
+
+
+def apply_update(doc: Document, update: Document, query: Document, inserting: bool = False) -> None:
+    """原地应用更新操作符"""
+    if not update or not all(key.startswith("$") for key in update):
+        raise NotImplementedError("Replacement documents and aggregation updates are not supported")
+    for operator, fields in update.items():
+        if operator == "$setOnInsert" and not inserting:
+            continue
+        for path, value in fields.items():
+            parts = _positional_path(doc, path, query)
+            if operator in ("$set", "$setOnInsert"):
+                _set_path(doc, parts, copy.deepcopy(value))
+            elif operator == "$unset":
+                _unset(doc, parts)
+            elif operator == "$inc":
+                current = (_resolve(doc, parts) or [0])[0]
+                _set_path(doc, parts, current + value)
+            elif operator == "$push":
+                current = (_resolve(doc, parts) or [None])[0]
+                if current is None:
+                    current = []
+                    _set_path(doc, parts, current)
+                items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                current.extend(copy.deepcopy(items))
+            else:
+                raise NotImplementedError(f"Unsupported update operator: {operator}")
+
+
+def _upsert_seed(query: Document) -> Document:
+    """upsert 插入时从查询中的等值条件得到初始文档"""
+    seed: Document = {}
+    for key, value in query.items():
+        if key.startswith("$") or _is_operator_spec(value):
+            if isinstance(value, dict) and "$eq" in value:
+                _set_path(seed, key.split("."), copy.deepcopy(value["$eq"]))
+            continue
+        _set_path(seed, key.split("."), copy.deepcopy(value))
+    return seed
+
+
+# ---------------------------------------------------------------- 聚合
+
+
+def evaluate(expression: Any, doc: Any, variables: Optional[Dict[str, Any]] = None) -> Any:
+    """聚合表达式求值：字段路径、$$ 变量、$ifNull、$filter、比较、$min/$max、$size"""
+    variables = variables or {}
+    if isinstance(expression, str) and expression.startswith("$$"):
+        name, _, path = expression[2:].partition(".")
+        return _expression_path(variables.get(name), path.split(".") if path else [])
+    if isinstance(expression, str) and expression.startswith("$"):
+        return _expression_path(doc, expression[1:].split("."))
+    if isinstance(expression, list):
+        return [evaluate(item, doc, variables) for item in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if len(expression) == 1 and next(iter(expression)).startswith("$"):
+        operator, operand = next(iter(expression.items()))
+        return _evaluate_operator(operator, operand, doc, variables)
+    return {key: evaluate(value, doc, variables) for key, value in expression.items()}
+
+
+def _expression_path(value: Any, parts: Sequence[str]) -> Any:
+    if not parts:
+        return value
+    if isinstance(value, dict):
+        return _expression_path(value.get(parts[0]), parts[1:]) if parts[0] in value else None
+    if isinstance(value, list):
+        return [_expression_path(item, parts) for item in value if isinstance(item, dict) and parts[0] in item]
+    return None
+
+
+def _evaluate_operator(operator: str, operand: Any, doc: Any, variables: Dict[str, Any]) -> Any:
+    if operator == "$literal":
+        return operand
+    if operator == "$ifNull":
+        for expression in operand:
+            value = evaluate(expression, doc, variables)
+            if value is not None:
+                return value
+        return None
+    if operator == "$filter":
+        items = evaluate(operand["input"], doc, variables)
+        if items is None:
+            return None
+        name = operand.get("as", "this")
+        return [item for item in items if evaluate(operand["cond"], doc, {**variables, name: item})]
+    if operator in ("$gt", "$gte", "$lt", "$lte"):
+        left, right = (evaluate(expression, doc, variables) for expression in operand)
+        return _COMPARISONS[operator](_compare(left, right))
+    if operator in ("$eq", "$ne"):
+        left, right = (evaluate(expression, doc, variables) for expression in operand)
+        return (left == right) == (operator == "$eq")
+    if operator in ("$min", "$max"):
+        values = evaluate(operand, doc, variables)
+        if isinstance(operand, list) or isinstance(values, list):
+            values = [value for value in values if value is not None] if values is not None else []
+            if not values:
+                return None
+            ordered = sorted(values, key=cmp_to_key(_compare))
+            return ordered[0] if operator == "$min" else ordered[-1]
+        return values
+    if operator == "$size":
+        return len(evaluate(operand, doc, variables))
+    raise NotImplementedError(f"Unsupported expression operator: {operator}")
+
+
+def _project_stage(docs: List[Document], spec: Document) -> List[Document]:
+    if all(value in (0, False) for value in spec.values()):
+        return [project(doc, spec) for doc in docs]
+    include_id = spec.get("_id", 1) not in (0, False)
+    included = [key for key, value in spec.items() if key != "_id" and value in (1, True)]
+    computed = {key: value for key, value in spec.items() if key != "_id" and value not in (0, 1, True, False)}
+    result = []
+    for doc in docs:
+        projected = project(doc, {key: 1 for key in included}) if included else {}
+        if include_id and "_id" in doc:
+            projected["_id"] = doc["_id"]
+        elif not include_id:
+            projected.pop("_id", None)
+        for key, expression in computed.items():
+            projected[key] = evaluate(expression, doc)
+        result.append(projected)
+    return result
+
+
+def _bucket_stage(docs: List[Document], spec: Document) -> List[Document]:
+    if "output" in spec:
+        raise NotImplementedError("$bucket output is not supported")
+    boundaries = spec["boundaries"]
+    counts: Dict[Any, int] = {}
+    for doc in docs:
+        value = evaluate(spec["groupBy"], doc)
+        bucket = spec.get("default", _MISSING)
+        for lower, upper in zip(boundaries, boundaries[1:]):
+            if _comparable(value, lower) and _compare(lower, value) <= 0 < _compare(upper, value):
+                bucket = lower
+                break
+        if bucket is _MISSING:
+            raise ValueError("$bucket could not find a matching branch for an input and no default was specified")
+        counts[bucket] = counts.get(bucket, 0) + 1
+    ordered = [bound for bound in boundaries if bound in counts]
+    if "default" in spec and spec["default"] in counts and spec["default"] not in boundaries:
+        ordered.append(spec["default"])
+    return [{"_id": bound, "count": counts[bound]} for bound in ordered]
+
+
+def _group_stage(docs: List[Document], spec: Document) -> List[Document]:
+    """$group，累加器只支持 $sum；分组按首次出现的顺序输出"""
+    groups: Dict[Any, Document] = {}
+    for doc in docs:
+        key = evaluate(spec["_id"], doc)
+        hashable = tuple(sorted((k, _hashable(v)) for k, v in key.items())) if isinstance(key, dict) else _hashable(key)
+        group = groups.setdefault(hashable, {"_id": key, **{field: 0 for field in spec if field != "_id"}})
+        for field, accumulator in spec.items():
+            if field == "_id":
+                continue
+            (operator, operand), = accumulator.items()
+            if operator != "$sum":
+                raise NotImplementedError(f"Unsupported accumulator: {operator}")
+            value = evaluate(operand, doc)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                group[field] += value
+    return list(groups.values())
+
+
+def _unwind_stage(docs: List[Document], spec: Any) -> List[Document]:
+    path = (spec["path"] if isinstance(spec, dict) else spec)[1:]
+    result = []
+    for doc in docs:
+        value = (_resolve(doc, path.split(".")) or [None])[0]
+        if not isinstance(value, list):
+            if value is not None:
+                result.append(doc)
+            continue
+        for item in value:
+            unwound = copy.copy(doc)
+            _set_path(unwound, path.split("."), item)
+            result.append(unwound)
+    return result
+
+
+def run_pipeline(docs: List[Document], pipeline: Sequence[Document]) -> List[Document]:
+    """执行聚合管道；docs 为集合文档的副本"""
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name == "$match":
+            docs = [doc for doc in docs if matches(doc, spec)]
+        elif name == "$sort":
+            docs = sort_documents(docs, _sort_spec(spec))
+        elif name == "$skip":
+            docs = docs[spec:]
+        elif name == "$limit":
+            docs = docs[:spec]
+        elif name == "$project":
+            docs = _project_stage(docs, spec)
+        elif name == "$unwind":
+            docs = _unwind_stage(docs, spec)
+        elif name == "$count":
+            docs = [{spec: len(docs)}] if docs else []
+        elif name == "$sortByCount":
+            counts = Counter(_hashable(evaluate(spec, doc)) for doc in docs)
+            docs = [{"_id": value, "count": count} for value, count in counts.most_common()]
+        elif name == "$bucket":
+            docs = _bucket_stage(docs, spec)
+        elif name == "$group":
+            docs = _group_stage(docs, spec)
+        elif name == "$facet":
+            docs = [{facet: run_pipeline(list(docs), stages) for facet, stages in spec.items()}]
+        else:
+            raise NotImplementedError(f"Unsupported aggregation stage: {name}")
+    return docs
+
+
+def _hashable(value: Any) -> Any:
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+# ---------------------------------------------------------------- 集合
+
+
+def _command(command: Any) -> Document:
+    name = command if isinstance(command, str) else next(iter(command))
+    if name in ("hello", "isMaster", "ping"):
+        # 没有 setName，调用方会当作单机部署
+        return {"ok": 1.0, "isWritablePrimary": True}
+    raise NotImplementedError(f"Unsupported command: {name}")
+
+
+class MemoryCursor:
+    """内存游标；第一次迭代时才执行查询，与驱动游标一样可以先链式设置排序和分页"""
+
+    def __init__(self, repository: "MemoryRepository", filter: Optional[Document], projection: Optional[Any]):
+        self._repository = repository
+        self._filter = filter or {}
+        self._projection = projection
+        self._sort: List[Tuple[str, int]] = []
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key_or_list: Any, direction: Optional[int] = None) -> "MemoryCursor":
+        self._sort = _sort_spec(key_or_list, direction)
+        return self
+
+    def skip(self, skip: int) -> "MemoryCursor":
+        self._skip = skip
+        return self
+
+    def limit(self, limit: int) -> "MemoryCursor":
+        self._limit = limit
+        return self
+
+    def _execute(self) -> List[Document]:
+        docs = [doc for doc in self._repository.documents.values() if matches(doc, self._filter)]
+        if self._sort:
+            docs = sort_documents(docs, self._sort)
+        docs = docs[self._skip :]
+        if self._limit:
+            docs = docs[: self._limit]
+        return [project(doc, self._projection) for doc in docs]
+
+    async def to_list(self, length: Optional[int] = None) -> List[Document]:
+        docs = self._execute()
+        return docs if length is None else docs[:length]
+
+    async def explain(self) -> Document:
+        return {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}, "executionStats": {}}
+
+    async def __aiter__(self) -> AsyncIterator[Document]:
+        for doc in self._execute():
+            yield doc
+
+
+class MemoryRepository(Repository):
+    """保存在进程内字典中的集合，按插入顺序返回文档"""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.documents: Dict[Any, Document] = {}
+        self.indexes: Dict[str, Document] = {"_id_": {"key": [("_id", 1)]}}
+
+    def find(self, filter: Optional[Document] = None, projection: Optional[Any] = None) -> MemoryCursor:
+        return MemoryCursor(self, filter, projection)
+
+    async def find_one(
+        self, filter: Optional[Document] = None, projection: Optional[Any] = None, sort: Optional[Any] = None
+    ) -> Optional[Document]:
+        cursor = self.find(filter, projection).limit(1)
+        if sort:
+            cursor.sort(sort)
+        docs = await cursor.to_list()
+        return docs[0] if docs else None
+
+    async def count_documents(self, filter: Document) -> int:
+        return sum(1 for doc in self.documents.values() if matches(doc, filter))
+
+    async def insert_one(self, document: Document) -> InsertOneResult:
+        return InsertOneResult(self._insert(document), True)
+
+    async def insert_many(self, documents: Sequence[Document]) -> InsertManyResult:
+        return InsertManyResult([self._insert(document) for document in documents], True)
+
+    async def update_one(self, filter: Document, update: Document, upsert: bool = False) -> UpdateResult:
+        return UpdateResult(self._update(filter, update, upsert, multi=False), True)
+
+    async def find_one_and_update(
+        self,
+        filter: Document,
+        update: Document,
+        return_document: bool = ReturnDocument.BEFORE,
+        upsert: bool = False,
+    ) -> Optional[Document]:
+        before = self._first(filter)
+        snapshot = copy.deepcopy(before) if before is not None else None
+        result = self._update(filter, update, upsert, multi=False)
+        if return_document == ReturnDocument.AFTER:
+            target = result.get("upserted", before["_id"] if before is not None else _MISSING)
+            return copy.deepcopy(self.documents[target]) if target is not _MISSING else None
+        return snapshot
+
+    async def delete_one(self, filter: Document) -> DeleteResult:
+        return DeleteResult({"n": self._delete(filter, multi=False)}, True)
+
+    async def delete_many(self, filter: Document) -> DeleteResult:
+        return DeleteResult({"n": self._delete(filter, multi=True)}, True)
+
+    async def bulk_write(self, requests: Sequence[Any], ordered: bool = True) -> BulkWriteResult:
+        summary: Dict[str, Any] = {
+            "nInserted": 0,
+            "nUpserted": 0,
+            "nMatched": 0,
+            "nModified": 0,
+            "nRemoved": 0,
+            "upserted": [],
+            "writeErrors": [],
+            "writeConcernErrors": [],
+        }
+        for index, request in enumerate(requests):
+            try:
+                self._apply_request(request, index, summary)
+            except (DuplicateKeyError, ValueError) as e:
+                code = e.code if isinstance(e, DuplicateKeyError) else 2
+                summary["writeErrors"].append({"index": index, "code": code, "errmsg": str(e), "op": request})
+                if ordered:
+                    break
+        if summary["writeErrors"]:
+            raise BulkWriteError(summary)
+        return BulkWriteResult(summary, True)
+
+    async def aggregate(self, pipeline: List[Document]) -> List[Document]:
+        docs: Iterable[Document] = self.documents.values()
+        # 开头的 $match 先过滤再拷贝，避免复制整个集合
+        if pipeline and "$match" in pipeline[0]:
+            docs = [doc for doc in docs if matches(doc, pipeline[0]["$match"])]
+            pipeline = pipeline[1:]
+        return run_pipeline([copy.deepcopy(doc) for doc in docs], pipeline)
+
+    def watch(self, pipeline: Optional[List[Document]] = None, **kwargs: Any) -> Any:
+        # 与单机 mongod 返回相同的错误码，调用方可以按错误码回退为轮询
+        raise OperationFailure("The memory store does not support change streams", code=CHANGE_STREAM_NOT_SUPPORTED)
+
+    def with_options(self, **kwargs: Any) -> "MemoryRepository":
+        return self
+
+    async def command(self, command: Any) -> Document:
+        return _command(command)
+
+    async def create_indexes(self, indexes: Iterable[IndexModel]) -> List[str]:
+        names = []
+        for index in indexes:
+            document = index.document
+            self.indexes[document["name"]] = {"key": list(document["key"].items())}
+            names.append(document["name"])
+        return names
+
+    async def index_information(self) -> Dict[str, Document]:
+        return copy.deepcopy(self.indexes)
+
+    def _first(self, filter: Document) -> Optional[Document]:
+        return next((doc for doc in self.documents.values() if matches(doc, filter)), None)
+
+    def _insert(self, document: Document) -> Any:
+        document.setdefault("_id", ObjectId())
+        if document["_id"] in self.documents:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} _id: {document['_id']}")
+        self.documents[document["_id"]] = copy.deepcopy(document)
+        return document["_id"]
+
+    def _update(self, filter: Document, update: Document, upsert: bool, multi: bool) -> Dict[str, Any]:
+        targets = [doc for doc in self.documents.values() if matches(doc, filter)]
+        if not multi:
+            targets = targets[:1]
+        if not targets:
+            if not upsert:
+                return {"n": 0, "nModified": 0, "updatedExisting": False}
+            doc = _upsert_seed(filter)
+            apply_update(doc, update, filter, inserting=True)
+            upserted = self._insert(doc)
+            return {"n": 1, "nModified": 0, "upserted": upserted, "updatedExisting": False}
+        modified = 0
+        for doc in targets:
+            updated = copy.deepcopy(doc)
+            apply_update(updated, update, filter)
+            if updated != doc:
+                self.documents[doc["_id"]] = updated
+                modified += 1
+        return {"n": len(targets), "nModified": modified, "updatedExisting": True}
+
+    def _delete(self, filter: Document, multi: bool) -> int:
+        targets = [doc["_id"] for doc in self.documents.values() if matches(doc, filter)]
+        if not multi:
+            targets = targets[:1]
+        for doc_id in targets:
+            del self.documents[doc_id]
+        return len(targets)
+
+    def _apply_request(self, request: Any, index: int, summary: Dict[str, Any]) -> None:
+        if isinstance(request, InsertOne):
+            self._insert(request._doc)
+            summary["nInserted"] += 1
+            return
+        if isinstance(request, (DeleteOne, DeleteMany)):
+            summary["nRemoved"] += self._delete(request._filter, multi=isinstance(request, DeleteMany))
+            return
+        if isinstance(request, ReplaceOne):
+            raise NotImplementedError("ReplaceOne is not supported by the memory store")
+        if isinstance(request, (UpdateOne, UpdateMany)):
+            result = self._update(
+                request._filter, request._doc, bool(request._upsert), multi=isinstance(request, UpdateMany)
+            )
+            if "upserted" in result:
+                summary["nUpserted"] += 1
+                summary["upserted"].append({"index": index, "_id": result["upserted"]})
+            else:
+                summary["nMatched"] += result["n"]
+                summary["nModified"] += result["nModified"]
+            return
+        raise NotImplementedError(f"Unsupported bulk operation: {type(request).__name__}")
+
+
+class MemoryDatabase:
+    """按名称惰性创建集合"""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._collections: Dict[str, MemoryRepository] = {}
+
+    def get_collection(self, name: str, **kwargs: Any) -> MemoryRepository:
+        if name not in self._collections:
+            self._collections[name] = MemoryRepository(name)
+        return self._collections[name]
+
+    def __getitem__(self, name: str) -> MemoryRepository:
+        return self.get_collection(name)
+
+    async def command(self, command: Any) -> Document:
+        return _command(command)
+
+
+class MemoryClient:
+    """与驱动客户端对应的入口，数据随客户端对象存在"""
+
+    def __init__(self) -> None:
+        self._databases: Dict[str, MemoryDatabase] = {}
+
+    def __getitem__(self, name: str) -> MemoryDatabase:
+        if name not in self._databases:
+            self._databases[name] = MemoryDatabase(name)
+        return self._databases[name]
+
+    def close(self) -> None:
+        pass
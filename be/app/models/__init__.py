@@ -1,6 +1,20 @@
 from .thread import Thread, ThreadCreate, ThreadUpdate
 from .message import Message, MessageCreate
-from .phone import Phone, PhoneSku, PhoneSearchParams
+from .usage import MessageUsage, ThreadUsage, UsageReport, UsageReportRow
+from .phone import (
+    FacetBucket,
+    HistogramBucket,
+    Phone,
+    PhoneBatchSearchRequest,
+    PhoneBulkUpsertRequest,
+    PhoneBulkUpsertResult,
+    PhoneFacetResult,
+    PhonePage,
+    PhoneSearchParams,
+    PhoneSku,
+    PhoneSkuUpdate,
+    PhoneUpsert,
+)
 
 __all__ = [
     "Thread",
@@ -8,7 +22,20 @@ __all__ = [
     "ThreadUpdate",
     "Message",
     "MessageCreate",
+    "MessageUsage",
+    "ThreadUsage",
+    "UsageReport",
+    "UsageReportRow",
     "Phone",
     "PhoneSku",
     "PhoneSearchParams",
+    "PhoneFacetResult",
+    "PhoneBatchSearchRequest",
+    "PhoneBulkUpsertRequest",
+    "PhoneBulkUpsertResult",
+    "PhoneUpsert",
+    "PhoneSkuUpdate",
+    "PhonePage",
+    "FacetBucket",
+    "HistogramBucket",
 ]
@@ -1,8 +1,9 @@
 from pydantic import BaseModel, Field
 from datetime import datetime
-from typing import Literal
+from typing import Any, Dict, List, Literal, Optional
 
 from app.models.base import MongoModel
+from app.models.usage import MessageUsage
 
 
 class Message(MongoModel):
@@ -13,6 +14,13 @@ class Message(MongoModel):
     content: str
     created_at: datetime
     tool_call_id: str | None = None
+    tool_calls: Optional[List[Dict[str, Any]]] = None
+    # 产生该消息的生成任务及其在生成内的序号，用于断点续跑
+    generation_id: Optional[str] = None
+    step: Optional[int] = None
+    partial: bool = False
+    # assistant 消息的 token 用量与模型耗时
+    usage: Optional[MessageUsage] = None
 
     class Config:
         from_attributes = True
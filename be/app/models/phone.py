@@ -3,7 +3,8 @@ from __future__ import annotations
 from datetime import datetime
 from typing import Any, Dict, List, Optional
 
-from pydantic import BaseModel, Field
+from bson import ObjectId
+from pydantic import BaseModel, Field, field_validator, model_validator
 
 from app.models.base import MongoModel
 
@@ -93,3 +94,114 @@ class PhoneSearchParams(BaseModel):
         le=20,
         description="返回结果数量上限，默认 5，最大 20",
     )
+    best_value: bool = Field(
+        False,
+        description="只返回性价比最优（价格、电池、屏幕、内存不被其他机型全面超越）的手机，仅结合标签与价格区间",
+    )
+
+
+class FacetBucket(BaseModel):
+    """分面计数"""
+
+    value: str = Field(..., description="分面取值，例如品牌或标签")
+    count: int = Field(..., ge=0, description="匹配的手机数量")
+
+
+class HistogramBucket(BaseModel):
+    """直方图区间，区间为左闭右开；lower 为空表示缺失值"""
+
+    lower: Optional[float] = Field(None, description="区间下界")
+    upper: Optional[float] = Field(None, description="区间上界，为空表示无上界")
+    count: int = Field(..., ge=0, description="落在区间内的手机数量")
+
+
+class PhoneFacetResult(BaseModel):
+    """分面搜索结果"""
+
+    total: int = Field(..., ge=0, description="匹配的手机总数")
+    hits: List[Phone] = Field(default_factory=list, description="按更新时间排序的前若干条结果")
+    brands: List[FacetBucket] = Field(default_factory=list, description="按品牌计数")
+    tags: List[FacetBucket] = Field(default_factory=list, description="按标签计数")
+    price_histogram: List[HistogramBucket] = Field(default_factory=list, description="按最低 SKU 价格分段计数")
+    battery_histogram: List[HistogramBucket] = Field(default_factory=list, description="按电池容量分段计数")
+
+
+class PhoneBatchSearchRequest(BaseModel):
+    """批量搜索请求"""
+
+    queries: List[PhoneSearchParams] = Field(..., min_length=1, max_length=10, description="搜索参数列表")
+
+
+class PhonePage(BaseModel):
+    """手机列表分页结果，items 为按 fields 投影后的文档"""
+
+    items: List[Dict[str, Any]] = Field(default_factory=list, description="手机文档列表")
+    next_cursor: Optional[str] = Field(None, description="下一页游标，为空表示没有更多数据")
+
+
+class PhoneSkuUpdate(BaseModel):
+    """SKU 级别的部分更新：SKU 已存在时只写入提供的字段，不存在时按提供的字段新增"""
+
+    sku_id: str = Field(..., description="SKU 唯一标识")
+    name: Optional[str] = Field(None, max_length=100, description="SKU 名称或规格描述")
+    ram: Optional[str] = Field(None, max_length=50, description="运行内存配置")
+    storage: Optional[str] = Field(None, max_length=50, description="存储容量")
+    color: Optional[str] = Field(None, max_length=50, description="颜色")
+    price: Optional[float] = Field(None, ge=0, description="价格")
+    currency: Optional[str] = Field(None, min_length=3, max_length=3, description="价格币种")
+    availability: Optional[str] = Field(None, max_length=50, description="库存或销售状态描述")
+    extra: Optional[Dict[str, Any]] = Field(None, description="额外的规格信息，整体替换")
+
+
+class PhoneUpsert(BaseModel):
+    """
+    批量写入中的一款手机
+
+    按 phone_id 定位已有手机；未提供时按 brand + model 定位，不存在则新建。
+    手机级字段只写入提供的部分。
+    """
+
+    phone_id: Optional[str] = Field(None, description="已有手机的 ID")
+    brand: Optional[str] = Field(None, max_length=100, description="品牌名称")
+    model: Optional[str] = Field(None, max_length=100, description="型号名称")
+    description: Optional[str] = Field(None, description="型号简介或卖点")
+    os: Optional[str] = Field(None, max_length=100, description="操作系统或界面")
+    chipset: Optional[str] = Field(None, max_length=150, description="SoC/芯片型号")
+    display_size: Optional[float] = Field(None, ge=0, description="屏幕尺寸（英寸）")
+    display_freq: Optional[int] = Field(None, ge=0, description="屏幕刷新率（Hz）")
+    battery: Optional[int] = Field(None, ge=0, description="电池容量（mAh）")
+    camera: Optional[str] = Field(None, max_length=200, description="摄像头信息")
+    tags: Optional[List[str]] = Field(None, description="标签列表，整体替换")
+    features: Optional[List[str]] = Field(None, description="特色功能列表，整体替换")
+    specs: Optional[Dict[str, Any]] = Field(None, description="详细规格字典，整体替换")
+    skus: List[PhoneSkuUpdate] = Field(default_factory=list, description="SKU 更新或新增")
+
+    @field_validator("phone_id")
+    @classmethod
+    def _valid_object_id(cls, value: Optional[str]) -> Optional[str]:
+        if value is not None and not ObjectId.is_valid(value):
+            raise ValueError("phone_id is not a valid ObjectId")
+        return value
+
+    @model_validator(mode="after")
+    def _identified(self) -> "PhoneUpsert":
+        if self.phone_id is None and not (self.brand and self.model):
+            raise ValueError("Either phone_id or both brand and model are required")
+        return self
+
+
+class PhoneBulkUpsertRequest(BaseModel):
+    """批量写入请求"""
+
+    items: List[PhoneUpsert] = Field(..., min_length=1, max_length=500, description="手机写入列表")
+
+
+class PhoneBulkUpsertResult(BaseModel):
+    """批量写入结果"""
+
+    matched: int = Field(..., ge=0, description="匹配到的更新操作数")
+    modified: int = Field(..., ge=0, description="实际修改的更新操作数")
+    upserted: int = Field(..., ge=0, description="新建的手机数量")
+    phone_ids: List[str] = Field(default_factory=list, description="受影响的手机 ID")
+    not_found: List[str] = Field(default_factory=list, description="不存在的 phone_id")
+    invalidated: int = Field(0, ge=0, description="失效的搜索缓存条目数")
@@ -2,6 +2,7 @@ from pydantic import BaseModel, Field
 from datetime import datetime
 from typing import List, Optional
 from .message import Message
+from .usage import ThreadUsage
 
 
 class Thread(BaseModel):
@@ -12,6 +13,7 @@ class Thread(BaseModel):
     created_at: datetime
     updated_at: datetime
     messages: List[Message] = []
+    usage: ThreadUsage = ThreadUsage()
 
     class Config:
         from_attributes = True
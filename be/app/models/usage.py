@@ -0,0 +1,45 @@
+from datetime import date
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+
+class MessageUsage(BaseModel):
+    """产生一条 assistant 消息的模型调用用量"""
+
+    model: Optional[str] = None
+    input_tokens: int = 0
+    output_tokens: int = 0
+    model_calls: int = 0
+    latency_ms: float = 0.0
+
+
+class ThreadUsage(BaseModel):
+    """线程累计用量"""
+
+    input_tokens: int = 0
+    output_tokens: int = 0
+    model_calls: int = 0
+
+
+class UsageReportRow(BaseModel):
+    """某天某个模型的用量与费用"""
+
+    day: date
+    model: str
+    input_tokens: int
+    output_tokens: int
+    model_calls: int
+    latency_ms: float
+    cost: Optional[float] = None  # 未配置价格的模型为空
+
+
+class UsageReport(BaseModel):
+    """按天、按模型汇总的用量与费用"""
+
+    since: date
+    until: date
+    rows: List[UsageReportRow]
+    by_model: List[UsageReportRow]  # 整个区间按模型汇总，day 为区间起始日
+    total_cost: float
+    unpriced_models: List[str]
@@ -0,0 +1,350 @@
+"""MongoDB 命令监控 - 按查询形状统计次数与耗时，记录慢查询及其 explain 摘要"""
+
+import asyncio
+import json
+import logging
+import math
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import monitoring
+
+from app.config import settings
+from app.metrics import registry
+
+logger = logging.getLogger("app.query_monitor")
+
+COMMAND_DURATION = registry.histogram(
+    "mongodb_command_duration_seconds",
+    "MongoDB command latency by command and collection",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+COMMAND_FAILURES = registry.counter("mongodb_command_failures_total", "MongoDB commands that returned an error")
+SLOW_COMMANDS = registry.counter("mongodb_slow_commands_total", "MongoDB commands slower than the slow query threshold")
+
+# 只统计读写命令；握手、心跳、会话和 explain 本身不计入
+MONITORED_COMMANDS = {
+    "find",
+    "getMore",
+    "aggregate",
+    "count",
+    "distinct",
+    "insert",
+    "update",
+    "delete",
+    "findAndModify",
+}
+# explain 支持的命令，其余（insert、getMore）慢时只记录形状
+EXPLAINABLE_COMMANDS = {"find", "aggregate", "count", "distinct", "update", "delete", "findAndModify"}
+# 重放 explain 时去掉的会话、事务和驱动附加字段
+_SESSION_FIELDS = {"lsid", "txnNumber", "autocommit", "startTransaction", "readConcern", "writeConcern"}
+
+# 单个形状的耗时分桶（毫秒），用于估算分位数
+SHAPE_BUCKETS_MS: Tuple[float, ...] = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, math.inf)
+OTHER_SHAPE = "(other)"
+
+
+def plan_stages(plan: Dict[str, Any]) -> Tuple[List[str], List[str]]:
+    """展开 winningPlan，返回 (阶段列表, 使用的索引名)；兼容 SBE 的 queryPlan 和分片的 shards"""
+    stages: List[str] = []
+    indexes: List[str] = []
+
+    def walk(node: Dict[str, Any]) -> None:
+        node = node.get("queryPlan", node)
+        for shard in node.get("shards", []):
+            walk(shard.get("winningPlan", {}))
+        if "stage" in node:
+            stages.append(node["stage"])
+        if "indexName" in node:
+            indexes.append(node["indexName"])
+        if "inputStage" in node:
+            walk(node["inputStage"])
+        for child in node.get("inputStages", []):
+            walk(child)
+
+    walk(plan)
+    return stages, indexes
+
+
+def summarize_explain(explain: Dict[str, Any]) -> Dict[str, Any]:
+    """从 explain 结果提取阶段、索引和扫描量；聚合管道的计划在第一个 $cursor 阶段里"""
+    planner = explain.get("queryPlanner")
+    if planner is None:
+        for stage in explain.get("stages", []):
+            if "$cursor" in stage:
+                planner = stage["$cursor"].get("queryPlanner")
+                break
+    stages, indexes = plan_stages((planner or {}).get("winningPlan", {}))
+    stats = explain.get("executionStats", {})
+    return {
+        "stages": stages,
+        "indexes": indexes,
+        "collection_scan": "COLLSCAN" in stages,
+        "docs_examined": stats.get("totalDocsExamined"),
+        "keys_examined": stats.get("totalKeysExamined"),
+        "returned": stats.get("nReturned"),
+    }
+
+
+def query_shape(value: Any) -> Any:
+    """把查询中的字面量替换为 "?"，保留字段名和操作符；标量数组（如 $in）整体视为一个值"""
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)) and value and all(isinstance(item, dict) for item in value):
+        return [query_shape(item) for item in value]
+    return "?"
+
+
+def _pipeline_shape(pipeline: List[Dict[str, Any]]) -> List[Any]:
+    # $sort 和 $project 的取值决定了执行计划，原样保留
+    return [
+        {name: spec if name in ("$sort", "$project") else query_shape(spec) for name, spec in stage.items()}
+        for stage in pipeline
+    ]
+
+
+def command_shape(name: str, command: Dict[str, Any]) -> Dict[str, Any]:
+    """提取决定执行计划的部分：过滤条件、排序、管道、更新操作符"""
+    if name == "find":
+        return {"filter": query_shape(command.get("filter", {})), "sort": command.get("sort")}
+    if name == "aggregate":
+        return {"pipeline": _pipeline_shape(command.get("pipeline", []))}
+    if name in ("count", "distinct"):
+        return {"query": query_shape(command.get("query", {})), "key": command.get("key")}
+    if name == "findAndModify":
+        update = command.get("update")
+        return {
+            "query": query_shape(command.get("query", {})),
+            "sort": command.get("sort"),
+            "update": sorted(update) if isinstance(update, dict) else None,
+        }
+    if name == "update":
+        statement = (command.get("updates") or [{}])[0]
+        update = statement.get("u")
+        return {
+            "q": query_shape(statement.get("q", {})),
+            "u": sorted(update) if isinstance(update, dict) else "pipeline",
+            "upsert": bool(statement.get("upsert")),
+        }
+    if name == "delete":
+        return {"q": query_shape((command.get("deletes") or [{}])[0].get("q", {}))}
+    return {}
+
+
+@dataclass
+class ShapeStats:
+    """单个查询形状的累计统计"""
+
+    command: str
+    collection: str
+    shape: str
+    count: int = 0
+    errors: int = 0
+    slow: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+    buckets: List[int] = field(default_factory=lambda: [0] * len(SHAPE_BUCKETS_MS))
+    last_plan: Optional[Dict[str, Any]] = None
+
+    def observe(self, duration_ms: float) -> None:
+        self.count += 1
+        self.total_ms += duration_ms
+        self.max_ms = max(self.max_ms, duration_ms)
+        for index, bound in enumerate(SHAPE_BUCKETS_MS):
+            if duration_ms <= bound:
+                self.buckets[index] += 1
+                break
+
+    def percentile(self, quantile: float) -> float:
+        """分桶上界近似的分位数；落在最后一个桶时返回最大值"""
+        target = quantile * self.count
+        seen = 0
+        for bound, count in zip(SHAPE_BUCKETS_MS, self.buckets):
+            seen += count
+            if seen >= target and seen > 0:
+                return float(min(bound, self.max_ms))
+        return self.max_ms
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "command": self.command,
+            "collection": self.collection,
+            "shape": self.shape,
+            "count": self.count,
+            "errors": self.errors,
+            "slow": self.slow,
+            "total_ms": round(self.total_ms, 3),
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": round(self.max_ms, 3),
+            "last_plan": self.last_plan,
+        }
+
+
+@dataclass
+class _PendingCommand:
+    name: str
+    collection: str
+    database: str
+    shape: str
+    command: Optional[Dict[str, Any]]
+
+
+class QueryMonitor(monitoring.CommandListener):
+    """注册到 Mongo 客户端的命令监听器
+
+    回调在驱动的 I/O 线程中执行，只做分类和计数；慢查询的 explain 调度回事件循环异步执行，
+    同一形状在 explain 间隔内只 explain 一次。
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pending: Dict[Tuple[int, Any], _PendingCommand] = {}
+        self._shapes: Dict[str, ShapeStats] = {}
+        self._explained_at: Dict[str, float] = {}
+        self._client: Any = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def attach(self, client: Any) -> None:
+        """绑定用于 explain 的客户端和当前事件循环"""
+        self._client = client
+        self._loop = asyncio.get_running_loop()
+
+    def detach(self) -> None:
+        self._client = None
+        self._loop = None
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        name = event.command_name
+        if name not in MONITORED_COMMANDS:
+            return
+        command = event.command
+        if name == "getMore":
+            collection = command.get("collection", "")
+            shape: Dict[str, Any] = {}
+        else:
+            collection = command.get(name, "")
+            shape = command_shape(name, command)
+        # 驱动在回调返回后可能复用命令文档，需要 explain 时保留一份浅拷贝
+        kept = dict(command) if name in EXPLAINABLE_COMMANDS else None
+        pending = _PendingCommand(
+            name=name,
+            collection=str(collection),
+            database=event.database_name,
+            shape=json.dumps(shape, ensure_ascii=False, default=str),
+            command=kept,
+        )
+        with self._lock:
+            self._pending[(event.request_id, event.connection_id)] = pending
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._finish(event, failed=False)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._finish(event, failed=True)
+
+    def top(self, limit: int = 20, sort: str = "total_ms") -> List[Dict[str, Any]]:
+        """按累计耗时（或 count / p95_ms / max_ms 等）排序的前 N 个形状"""
+        with self._lock:
+            rows = [stats.to_dict() for stats in self._shapes.values()]
+        rows.sort(key=lambda row: row.get(sort) or 0, reverse=True)
+        return rows[:limit]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._shapes.clear()
+            self._explained_at.clear()
+
+    def _finish(self, event: Any, failed: bool) -> None:
+        with self._lock:
+            pending = self._pending.pop((event.request_id, event.connection_id), None)
+        if pending is None:
+            return
+        duration_ms = event.duration_micros / 1000
+        COMMAND_DURATION.observe(duration_ms / 1000, command=pending.name, collection=pending.collection)
+        if failed:
+            COMMAND_FAILURES.inc(command=pending.name, collection=pending.collection)
+        slow = duration_ms >= settings.mongodb_slow_query_ms
+        with self._lock:
+            stats = self._stats(pending)
+            stats.observe(duration_ms)
+            stats.errors += failed
+            stats.slow += slow
+            explain = slow and self._should_explain(pending, stats.shape)
+        if not slow:
+            return
+        SLOW_COMMANDS.inc(command=pending.name, collection=pending.collection)
+        if explain and self._loop is not None and not self._loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self._explain_and_log(pending, duration_ms), self._loop)
+        else:
+            self._log_slow(pending, duration_ms, None)
+
+    def _stats(self, pending: _PendingCommand) -> ShapeStats:
+        key = f"{pending.name} {pending.collection} {pending.shape}"
+        stats = self._shapes.get(key)
+        if stats is None:
+            # 形状数量有上限，动态拼接字段名的查询不会让统计无限增长
+            if len(self._shapes) >= settings.mongodb_query_shapes_max:
+                key = f"{pending.name} {pending.collection} {OTHER_SHAPE}"
+                stats = self._shapes.get(key)
+            if stats is None:
+                shape = pending.shape if not key.endswith(OTHER_SHAPE) else OTHER_SHAPE
+                stats = self._shapes[key] = ShapeStats(pending.name, pending.collection, shape)
+        return stats
+
+    def _should_explain(self, pending: _PendingCommand, shape: str) -> bool:
+        if not settings.mongodb_slow_query_explain or pending.command is None or shape == OTHER_SHAPE:
+            return False
+        key = f"{pending.name} {pending.collection} {shape}"
+        now = time.monotonic()
+        if now - self._explained_at.get(key, -math.inf) < settings.mongodb_slow_query_explain_interval:
+            return False
+        self._explained_at[key] = now
+        return True
+
+    async def _explain_and_log(self, pending: _PendingCommand, duration_ms: float) -> None:
+        plan: Optional[Dict[str, Any]] = None
+        if self._client is not None:
+            command = {
+                key: value
+                for key, value in (pending.command or {}).items()
+                if not key.startswith("$") and key not in _SESSION_FIELDS
+            }
+            try:
+                explain = await self._client[pending.database].command(
+                    {"explain": command, "verbosity": "queryPlanner"}
+                )
+                plan = summarize_explain(explain)
+            except Exception as e:
+                logger.debug("Failed to explain slow %s on %s: %s", pending.name, pending.collection, e)
+        if plan is not None:
+            key = f"{pending.name} {pending.collection} {pending.shape}"
+            with self._lock:
+                stats = self._shapes.get(key)
+                if stats is not None:
+                    stats.last_plan = plan
+        self._log_slow(pending, duration_ms, plan)
+
+    @staticmethod
+    def _log_slow(pending: _PendingCommand, duration_ms: float, plan: Optional[Dict[str, Any]]) -> None:
+        if plan is None:
+            logger.warning(
+                "Slow %s on %s took %.1f ms, shape=%s", pending.name, pending.collection, duration_ms, pending.shape
+            )
+            return
+        logger.warning(
+            "Slow %s on %s took %.1f ms, shape=%s, plan=%s, indexes=%s",
+            pending.name,
+            pending.collection,
+            duration_ms,
+            pending.shape,
+            ">".join(plan["stages"]) or "?",
+            ",".join(plan["indexes"]) or "-",
+        )
+
+
+query_monitor = QueryMonitor()
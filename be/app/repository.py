@@ -0,0 +1,166 @@
+"""集合级别的仓储接口 - 屏蔽 Motor、PyMongo 原生异步客户端与内存实现之间的差异
+
+服务只依赖 Repository 上的这些操作。Motor 与 PyMongo 的游标、写入结果完全一致，
+差别只在于 PyMongo 原生异步客户端的 aggregate / watch 需要 await 才得到游标；
+aggregate 统一为返回文档列表，watch 统一为异步上下文管理器。
+"""
+
+import inspect
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Protocol, Sequence
+
+from pymongo import ReturnDocument
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+Document = Dict[str, Any]
+
+
+class Cursor(Protocol):
+    """find 返回的游标；链式方法返回游标本身"""
+
+    def sort(self, key_or_list: Any, direction: Optional[int] = None) -> "Cursor": ...
+
+    def skip(self, skip: int) -> "Cursor": ...
+
+    def limit(self, limit: int) -> "Cursor": ...
+
+    async def to_list(self, length: Optional[int] = None) -> List[Document]: ...
+
+    async def explain(self) -> Document: ...
+
+    def __aiter__(self) -> AsyncIterator[Document]: ...
+
+
+class Repository(ABC):
+    """一个集合上的异步操作"""
+
+    name: str
+
+    @abstractmethod
+    def find(self, filter: Optional[Document] = None, projection: Optional[Any] = None) -> Cursor: ...
+
+    @abstractmethod
+    async def find_one(
+        self, filter: Optional[Document] = None, projection: Optional[Any] = None, sort: Optional[Any] = None
+    ) -> Optional[Document]: ...
+
+    @abstractmethod
+    async def count_documents(self, filter: Document) -> int: ...
+
+    @abstractmethod
+    async def insert_one(self, document: Document) -> InsertOneResult: ...
+
+    @abstractmethod
+    async def insert_many(self, documents: Sequence[Document]) -> InsertManyResult: ...
+
+    @abstractmethod
+    async def update_one(self, filter: Document, update: Document, upsert: bool = False) -> UpdateResult: ...
+
+    @abstractmethod
+    async def find_one_and_update(
+        self,
+        filter: Document,
+        update: Document,
+        return_document: bool = ReturnDocument.BEFORE,
+        upsert: bool = False,
+    ) -> Optional[Document]: ...
+
+    @abstractmethod
+    async def delete_one(self, filter: Document) -> DeleteResult: ...
+
+    @abstractmethod
+    async def delete_many(self, filter: Document) -> DeleteResult: ...
+
+    @abstractmethod
+    async def bulk_write(self, requests: Sequence[Any], ordered: bool = True) -> BulkWriteResult: ...
+
+    @abstractmethod
+    async def aggregate(self, pipeline: List[Document]) -> List[Document]:
+        """执行聚合管道并返回全部结果"""
+
+    @abstractmethod
+    def watch(self, pipeline: Optional[List[Document]] = None, **kwargs: Any) -> Any:
+        """change stream，作为异步上下文管理器使用：`async with repository.watch() as stream`"""
+
+    @abstractmethod
+    def with_options(self, **kwargs: Any) -> "Repository": ...
+
+    @abstractmethod
+    async def command(self, command: Any) -> Document:
+        """在集合所属的数据库上执行命令"""
+
+
+class MotorRepository(Repository):
+    """Motor 集合；操作在驱动的线程池中执行"""
+
+    def __init__(self, collection: Any) -> None:
+        self.collection = collection
+        self.name = collection.name
+
+    def find(self, filter: Optional[Document] = None, projection: Optional[Any] = None) -> Cursor:
+        return self.collection.find(filter, projection)
+
+    async def find_one(
+        self, filter: Optional[Document] = None, projection: Optional[Any] = None, sort: Optional[Any] = None
+    ) -> Optional[Document]:
+        return await self.collection.find_one(filter, projection, sort=sort)
+
+    async def count_documents(self, filter: Document) -> int:
+        return await self.collection.count_documents(filter)
+
+    async def insert_one(self, document: Document) -> InsertOneResult:
+        return await self.collection.insert_one(document)
+
+    async def insert_many(self, documents: Sequence[Document]) -> InsertManyResult:
+        return await self.collection.insert_many(documents)
+
+    async def update_one(self, filter: Document, update: Document, upsert: bool = False) -> UpdateResult:
+        return await self.collection.update_one(filter, update, upsert=upsert)
+
+    async def find_one_and_update(
+        self,
+        filter: Document,
+        update: Document,
+        return_document: bool = ReturnDocument.BEFORE,
+        upsert: bool = False,
+    ) -> Optional[Document]:
+        return await self.collection.find_one_and_update(
+            filter, update, return_document=return_document, upsert=upsert
+        )
+
+    async def delete_one(self, filter: Document) -> DeleteResult:
+        return await self.collection.delete_one(filter)
+
+    async def delete_many(self, filter: Document) -> DeleteResult:
+        return await self.collection.delete_many(filter)
+
+    async def bulk_write(self, requests: Sequence[Any], ordered: bool = True) -> BulkWriteResult:
+        return await self.collection.bulk_write(requests, ordered=ordered)
+
+    async def aggregate(self, pipeline: List[Document]) -> List[Document]:
+        cursor = self.collection.aggregate(pipeline)
+        if inspect.isawaitable(cursor):
+            cursor = await cursor
+        return await cursor.to_list(length=None)
+
+    @asynccontextmanager
+    async def watch(self, pipeline: Optional[List[Document]] = None, **kwargs: Any) -> AsyncIterator[Any]:
+        stream = self.collection.watch(pipeline, **kwargs)
+        if inspect.isawaitable(stream):
+            stream = await stream
+        async with stream:
+            yield stream
+
+    def with_options(self, **kwargs: Any) -> Repository:
+        return type(self)(self.collection.with_options(**kwargs))
+
+    async def command(self, command: Any) -> Document:
+        return await self.collection.database.command(command)
+
+
+class PyMongoRepository(MotorRepository):
+    """PyMongo 原生异步集合（AsyncMongoClient）；直接在事件循环上执行，没有线程切换
+
+    接口与 Motor 相同，aggregate / watch 的可等待游标由基类统一处理。
+    """
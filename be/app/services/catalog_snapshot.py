@@ -0,0 +1,300 @@
+"""手机目录的二进制快照 - 导出为带版本的列式文件，多个 worker 以只读 mmap 共享
+
+文件布局（小端，各段按 8 字节对齐）:
+    magic(8) | 元数据长度(uint32) | 元数据 JSON | 各段数据
+
+元数据记录版本号、手机与 SKU 数量，以及每个段的 (offset, count, typecode)。
+数值列直接以 memoryview.cast 访问，不复制；字符串统一存放在字符串表中，列里只存下标。
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+from array import array
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+from app.config import settings
+from app.metrics import registry
+from app.services.skyline_service import parse_ram
+
+logger = logging.getLogger("app.catalog_snapshot")
+
+MAGIC = b"PHCATSN1"
+HEADER = struct.Struct("<8sI")
+ALIGNMENT = 8
+CURRENT_FILE = "CURRENT"
+
+SNAPSHOT_PROJECTION = {
+    "brand": 1,
+    "model": 1,
+    "tags": 1,
+    "battery": 1,
+    "display_size": 1,
+    "skus": 1,
+    "updated_at": 1,
+}
+
+SNAPSHOT_LOADS = registry.counter("catalog_snapshot_loads_total", "Snapshot mappings by outcome")
+SNAPSHOT_PHONES = registry.gauge("catalog_snapshot_phones", "Phones in the currently mapped catalog snapshot")
+
+def _to_millis(value: Any) -> int:
+    if not isinstance(value, datetime):
+        return 0
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp() * 1000)
+
+
+class _StringTable:
+    def __init__(self) -> None:
+        self._ids: Dict[str, int] = {}
+        self.values: List[str] = []
+
+    def add(self, value: str) -> int:
+        index = self._ids.get(value)
+        if index is None:
+            index = self._ids[value] = len(self.values)
+            self.values.append(value)
+        return index
+
+
+def build_snapshot(docs: Iterable[Dict[str, Any]], version: str) -> bytes:
+    """把 phones 文档编码为快照文件内容"""
+    strings = _StringTable()
+    columns: Dict[str, array] = {
+        "phone_id": array("I"),
+        "phone_brand": array("I"),
+        "phone_model": array("I"),
+        "phone_battery": array("d"),
+        "phone_display_size": array("d"),
+        "phone_updated_at": array("q"),
+        "phone_sku_offsets": array("I", [0]),
+        "phone_tag_offsets": array("I", [0]),
+        "phone_tags": array("I"),
+        "sku_id": array("I"),
+        "sku_price": array("d"),
+        "sku_ram": array("d"),
+    }
+
+    phone_count = 0
+    for doc in docs:
+        phone_count += 1
+        columns["phone_id"].append(strings.add(str(doc["_id"])))
+        columns["phone_brand"].append(strings.add(doc.get("brand") or ""))
+        columns["phone_model"].append(strings.add(doc.get("model") or ""))
+        columns["phone_battery"].append(float(doc.get("battery") or 0))
+        columns["phone_display_size"].append(float(doc.get("display_size") or 0))
+        columns["phone_updated_at"].append(_to_millis(doc.get("updated_at")))
+
+        for sku in doc.get("skus") or []:
+            price = sku.get("price")
+            columns["sku_id"].append(strings.add(str(sku.get("sku_id") or "")))
+            columns["sku_price"].append(math.nan if price is None else float(price))
+            columns["sku_ram"].append(parse_ram(sku.get("ram")))
+        columns["phone_sku_offsets"].append(len(columns["sku_id"]))
+
+        for tag in doc.get("tags") or []:
+            if tag:
+                columns["phone_tags"].append(strings.add(tag))
+        columns["phone_tag_offsets"].append(len(columns["phone_tags"]))
+
+    encoded = [value.encode("utf-8") for value in strings.values]
+    string_offsets = array("Q", [0])
+    for value in encoded:
+        string_offsets.append(string_offsets[-1] + len(value))
+    columns["string_offsets"] = string_offsets
+    columns["string_data"] = array("B", b"".join(encoded))
+
+    if sys.byteorder != "little":
+        for column in columns.values():
+            column.byteswap()
+
+    # 先按占位偏移量估算元数据长度，再计算实际偏移量；预留空间足够容纳更长的数字
+    sections: Dict[str, List[Any]] = {}
+    meta = {
+        "version": version,
+        "exported_at": int(time.time() * 1000),
+        "phones": phone_count,
+        "skus": len(columns["sku_id"]),
+        "sections": sections,
+    }
+    for name, column in columns.items():
+        sections[name] = [0, len(column), column.typecode]
+    reserved = len(json.dumps(meta, ensure_ascii=False).encode()) + 24 * len(columns)
+    offset = _align(HEADER.size + reserved)
+    for name, column in columns.items():
+        sections[name][0] = offset
+        offset = _align(offset + len(column) * column.itemsize)
+    meta_bytes = json.dumps(meta, ensure_ascii=False).encode().ljust(reserved)
+
+    buffer = bytearray(offset)
+    HEADER.pack_into(buffer, 0, MAGIC, len(meta_bytes))
+    buffer[HEADER.size : HEADER.size + len(meta_bytes)] = meta_bytes
+    for name, column in columns.items():
+        start = sections[name][0]
+        data = column.tobytes()
+        buffer[start : start + len(data)] = data
+    return bytes(buffer)
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class CatalogSnapshot:
+    """
+    只读映射的目录快照
+
+    数值列是指向映射内存的 memoryview，同一文件在多个进程中共享页缓存；
+    快照对象被丢弃后映射随之释放，已替换的旧版本不会影响正在使用它的读者。
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        magic, meta_length = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError(f"Not a catalog snapshot: {path}")
+        meta = json.loads(bytes(view[HEADER.size : HEADER.size + meta_length]))
+        if sys.byteorder != "little":
+            raise ValueError("Catalog snapshots can only be mapped on little-endian hosts")
+
+        self.version: str = meta["version"]
+        self.exported_at: int = meta["exported_at"]
+        self.phone_count: int = meta["phones"]
+        self.sku_count: int = meta["skus"]
+        self._columns: Dict[str, memoryview] = {}
+        for name, (offset, count, typecode) in meta["sections"].items():
+            itemsize = array(typecode).itemsize
+            self._columns[name] = view[offset : offset + count * itemsize].cast(typecode)
+
+        self.battery = self._columns["phone_battery"]
+        self.display_size = self._columns["phone_display_size"]
+        self.updated_at = self._columns["phone_updated_at"]
+        self.sku_price = self._columns["sku_price"]
+        self.sku_ram = self._columns["sku_ram"]
+
+    def string(self, index: int) -> str:
+        offsets = self._columns["string_offsets"]
+        return bytes(self._columns["string_data"][offsets[index] : offsets[index + 1]]).decode("utf-8")
+
+    def phone_id(self, phone_index: int) -> str:
+        return self.string(self._columns["phone_id"][phone_index])
+
+    def brand(self, phone_index: int) -> str:
+        return self.string(self._columns["phone_brand"][phone_index])
+
+    def model(self, phone_index: int) -> str:
+        return self.string(self._columns["phone_model"][phone_index])
+
+    def tags(self, phone_index: int) -> List[str]:
+        return [self.string(tag_id) for tag_id in self.tag_ids(phone_index)]
+
+    def tag_ids(self, phone_index: int) -> memoryview:
+        """手机标签在字符串表中的下标，不解码"""
+        offsets = self._columns["phone_tag_offsets"]
+        return self._columns["phone_tags"][offsets[phone_index] : offsets[phone_index + 1]]
+
+    def tag_table(self) -> Dict[str, int]:
+        """快照中出现过的标签到字符串表下标的映射"""
+        return {self.string(tag_id): tag_id for tag_id in set(self._columns["phone_tags"])}
+
+    def skus(self, phone_index: int) -> range:
+        """手机的 SKU 在 sku_* 列中的下标范围"""
+        offsets = self._columns["phone_sku_offsets"]
+        return range(offsets[phone_index], offsets[phone_index + 1])
+
+    def sku_id(self, sku_index: int) -> str:
+        return self.string(self._columns["sku_id"][sku_index])
+
+
+class CatalogSnapshotStore:
+    """
+    快照目录
+
+    导出方把新版本写入临时文件并 fsync 后改名，再原子替换 CURRENT 指针；
+    读者按 catalog_snapshot_check_seconds 检查指针，变化时映射新文件并整体替换引用。
+    """
+
+    def __init__(self, directory: Optional[str] = None, keep: int = 2) -> None:
+        self.directory = directory or settings.catalog_snapshot_dir
+        self.keep = keep
+        self._snapshot: Optional[CatalogSnapshot] = None
+        self._current_name: Optional[str] = None
+        self._checked_at: Optional[float] = None
+
+    def current(self) -> Optional[CatalogSnapshot]:
+        """当前版本的快照，没有可用快照时返回 None"""
+        if not settings.catalog_snapshot_enabled:
+            return None
+        checked_at = time.monotonic()
+        if self._checked_at is not None and checked_at - self._checked_at < settings.catalog_snapshot_check_seconds:
+            return self._snapshot
+        self._checked_at = checked_at
+
+        try:
+            with open(os.path.join(self.directory, CURRENT_FILE), encoding="utf-8") as pointer:
+                name = pointer.read().strip()
+        except FileNotFoundError:
+            return self._snapshot
+        if not name or name == self._current_name:
+            return self._snapshot
+
+        try:
+            snapshot = CatalogSnapshot(os.path.join(self.directory, name))
+        except (OSError, ValueError) as e:
+            SNAPSHOT_LOADS.inc(outcome="error")
+            logger.warning("Failed to map catalog snapshot %s: %s", name, e)
+            return self._snapshot
+        self._snapshot, self._current_name = snapshot, name
+        SNAPSHOT_LOADS.inc(outcome="loaded")
+        SNAPSHOT_PHONES.set(snapshot.phone_count)
+        logger.info("Mapped catalog snapshot %s (%d phones, %d skus)", snapshot.version, snapshot.phone_count, snapshot.sku_count)
+        return snapshot
+
+    def publish(self, docs: Iterable[Dict[str, Any]], version: str) -> str:
+        """写入新版本并切换 CURRENT 指针，返回快照文件路径"""
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"catalog-{re.sub(r'[^0-9A-Za-z_.-]', '_', version)}.bin"
+        path = os.path.join(self.directory, name)
+        _write_atomically(path, build_snapshot(docs, version))
+        _write_atomically(os.path.join(self.directory, CURRENT_FILE), name.encode() + b"\n")
+        self._prune(keep_name=name)
+        return path
+
+    def _prune(self, keep_name: str) -> None:
+        """只保留最近几个版本；已映射旧文件的读者不受删除影响"""
+        names = [
+            name
+            for name in os.listdir(self.directory)
+            if name.startswith("catalog-") and name.endswith(".bin") and name != keep_name
+        ]
+        names.sort(key=lambda name: os.path.getmtime(os.path.join(self.directory, name)), reverse=True)
+        for name in names[self.keep - 1 :]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+def _write_atomically(path: str, data: bytes) -> None:
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+
+catalog_snapshots = CatalogSnapshotStore()
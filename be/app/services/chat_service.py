@@ -1,19 +1,31 @@
+import asyncio
 import logging
-from typing import AsyncIterator, List, Optional
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional
 
 from bson import ObjectId
 from fastapi import HTTPException
-from langchain.messages import AIMessage, ToolMessage
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, ToolMessage
 from pymongo import ReturnDocument
 
 from app.database import get_threads_collection
 from app.models.message import Message, MessageCreate
+from app.models.usage import MessageUsage
 from app.models.thread import Thread, ThreadCreate, ThreadUpdate
-from app.services.llm_service import llm_service
-from app.utils.datetime import now
-from rich import print
+from app.metrics import registry
+from app.services.llm_service import AgentRun, llm_service
+from app.services.prefetch_service import prefetch_service
+from app.services.scheduler import Ticket
+from app.services.usage_service import usage_service
+from app.services.write_behind import message_writes
+from app.utils.datetime import as_utc, now
 logger = logging.getLogger("app.chat_service")
 
+GENERATIONS_CANCELLED = registry.counter("generations_cancelled_total", "Generations cancelled before completion")
+TOKENS_SAVED = registry.counter(
+    "generation_output_tokens_saved_total", "Estimated output tokens not generated due to cancellation"
+)
+
 
 class ChatService:
     """对话服务"""
@@ -44,26 +56,25 @@ class ChatService:
         )
 
     @staticmethod
-    async def get_thread(thread_id: str) -> Optional[Thread]:
-        """获取对话线程"""
+    async def _find_thread_doc(thread_id: str, projection: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """读取线程文档，并合并 write-behind 队列中尚未落库的写入"""
         threads_collection = get_threads_collection()
 
-        thread_doc = await threads_collection.find_one({"_id": ObjectId(thread_id)})
+        thread_doc = await threads_collection.find_one({"_id": ObjectId(thread_id)}, projection)
+        if not thread_doc:
+            return None
+        return message_writes.apply_overlay(thread_id, thread_doc)
+
+    @staticmethod
+    async def get_thread(thread_id: str) -> Optional[Thread]:
+        """获取对话线程"""
+        thread_doc = await ChatService._find_thread_doc(thread_id)
         if not thread_doc:
             logger.warning("Thread %s not found", thread_id)
             return None
 
-        print(thread_doc)
-        messages = [
-            Message(
-                id=msg["_id"],
-                thread_id=thread_id,
-                role=msg["role"],
-                content=msg["content"],
-                created_at=msg["created_at"],
-            )
-            for msg in thread_doc.get("messages", [])
-        ]
+        logger.debug("Loaded thread %s with %d messages", thread_id, len(thread_doc.get("messages", [])))
+        messages = [ChatService._message_from_doc(thread_id, msg) for msg in thread_doc.get("messages", [])]
 
         return Thread(
             id=str(thread_doc["_id"]),
@@ -71,6 +82,72 @@ class ChatService:
             created_at=thread_doc["created_at"],
             updated_at=thread_doc["updated_at"],
             messages=messages,
+            usage=thread_doc.get("usage") or {},
+        )
+
+    @staticmethod
+    async def get_thread_version(thread_id: str) -> Optional[datetime]:
+        """只读取 updated_at，用于条件请求的版本校验"""
+        thread_doc = await ChatService._find_thread_doc(thread_id, {"updated_at": 1})
+        return thread_doc["updated_at"] if thread_doc else None
+
+    @staticmethod
+    async def get_messages(thread_id: str, since: Optional[datetime] = None) -> Optional[List[Message]]:
+        """
+        获取对话消息列表
+
+        Args:
+            thread_id: 对话线程 ID
+            since: 只返回在此时间之后创建的消息，过滤在数据库端完成；没有时区时按 UTC 解释
+
+        Returns:
+            按问答顺序排列的消息；线程不存在时返回 None
+        """
+        threads_collection = get_threads_collection()
+        # 未落库的消息带时区，统一后才能与 since 比较
+        since = as_utc(since) if since is not None else None
+
+        messages_expr: Any = "$messages"
+        if since is not None:
+            messages_expr = {
+                "$filter": {
+                    "input": {"$ifNull": ["$messages", []]},
+                    "cond": {"$gt": ["$$this.created_at", since]},
+                }
+            }
+        pipeline = [
+            {"$match": {"_id": ObjectId(thread_id)}},
+            {"$project": {"messages": messages_expr}},
+        ]
+        docs = await threads_collection.aggregate(pipeline)
+        if not docs:
+            logger.warning("Thread %s not found", thread_id)
+            return None
+        messages = docs[0].get("messages") or []
+        seen = {msg["_id"] for msg in messages}
+        for write in message_writes.writes(thread_id):
+            messages.extend(
+                msg
+                for msg in write.messages
+                if msg["_id"] not in seen and (since is None or msg["created_at"] > since)
+            )
+        messages = ChatService._conversation_order(messages)
+        return [ChatService._message_from_doc(thread_id, msg) for msg in messages]
+
+    @staticmethod
+    def _message_from_doc(thread_id: str, msg: Dict[str, Any]) -> Message:
+        return Message(
+            id=msg["_id"],
+            thread_id=thread_id,
+            role=msg["role"],
+            content=msg["content"],
+            created_at=msg["created_at"],
+            tool_call_id=msg.get("tool_call_id"),
+            tool_calls=msg.get("tool_calls"),
+            generation_id=msg.get("generation_id"),
+            step=msg.get("step"),
+            partial=msg.get("partial", False),
+            usage=msg.get("usage"),
         )
 
     @staticmethod
@@ -82,6 +159,7 @@ class ChatService:
         threads: List[Thread] = []
 
         async for thread_doc in cursor:
+            thread_doc = message_writes.apply_overlay(str(thread_doc["_id"]), thread_doc)
             threads.append(
                 Thread(
                     id=str(thread_doc["_id"]),
@@ -89,6 +167,7 @@ class ChatService:
                     created_at=thread_doc["created_at"],
                     updated_at=thread_doc["updated_at"],
                     messages=[],  # 列表时不返回完整消息
+                    usage=thread_doc.get("usage") or {},
                 )
             )
 
@@ -115,6 +194,8 @@ class ChatService:
 
         update_payload["updated_at"] = now()
 
+        # 排队中的首条消息会设置标题，先落库以免覆盖这次修改
+        await message_writes.drain(thread_id)
         updated_thread = await threads_collection.find_one_and_update(
             {"_id": ObjectId(thread_id)},
             {"$set": update_payload},
@@ -125,16 +206,7 @@ class ChatService:
             logger.warning("Thread %s not found when updating", thread_id)
             raise HTTPException(status_code=404, detail="Thread not found")
 
-        messages = [
-            Message(
-                id=str(msg.get("_id", "")),
-                thread_id=thread_id,
-                role=msg["role"],
-                content=msg["content"],
-                created_at=msg["created_at"],
-            )
-            for msg in updated_thread.get("messages", [])
-        ]
+        messages = [ChatService._message_from_doc(thread_id, msg) for msg in updated_thread.get("messages", [])]
 
         logger.info("Updated thread %s", thread_id)
 
@@ -144,6 +216,7 @@ class ChatService:
             created_at=updated_thread["created_at"],
             updated_at=updated_thread["updated_at"],
             messages=messages,
+            usage=updated_thread.get("usage") or {},
         )
 
     @staticmethod
@@ -152,6 +225,7 @@ class ChatService:
         threads_collection = get_threads_collection()
 
         result = await threads_collection.delete_one({"_id": ObjectId(thread_id)})
+        message_writes.discard(thread_id)
         if result.deleted_count:
             logger.info("Deleted thread %s", thread_id)
         else:
@@ -159,12 +233,12 @@ class ChatService:
         return result.deleted_count > 0
 
     @staticmethod
-    async def add_message(thread_id: str, message_data: MessageCreate) -> Message:
-        """添加用户消息"""
-        threads_collection = get_threads_collection()
-
+    async def add_message(
+        thread_id: str, message_data: MessageCreate, generation_id: Optional[str] = None
+    ) -> Message:
+        """添加用户消息；generation_id 为回答该消息的生成任务，排在前面的生成据此跳过它"""
         # 检查线程是否存在
-        thread = await threads_collection.find_one({"_id": ObjectId(thread_id)})
+        thread = await ChatService._find_thread_doc(thread_id, {"messages._id": 1})
         if not thread:
             logger.warning("Thread %s not found when adding message", thread_id)
             raise HTTPException(status_code=404, detail="Thread not found")
@@ -176,25 +250,17 @@ class ChatService:
             "content": message_data.content,
             "created_at": now(),
         }
+        if generation_id is not None:
+            user_message["generation_id"] = generation_id
 
-        # 更新线程
-        await threads_collection.update_one(
-            {"_id": ObjectId(thread_id)},
-            {
-                "$push": {"messages": user_message},
-                "$set": {"updated_at": now()},
-            },
-        )
-        logger.debug("Added user message to thread %s", thread_id)
-
-        # 如果是第一条消息，更新标题
+        # 更新线程；如果是第一条消息，同时更新标题
+        set_fields: Dict[str, Any] = {"updated_at": now()}
         if len(thread.get("messages", [])) == 0:
             title = message_data.content[:50] + "..." if len(message_data.content) > 50 else message_data.content
-            await threads_collection.update_one(
-                {"_id": ObjectId(thread_id)},
-                {"$set": {"title": title}},
-            )
+            set_fields["title"] = title
             logger.debug("Updated title for thread %s", thread_id)
+        await message_writes.append(thread_id, [user_message], set_fields)
+        logger.debug("Added user message to thread %s", thread_id)
 
         return Message(
             id=user_message["_id"],
@@ -202,66 +268,227 @@ class ChatService:
             role="user",
             content=user_message["content"],
             created_at=user_message["created_at"],
+            generation_id=generation_id,
         )
 
     @staticmethod
-    async def generate_response_stream(thread_id: str) -> AsyncIterator[str]:
+    async def get_checkpoint(thread_id: str, generation_id: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        读取某次生成已经完成的步骤，用于重试时断点续跑；线程中没有该生成的任何消息时返回 None
+
+        Raises:
+            HTTPException: 线程不存在（404），或该生成之后已经有新的消息（409）
+        """
+        thread = await ChatService._find_thread_doc(thread_id, {"messages": 1})
+        if not thread:
+            raise HTTPException(status_code=404, detail="Thread not found")
+        messages = thread.get("messages", [])
+        _, checkpoint, later = ChatService._split_generation(messages, generation_id)
+        if later:
+            raise HTTPException(status_code=409, detail="Generation is not the latest in this thread")
+        # 只留下用户消息或未完成输出（partial）的生成也算存在
+        if not checkpoint and not any(msg.get("generation_id") == generation_id for msg in messages):
+            return None
+        return checkpoint
+
+    @staticmethod
+    def _conversation_order(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        按问答顺序排列消息：每个生成的消息紧跟在它回答的用户消息之后
+
+        用户消息在排队前写入，同一线程排队的多个问题会先于前面生成的回复保存。
+        重试后已被完整步骤取代的未完成输出（partial）不再返回。
+        """
+        completed: Dict[str, int] = {}
+        for msg in messages:
+            if msg.get("generation_id") is not None and not msg.get("partial") and msg.get("step") is not None:
+                completed[msg["generation_id"]] = max(completed.get(msg["generation_id"], 0), msg["step"])
+        groups: Dict[str, List[Dict[str, Any]]] = {}
+        ordered: List[List[Dict[str, Any]]] = []
+        for msg in messages:
+            generation_id = msg.get("generation_id")
+            if msg.get("partial") and (msg.get("step") or 0) <= completed.get(generation_id, 0):
+                continue
+            if generation_id is not None and msg.get("role") == "user":
+                groups[generation_id] = [msg]
+                ordered.append(groups[generation_id])
+            elif generation_id in groups:
+                groups[generation_id].append(msg)
+            else:
+                ordered.append([msg])
+        return [msg for group in ordered for msg in group]
+
+    @staticmethod
+    def _split_generation(
+        messages: List[Dict[str, Any]], generation_id: str
+    ) -> tuple[List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """把线程消息分为该生成之前的历史（含它回答的用户消息）、该生成已完成的步骤、该生成之后的其他消息"""
+        history: List[Dict[str, Any]] = []
+        checkpoint: List[Dict[str, Any]] = []
+        later: List[Dict[str, Any]] = []
+        asked = False
+        for msg in ChatService._conversation_order(messages):
+            if msg.get("generation_id") == generation_id:
+                if msg.get("role") == "user":
+                    history.append(msg)
+                    asked = True
+                elif not msg.get("partial"):
+                    checkpoint.append(msg)
+            elif asked or checkpoint:
+                later.append(msg)
+            else:
+                history.append(msg)
+        checkpoint.sort(key=lambda msg: msg.get("step") or 0)
+        return history, checkpoint, later
+
+    @staticmethod
+    async def generate_response_stream(
+        thread_id: str,
+        ticket: Optional[Ticket] = None,
+        generation_id: Optional[str] = None,
+    ) -> AsyncIterator[str]:
         """
         生成 AI 响应（流式）
 
+        每个完成的 agent 步骤立即以追加方式保存，并记录 generation_id 与步骤序号；
+        以相同 generation_id 重试时从最后一个完成的步骤继续。
+        assistant 步骤带上模型调用的 token 用量与耗时，同时累加到线程和每日用量；
+        超出用量预算时在下一次模型调用前停止。
+
         Args:
             thread_id: 对话线程 ID
+            ticket: 调度凭证，结束时记录实际 token 用量
+            generation_id: 生成任务 ID
 
         Yields:
             str: 响应文本片段
         """
-        threads_collection = get_threads_collection()
-
         # 获取线程和消息历史
-        thread = await threads_collection.find_one({"_id": ObjectId(thread_id)})
+        thread = await ChatService._find_thread_doc(thread_id)
         if not thread:
             logger.warning("Thread %s not found when generating response", thread_id)
             raise HTTPException(status_code=404, detail="Thread not found")
 
-        # 格式化消息历史
-        messages_history = [{"role": msg["role"], "content": msg["content"]} for msg in thread.get("messages", [])]
+        messages_history = thread.get("messages", [])
+        checkpoint_docs: List[Dict[str, Any]] = []
+        if generation_id is not None:
+            messages_history, checkpoint_docs, _ = ChatService._split_generation(messages_history, generation_id)
 
         # 转换为 LangChain 消息格式
         langchain_messages = llm_service.format_messages(messages_history)
+        checkpoint = llm_service.format_checkpoint(checkpoint_docs)
+        if checkpoint:
+            logger.info("Resuming generation %s from step %d", generation_id, len(checkpoint_docs))
 
         # 流式生成响应
         logger.debug("Start streaming response for thread %s", thread_id)
-        message_sub_docs = []
-        async for message in llm_service.agent_stream(langchain_messages):
-            yield str(message.content)
-            role = None
-            if isinstance(message, AIMessage):
-                role = "assistant"
-            elif isinstance(message, ToolMessage):
-                role = "tool"
-            else:
-                role = "unknown"
-                logger.error("Unknown message role: %s", message)
-            message_sub = Message(
-                thread_id=thread_id,
-                role=role,
-                content=str(message.content),
-                created_at=now(),
-                tool_call_id=message.tool_call_id if isinstance(message, ToolMessage) else None,
-            )
-            message_sub_docs.append(message_sub.py())
+        produced: List[BaseMessage] = []
+        step = len(checkpoint_docs)
+        usage_key = ticket.key if ticket is not None else thread_id
+        run = AgentRun(budget=await usage_service.budget(usage_key))
+        metered = AgentRun()
+        completed = False
+        try:
+            async for message in llm_service.agent_stream(langchain_messages, run, checkpoint):
+                # 每个步骤完成即保存，shield 防止取消打断写入
+                step += 1
+                usage = ChatService._step_usage(run, metered) if isinstance(message, AIMessage) else None
+                sub_doc = ChatService._message_sub_doc(thread_id, message, generation_id, step, usage=usage)
+                await asyncio.shield(
+                    message_writes.append(
+                        thread_id, [sub_doc], {"updated_at": now()}, ChatService._usage_increments(usage)
+                    )
+                )
+                if usage is not None:
+                    await asyncio.shield(usage_service.record(usage_key, usage))
+                produced.append(message)
+                yield str(message.content)
+            completed = True
+            llm_service.record_completed_run(run)
+            prefetch_service.schedule(produced, busy=llm_service.scheduler.queued > 0)
+        except asyncio.CancelledError:
+            saved = llm_service.estimate_tokens_saved(run)
+            GENERATIONS_CANCELLED.inc()
+            TOKENS_SAVED.inc(saved)
+            logger.info("Generation for thread %s cancelled, ~%d output tokens saved", thread_id, saved)
+            raise
+        finally:
+            if ticket is not None:
+                ticket.tokens_used = run.total_tokens
+            # 被取消时也保存未完成的模型输出，标记为 partial，续跑时不作为检查点
+            if not completed and run.partial is not None and run.partial.content:
+                sub_doc = ChatService._message_sub_doc(thread_id, run.partial, generation_id, step + 1, partial=True)
+                await asyncio.shield(message_writes.append(thread_id, [sub_doc], {"updated_at": now()}))
+            logger.debug("Saved %d assistant steps for thread %s", len(produced), thread_id)
 
-            # 保存 AI 响应到数据库
+    @staticmethod
+    def _step_usage(run: AgentRun, metered: AgentRun) -> Optional[MessageUsage]:
+        """
+        上一个步骤之后的模型调用用量，metered 记录已计入的部分
 
-        print(message_sub_docs)
-        await threads_collection.update_one(
-            {"_id": ObjectId(thread_id)},
-            {
-                "$push": {"messages": {"$each": message_sub_docs}},
-                "$set": {"updated_at": now()},
-            },
+        相同的并发请求共享一次生成时，每个请求的步骤都带上共享的模型调用用量；命中响应缓存的回放没有用量。
+        """
+        calls = run.model_calls - metered.model_calls
+        if calls <= 0:
+            return None
+        usage = MessageUsage(
+            model=run.model,
+            input_tokens=run.input_tokens - metered.input_tokens,
+            output_tokens=run.output_tokens - metered.output_tokens,
+            model_calls=calls,
+            latency_ms=round((run.model_seconds - metered.model_seconds) * 1000, 1),
+        )
+        metered.input_tokens, metered.output_tokens = run.input_tokens, run.output_tokens
+        metered.model_calls, metered.model_seconds = run.model_calls, run.model_seconds
+        return usage
+
+    @staticmethod
+    def _usage_increments(usage: Optional[MessageUsage]) -> Optional[Dict[str, Any]]:
+        """线程上累计用量的 $inc，随消息一起写入"""
+        if usage is None:
+            return None
+        return {
+            "usage.input_tokens": usage.input_tokens,
+            "usage.output_tokens": usage.output_tokens,
+            "usage.model_calls": usage.model_calls,
+        }
+
+    @staticmethod
+    def _message_sub_doc(
+        thread_id: str,
+        message: BaseMessage,
+        generation_id: Optional[str] = None,
+        step: Optional[int] = None,
+        partial: bool = False,
+        usage: Optional[MessageUsage] = None,
+    ) -> Dict[str, Any]:
+        """把 LangChain 消息转换为线程中的消息子文档"""
+        role = None
+        tool_calls = None
+        if isinstance(message, (AIMessage, AIMessageChunk)):
+            role = "assistant"
+            if message.tool_calls and not partial:
+                tool_calls = [
+                    {"id": call["id"], "name": call["name"], "args": call["args"]} for call in message.tool_calls
+                ]
+        elif isinstance(message, ToolMessage):
+            role = "tool"
+        else:
+            role = "unknown"
+            logger.error("Unknown message role: %s", message)
+        message_sub = Message(
+            thread_id=thread_id,
+            role=role,
+            content=str(message.content),
+            created_at=now(),
+            tool_call_id=message.tool_call_id if isinstance(message, ToolMessage) else None,
+            tool_calls=tool_calls,
+            generation_id=generation_id,
+            step=step,
+            partial=partial,
+            usage=usage,
         )
-        logger.debug("Saved assistant response for thread %s", thread_id)
+        return message_sub.py()
 
 
 chat_service = ChatService()
@@ -0,0 +1,207 @@
+"""生成任务管理 - 让 AI 响应的生成与 HTTP 连接解耦，断线后可按事件序号续传"""
+
+import asyncio
+import contextlib
+import logging
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, AsyncContextManager, AsyncIterator, Callable, Deque, Dict, Optional
+
+from app.config import settings
+from app.services.scheduler import GenerationScheduler, Ticket
+
+logger = logging.getLogger("app.generation_service")
+
+
+class GenerationGapError(Exception):
+    """请求续传的事件已被环形缓冲区淘汰"""
+
+
+class GenerationStopped(Exception):
+    """生成被有意停止（如超出用量预算），客户端收到带 code 的错误事件"""
+
+    code = "stopped"
+
+
+@dataclass
+class GenerationEvent:
+    """一条带序号的 SSE 事件"""
+
+    seq: int
+    data: Dict[str, Any]
+
+
+@dataclass
+class Generation:
+    """一次 AI 响应生成，事件保存在有界环形缓冲区中"""
+
+    id: str
+    thread_id: str
+    events: Deque[GenerationEvent]
+    last_seq: int = 0
+    done: bool = False
+    cancelled: bool = False
+    finished_at: Optional[float] = None
+    task: Optional[asyncio.Task] = None
+    subscribers: int = 0
+    idle_handle: Optional[asyncio.TimerHandle] = None
+    _changed: asyncio.Condition = field(default_factory=asyncio.Condition)
+
+    async def publish(self, data: Dict[str, Any]) -> None:
+        async with self._changed:
+            self.last_seq += 1
+            self.events.append(GenerationEvent(seq=self.last_seq, data=data))
+            self._changed.notify_all()
+
+    async def finish(self) -> None:
+        async with self._changed:
+            self.done = True
+            self.finished_at = time.monotonic()
+            self._changed.notify_all()
+
+    async def subscribe(self, last_event_id: int = 0) -> AsyncIterator[GenerationEvent]:
+        """
+        先回放序号大于 last_event_id 的缓冲事件，再持续跟随新事件直到生成结束
+
+        Raises:
+            GenerationGapError: 需要的事件已被淘汰，无法无损续传
+        """
+        cursor = last_event_id
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: self.last_seq > cursor or self.done)
+                pending = [event for event in self.events if event.seq > cursor]
+                finished = self.done
+
+            if pending and pending[0].seq > cursor + 1:
+                raise GenerationGapError(f"events {cursor + 1}..{pending[0].seq - 1} expired")
+            for event in pending:
+                cursor = event.seq
+                yield event
+            if finished and cursor >= self.last_seq:
+                return
+
+
+class GenerationManager:
+    """管理进行中与刚结束的生成任务"""
+
+    def __init__(self) -> None:
+        self._generations: Dict[str, Generation] = {}
+
+    def start(
+        self,
+        thread_id: str,
+        producer: Callable[[], AsyncIterator[str]],
+        scheduler: Optional[GenerationScheduler] = None,
+        ticket: Optional[Ticket] = None,
+        generation_id: Optional[str] = None,
+        turn: Optional[Callable[[], AsyncContextManager[Any]]] = None,
+    ) -> Generation:
+        """
+        在后台启动生成任务，客户端断开不会中断生成
+
+        传入 turn 时先进入线程的生成轮次（等待同一线程上前一个生成结束），
+        传入调度凭证时再等待准入，排队期间向客户端推送排队位置和预计等待时间。
+        重试已结束的生成时传入原 generation_id，新任务替换旧记录。
+        """
+        generation = Generation(
+            id=generation_id or self.new_id(),
+            thread_id=thread_id,
+            events=deque(maxlen=settings.generation_buffer_size),
+        )
+        self._generations[generation.id] = generation
+        generation.task = asyncio.create_task(self._run(generation, producer, scheduler, ticket, turn))
+        logger.info("Started generation %s for thread %s", generation.id, thread_id)
+        return generation
+
+    @staticmethod
+    def new_id() -> str:
+        return uuid.uuid4().hex
+
+    def get(self, generation_id: str) -> Optional[Generation]:
+        return self._generations.get(generation_id)
+
+    async def subscribe(self, generation: Generation, last_event_id: int = 0) -> AsyncIterator[GenerationEvent]:
+        """
+        订阅生成任务的事件流
+
+        最后一个订阅者断开后，若在宽限期内没有客户端重连，则取消生成，
+        不再为无人接收的响应调用模型和工具。
+        """
+        generation.subscribers += 1
+        if generation.idle_handle is not None:
+            generation.idle_handle.cancel()
+            generation.idle_handle = None
+        try:
+            async for event in generation.subscribe(last_event_id):
+                yield event
+        finally:
+            generation.subscribers -= 1
+            if generation.subscribers == 0 and not generation.done and settings.generation_cancel_on_disconnect:
+                generation.idle_handle = asyncio.get_running_loop().call_later(
+                    settings.generation_disconnect_grace_seconds,
+                    self._cancel_abandoned,
+                    generation,
+                )
+
+    def _cancel_abandoned(self, generation: Generation) -> None:
+        generation.idle_handle = None
+        if generation.subscribers or generation.done or generation.task is None:
+            return
+        logger.info("No subscribers left for generation %s, cancelling", generation.id)
+        generation.cancelled = True
+        generation.task.cancel()
+
+    async def shutdown(self) -> None:
+        """取消仍在运行的生成任务"""
+        tasks = [g.task for g in self._generations.values() if g.task and not g.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._generations.clear()
+
+    async def _run(
+        self,
+        generation: Generation,
+        producer: Callable[[], AsyncIterator[str]],
+        scheduler: Optional[GenerationScheduler],
+        ticket: Optional[Ticket],
+        turn: Optional[Callable[[], AsyncContextManager[Any]]],
+    ) -> None:
+        async def report_queue(position: int, estimated_wait: float) -> None:
+            await generation.publish({"queue": {"position": position, "estimated_wait": estimated_wait}})
+
+        try:
+            await generation.publish({"generation_id": generation.id})
+            async with turn() if turn is not None else contextlib.nullcontext():
+                if scheduler is not None and ticket is not None:
+                    await scheduler.wait(ticket, report_queue)
+                async for chunk in producer():
+                    logger.debug("Generation %s produced chunk", generation.id)
+                    await generation.publish({"content": chunk})
+            await generation.publish({"done": True})
+            logger.debug("Completed generation %s", generation.id)
+        except asyncio.CancelledError:
+            logger.info("Generation %s cancelled", generation.id)
+            await generation.publish({"error": "生成已取消", "code": "cancelled"})
+        except GenerationStopped as e:
+            logger.info("Generation %s stopped: %s", generation.id, e)
+            await generation.publish({"error": str(e), "code": e.code})
+        except Exception as e:
+            logger.exception("Generation %s failed for thread %s", generation.id, generation.thread_id)
+            await generation.publish({"error": str(e)})
+        finally:
+            if scheduler is not None and ticket is not None:
+                scheduler.release(ticket)
+            await generation.finish()
+            asyncio.get_running_loop().call_later(settings.generation_retention_seconds, self._forget, generation)
+
+    def _forget(self, generation: Generation) -> None:
+        # 重试会以相同 id 登记新任务，只移除仍是自己的记录
+        if self._generations.get(generation.id) is generation:
+            del self._generations[generation.id]
+
+
+generation_manager = GenerationManager()
@@ -0,0 +1,227 @@
+"""索引声明与启动时的幂等创建，以及热点查询的 explain 诊断"""
+
+import asyncio
+import logging
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure, PyMongoError
+
+from app.config import settings
+from app.database import get_database
+from app.metrics import registry
+from app.models import PhoneSearchParams
+from app.query_monitor import summarize_explain
+from app.services.phone_service import phone_service
+
+logger = logging.getLogger("app.index_service")
+
+COLLECTION_SCANS = registry.gauge(
+    "mongodb_diagnostic_collection_scans", "Representative queries whose winning plan is a collection scan"
+)
+
+# 每个集合需要的索引；名称使用默认命名，与已有部署中手动创建的同键索引一致
+INDEXES: Dict[str, List[IndexModel]] = {
+    "threads": [
+        # list_threads 按 updated_at 倒序分页
+        IndexModel([("updated_at", DESCENDING)]),
+    ],
+    "phones": [
+        # list_phones 的 keyset 分页，以及目录版本读取最近的 updated_at
+        IndexModel([("updated_at", DESCENDING), ("_id", DESCENDING)]),
+        # 按品牌 / 标签过滤后仍按 (updated_at, _id) 排序
+        IndexModel([("brand", ASCENDING), ("updated_at", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("tags", ASCENDING), ("updated_at", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("model", ASCENDING)]),
+        # 搜索的价格条件是 skus 上的 $elemMatch
+        IndexModel([("skus.price", ASCENDING)]),
+    ],
+    "thread_leases": [
+        # 过期的生成租约由 TTL 清理；抢占只看 expires_at，不依赖清理时机
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=3600),
+    ],
+    "usage_daily": [
+        # 每日预算读取某个用户当天的用量；用量报表按日期范围汇总
+        IndexModel([("day", ASCENDING), ("key", ASCENDING)]),
+    ],
+}
+
+Sort = List[Tuple[str, int]]
+
+
+@dataclass(frozen=True)
+class RepresentativeQuery:
+    """一个热点查询；允许全表扫描的查询（如正则关键词搜索）只报告不告警"""
+
+    name: str
+    collection: str
+    build: Callable[[Dict[str, Any]], Dict[str, Any]]
+    sort: Sort = field(default_factory=list)
+    limit: int = 20
+    allow_collection_scan: bool = False
+
+
+_KEYSET = [("updated_at", DESCENDING), ("_id", DESCENDING)]
+
+REPRESENTATIVE_QUERIES: List[RepresentativeQuery] = [
+    RepresentativeQuery("threads.list", "threads", lambda sample: {}, [("updated_at", DESCENDING)], limit=100),
+    RepresentativeQuery("threads.get", "threads", lambda sample: {"_id": sample["thread_id"]}, limit=1),
+    RepresentativeQuery("phones.list", "phones", lambda sample: {}, _KEYSET, limit=21),
+    RepresentativeQuery("phones.list_by_brand", "phones", lambda sample: {"brand": sample["brand"]}, _KEYSET, limit=21),
+    RepresentativeQuery("phones.list_by_tag", "phones", lambda sample: {"tags": sample["tag"]}, _KEYSET, limit=21),
+    RepresentativeQuery("phones.latest_update", "phones", lambda sample: {}, [("updated_at", DESCENDING)], limit=1),
+    RepresentativeQuery(
+        "phones.search_by_tag_and_price",
+        "phones",
+        lambda sample: phone_service.build_search_query(PhoneSearchParams(tags=[sample["tag"]], max_price=3000)),
+        [("updated_at", DESCENDING)],
+        limit=5,
+    ),
+    RepresentativeQuery(
+        "phones.search_by_price",
+        "phones",
+        lambda sample: phone_service.build_search_query(PhoneSearchParams(min_price=2000, max_price=4000)),
+        [("updated_at", DESCENDING)],
+        limit=5,
+    ),
+    RepresentativeQuery(
+        "phones.search_by_keyword",
+        "phones",
+        lambda sample: phone_service.build_search_query(PhoneSearchParams(keyword=sample["brand"])),
+        [("updated_at", DESCENDING)],
+        limit=5,
+        allow_collection_scan=True,
+    ),
+    RepresentativeQuery(
+        "phones.sync_watermark",
+        "phones",
+        lambda sample: {
+            "$or": [{"updated_at": {"$gt": sample["now"]}}, {"updated_at": sample["now"], "_id": {"$gt": ObjectId()}}]
+        },
+        [("updated_at", ASCENDING), ("_id", ASCENDING)],
+        limit=500,
+    ),
+]
+
+
+@dataclass
+class QueryPlan:
+    """一个查询的 explain 摘要"""
+
+    name: str
+    collection: str
+    stages: List[str]
+    indexes: List[str]
+    collection_scan: bool
+    allow_collection_scan: bool
+    docs_examined: Optional[int] = None
+    keys_examined: Optional[int] = None
+    returned: Optional[int] = None
+
+
+class IndexService:
+    """启动时在后台幂等地创建声明的索引；诊断模式下 explain 热点查询并告警全表扫描"""
+
+    def __init__(self) -> None:
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if not settings.mongodb_ensure_indexes and not settings.mongodb_index_diagnostics:
+            return
+        self._task = asyncio.create_task(self._bootstrap())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def ensure_indexes(self, database: Optional[Any] = None) -> Dict[str, List[str]]:
+        """创建全部声明的索引，已存在的索引不受影响；返回每个集合的索引名"""
+        database = database if database is not None else get_database()
+        created: Dict[str, List[str]] = {}
+        for name, indexes in INDEXES.items():
+            try:
+                created[name] = await database.get_collection(name).create_indexes(indexes)
+            except OperationFailure as e:
+                # 同键不同选项的旧索引会冲突，需要人工处理，不影响其他集合
+                logger.error("Failed to create indexes on %s: %s", name, e)
+        logger.info("Ensured indexes: %s", created)
+        return created
+
+    async def describe_indexes(self) -> Dict[str, Dict[str, Any]]:
+        """每个集合已存在的索引，以及缺失的声明索引"""
+        database = get_database()
+        report: Dict[str, Dict[str, Any]] = {}
+        for name, indexes in INDEXES.items():
+            existing = await database.get_collection(name).index_information()
+            declared = [index.document["name"] for index in indexes]
+            report[name] = {
+                "existing": sorted(existing),
+                "missing": [index for index in declared if index not in existing],
+            }
+        return report
+
+    async def explain_queries(self, queries: Sequence[RepresentativeQuery] = REPRESENTATIVE_QUERIES) -> List[QueryPlan]:
+        """explain 代表性查询，记录全表扫描"""
+        database = get_database()
+        sample = await self._sample(database)
+        plans: List[QueryPlan] = []
+        for query in queries:
+            collection = database.get_collection(query.collection)
+            cursor = collection.find(query.build(sample)).limit(query.limit)
+            if query.sort:
+                cursor = cursor.sort(query.sort)
+            try:
+                summary = summarize_explain(await cursor.explain())
+            except PyMongoError as e:
+                logger.warning("Failed to explain %s: %s", query.name, e)
+                continue
+            plan = QueryPlan(
+                name=query.name,
+                collection=query.collection,
+                allow_collection_scan=query.allow_collection_scan,
+                **summary,
+            )
+            if plan.collection_scan and not plan.allow_collection_scan:
+                logger.warning(
+                    "Query %s on %s uses a collection scan (%s docs examined)",
+                    plan.name,
+                    plan.collection,
+                    plan.docs_examined,
+                )
+            plans.append(plan)
+        COLLECTION_SCANS.set(sum(plan.collection_scan and not plan.allow_collection_scan for plan in plans))
+        return plans
+
+    async def report(self) -> Dict[str, Any]:
+        plans = await self.explain_queries()
+        return {"indexes": await self.describe_indexes(), "queries": [asdict(plan) for plan in plans]}
+
+    async def _bootstrap(self) -> None:
+        try:
+            if settings.mongodb_ensure_indexes:
+                await self.ensure_indexes()
+            if settings.mongodb_index_diagnostics:
+                await self.explain_queries()
+        except PyMongoError as e:
+            logger.error("Index bootstrap failed: %s", e)
+
+    @staticmethod
+    async def _sample(database: Any) -> Dict[str, Any]:
+        """从现有数据中取查询参数，集合为空时使用占位值"""
+        phone = await database.get_collection("phones").find_one({}, {"brand": 1, "tags": 1}) or {}
+        thread = await database.get_collection("threads").find_one({}, {"_id": 1}) or {}
+        return {
+            "brand": phone.get("brand") or "小米",
+            "tag": (phone.get("tags") or ["拍照手机"])[0],
+            "thread_id": thread.get("_id") or ObjectId(),
+            "now": datetime.now(timezone.utc),
+        }
+
+
+index_service = IndexService()
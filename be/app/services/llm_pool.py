@@ -0,0 +1,302 @@
+"""多后端 LLM 连接池 - 最少在途请求负载均衡、健康评分与对冲请求"""
+
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Sequence, Tuple
+
+import httpx
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, message_chunk_to_message
+from langchain_core.tools import BaseTool
+
+from app.config import LLMBackendConfig, settings
+from app.metrics import registry
+
+logger = logging.getLogger("app.llm_pool")
+
+REQUESTS = registry.counter("llm_backend_requests_total", "LLM requests by backend and outcome")
+FIRST_TOKEN = registry.histogram("llm_backend_first_token_seconds", "Time to first streamed chunk by backend")
+OUTSTANDING = registry.gauge("llm_backend_outstanding", "In-flight LLM requests by backend")
+HEDGES = registry.counter("llm_hedged_requests_total", "Hedged requests started, labelled by winning backend")
+
+# 连续失败达到该次数后暂时摘除后端
+FAILURE_THRESHOLD = 3
+SAMPLE_WINDOW = 200
+
+
+class LLMBackend:
+    """
+    一个 OpenAI 兼容的上游，记录在途请求数、首 token 延迟和错误率
+
+    langchain_openai 导入较慢，客户端在首次使用或 warm_up 时才构建。
+    """
+
+    def __init__(self, config: LLMBackendConfig, http_client: httpx.AsyncClient) -> None:
+        self.name = config.name
+        self.weight = config.weight
+        self.config = config
+        self.http_client = http_client
+        self.tools: Sequence[BaseTool] = ()
+        self._runnable: Any = None
+        self._build_lock = threading.Lock()
+        self.outstanding = 0
+        self.latency_ewma: Optional[float] = None
+        self.error_ewma = 0.0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+    @property
+    def runnable(self) -> Any:
+        if self._runnable is None:
+            self.warm_up()
+        return self._runnable
+
+    def bind_tools(self, tools: Sequence[BaseTool]) -> None:
+        self.tools = tools
+        self._runnable = None
+
+    def warm_up(self) -> None:
+        """构建客户端并绑定工具，可在后台线程中调用"""
+        with self._build_lock:
+            if self._runnable is not None:
+                return
+            from langchain_openai import ChatOpenAI
+
+            llm = ChatOpenAI(
+                model=self.config.model or settings.openai_model,
+                temperature=0.7,
+                streaming=True,
+                stream_usage=True,
+                api_key=self.config.api_key or settings.openai_api_key,
+                base_url=self.config.base_url or None,
+                http_async_client=self.http_client,
+                max_retries=settings.llm_backend_max_retries,
+            )
+            self._runnable = llm.bind_tools(self.tools) if self.tools else llm
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self.cooldown_until
+
+    def score(self) -> float:
+        """越小越优先：在途请求越少、延迟越低、错误越少的后端得分越低"""
+        latency = self.latency_ewma if self.latency_ewma is not None else 1.0
+        return (self.outstanding + 1) * latency * (1 + 4 * self.error_ewma) / max(self.weight, 1e-6)
+
+    def acquire(self) -> None:
+        self.outstanding += 1
+        OUTSTANDING.set(self.outstanding, backend=self.name)
+
+    def release(self) -> None:
+        self.outstanding -= 1
+        OUTSTANDING.set(self.outstanding, backend=self.name)
+
+    def record_first_token(self, seconds: float) -> None:
+        self.latency_ewma = seconds if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * seconds
+        FIRST_TOKEN.observe(seconds, backend=self.name)
+
+    def record_abandoned(self, seconds: float) -> None:
+        """对冲落败被取消时，已等待的时间是首 token 延迟的下界"""
+        if self.latency_ewma is None or seconds > self.latency_ewma:
+            self.latency_ewma = seconds if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * seconds
+
+    def record_success(self) -> None:
+        self.error_ewma *= 0.9
+        self.consecutive_failures = 0
+        REQUESTS.inc(backend=self.name, outcome="ok")
+
+    def record_failure(self) -> None:
+        self.error_ewma = 0.9 * self.error_ewma + 0.1
+        self.consecutive_failures += 1
+        REQUESTS.inc(backend=self.name, outcome="error")
+        if self.consecutive_failures >= FAILURE_THRESHOLD:
+            self.cooldown_until = time.monotonic() + settings.llm_backend_cooldown_seconds
+            logger.warning("Backend %s failed %d times, cooling down", self.name, self.consecutive_failures)
+
+
+@dataclass
+class _OpenStream:
+    """已经收到首个 chunk 的流"""
+
+    backend: LLMBackend
+    stream: AsyncIterator[AIMessageChunk]
+    first: AIMessageChunk
+
+    async def close(self) -> None:
+        try:
+            await self.stream.aclose()  # type: ignore[attr-defined]
+        finally:
+            self.backend.release()
+
+
+class LLMBackendPool:
+    """
+    OpenAI 兼容后端池
+
+    每次请求选择得分最低的可用后端；开启对冲时，若首个后端在基于历史首 token 延迟分位数的期限内
+    还没有返回首个 chunk，则向另一个后端发起相同请求，先返回者胜出，另一个被取消。
+    首个 chunk 之前失败的请求会自动切换到其他后端。
+    """
+
+    def __init__(self, configs: Sequence[LLMBackendConfig]) -> None:
+        if not configs:
+            raise ValueError("At least one LLM backend is required")
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.llm_http_max_connections,
+                max_keepalive_connections=settings.llm_http_max_keepalive_connections,
+            ),
+            timeout=httpx.Timeout(settings.llm_request_timeout_seconds, connect=10.0),
+        )
+        self.backends: List[LLMBackend] = [LLMBackend(config, self.http_client) for config in configs]
+        self._first_token_samples: Deque[float] = deque(maxlen=SAMPLE_WINDOW)
+        logger.info("Initialized LLM backend pool: %s", [backend.name for backend in self.backends])
+
+    @classmethod
+    def from_settings(cls) -> "LLMBackendPool":
+        """未配置 llm_backends 时，使用 openai_api_base 作为唯一后端"""
+        configs = settings.llm_backends or [
+            LLMBackendConfig(name="default", base_url=settings.openai_api_base or None),
+        ]
+        return cls(configs)
+
+    def bind_tools(self, tools: Sequence[BaseTool]) -> "LLMBackendPool":
+        for backend in self.backends:
+            backend.bind_tools(tools)
+        return self
+
+    def warm_up(self) -> None:
+        """预先构建全部后端的客户端"""
+        for backend in self.backends:
+            backend.warm_up()
+
+    def pick(self, exclude: Sequence[LLMBackend] = ()) -> Optional[LLMBackend]:
+        """选择得分最低的后端；全部处于冷却期时退而选择未被排除的任意后端"""
+        candidates = [backend for backend in self.backends if backend not in exclude]
+        if not candidates:
+            return None
+        available = [backend for backend in candidates if backend.available] or candidates
+        return min(available, key=LLMBackend.score)
+
+    def hedge_delay(self) -> float:
+        """对冲期限：首 token 延迟的分位数，样本不足时使用上限"""
+        if len(self._first_token_samples) < 20:
+            return settings.llm_hedge_max_delay_seconds
+        samples = sorted(self._first_token_samples)
+        index = min(len(samples) - 1, math.ceil(settings.llm_hedge_percentile * len(samples)) - 1)
+        return min(max(samples[index], settings.llm_hedge_min_delay_seconds), settings.llm_hedge_max_delay_seconds)
+
+    async def astream(self, messages: List[BaseMessage], **kwargs: Any) -> AsyncIterator[AIMessageChunk]:
+        opened = await self._open_first(messages, **kwargs)
+        backend = opened.backend
+        try:
+            yield opened.first
+            async for chunk in opened.stream:
+                yield chunk
+            backend.record_success()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            backend.record_failure()
+            raise
+        finally:
+            await opened.close()
+
+    async def ainvoke(self, messages: List[BaseMessage], **kwargs: Any) -> AIMessage:
+        response: Optional[AIMessageChunk] = None
+        async for chunk in self.astream(messages, **kwargs):
+            response = chunk if response is None else response + chunk
+        if response is None:
+            raise RuntimeError("Model returned an empty stream")
+        return message_chunk_to_message(response)  # type: ignore[return-value]
+
+    async def aclose(self) -> None:
+        await self.http_client.aclose()
+
+    async def _open_first(self, messages: List[BaseMessage], **kwargs: Any) -> _OpenStream:
+        """并发等待各后端的首个 chunk，处理对冲与失败切换"""
+        tried: List[LLMBackend] = []
+        tasks: set[asyncio.Task] = set()
+        launched: Dict[asyncio.Task, Tuple[LLMBackend, float]] = {}
+        hedged = False
+        won = False
+        last_error: Optional[BaseException] = None
+
+        def launch() -> bool:
+            backend = self.pick(exclude=tried)
+            if backend is None:
+                return False
+            tried.append(backend)
+            task = asyncio.create_task(self._open(backend, messages, **kwargs))
+            tasks.add(task)
+            launched[task] = (backend, time.monotonic())
+            return True
+
+        launch()
+        try:
+            while True:
+                can_hedge = settings.llm_hedge_enabled and not hedged and len(tried) < len(self.backends)
+                done, _ = await asyncio.wait(
+                    tasks,
+                    timeout=self.hedge_delay() if can_hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    hedged = True
+                    if launch():
+                        logger.info("No first token within %.2fs, hedging to %s", self.hedge_delay(), tried[-1].name)
+                    continue
+
+                winner: Optional[_OpenStream] = None
+                for task in done:
+                    tasks.discard(task)
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                        logger.warning("LLM backend failed before first token: %s", last_error)
+                    elif winner is None:
+                        winner = task.result()
+                    else:
+                        await task.result().close()
+                if winner is not None:
+                    won = True
+                    if hedged:
+                        HEDGES.inc(winner=winner.backend.name)
+                    return winner
+                if not tasks and not launch():
+                    raise last_error or RuntimeError("No LLM backend available")
+        finally:
+            for task in tasks:
+                if won and not task.done():
+                    # 对冲落败：已等待的时间是该后端首 token 延迟的下界；调用方取消时不计入
+                    backend, started = launched[task]
+                    backend.record_abandoned(time.monotonic() - started)
+                task.cancel()
+            for task in tasks:
+                try:
+                    opened = await task
+                except BaseException:
+                    continue
+                await opened.close()
+
+    async def _open(self, backend: LLMBackend, messages: List[BaseMessage], **kwargs: Any) -> _OpenStream:
+        backend.acquire()
+        started = time.monotonic()
+        stream = backend.runnable.astream(messages, **kwargs)
+        try:
+            first = await stream.__anext__()
+        except BaseException as e:
+            backend.release()
+            if not isinstance(e, asyncio.CancelledError):
+                backend.record_failure()
+            await stream.aclose()
+            if isinstance(e, StopAsyncIteration):
+                raise RuntimeError(f"Backend {backend.name} returned an empty stream") from e
+            raise
+        elapsed = time.monotonic() - started
+        backend.record_first_token(elapsed)
+        self._first_token_samples.append(elapsed)
+        return _OpenStream(backend=backend, stream=stream, first=first)
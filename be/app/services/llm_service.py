@@ -1,37 +1,56 @@
+from __future__ import annotations
+
+import asyncio
 import logging
-from typing import Any, AsyncIterator, Dict, List
+import time
+from dataclasses import dataclass, replace
+from typing import TYPE_CHECKING, Any, AsyncIterator, Dict, List, NamedTuple, Optional, Sequence
 
-from langchain.messages import (
+from langchain_core.messages import (
     AIMessage,
+    AIMessageChunk,
+    BaseMessage,
     HumanMessage,
     SystemMessage,
     ToolCall,
     ToolMessage,
+    message_chunk_to_message,
 )
-from langchain_core.language_models import BaseChatModel, LanguageModelInput
-from langchain_core.messages import BaseMessage
 from langchain_core.tools import BaseTool
-from langchain_openai import ChatOpenAI
-from langgraph.func import task
-from langgraph.graph import add_messages
-from langgraph.graph.state import Runnable
-from rich import print
 
 from app.config import settings
-from app.tools import search_phones
+from app.services.llm_pool import LLMBackendPool
+from app.services.model_router import ModelRouter
+from app.services.phone_service import phone_service
+from app.services.response_cache import cache_key, normalize_message, response_cache
+from app.services.scheduler import GenerationScheduler
+from app.tools import facet_phones, search_phones
+from app.tools.search_phones import build_search_params
+from app.utils.singleflight import SingleFlight
+
+if TYPE_CHECKING:
+    from langchain_core.language_models import LanguageModelInput
+    from langchain_core.runnables import Runnable
+
+    from app.services.usage_service import UsageBudget
 
 logger = logging.getLogger("app.llm")
 
-tools = [search_phones]
+SYSTEM_PROMPT = "你是一个手机推荐助手，根据用户的需求，使用search_phones tool从数据库中搜索手机信息，并返回给用户。注意只能推荐数据库里的手机，不能推荐其他手机。"
+
+tools = [search_phones, facet_phones]
 tools_by_name = {tool.name: tool for tool in tools}
 
 
 async def call_tool(tool_call: ToolCall) -> ToolMessage:
     """Performs the tool call and wraps the result in a ToolMessage."""
     tool = tools_by_name[tool_call["name"]]
-    print("calling tool", tool_call)
+    logger.debug("Calling tool %s", tool_call)
     result = await tool.ainvoke(tool_call)
 
+    # 以 ToolCall 调用时工具返回的是 ToolMessage，只取其内容
+    if isinstance(result, ToolMessage):
+        result = result.content
     if isinstance(result, str):
         content = result
     else:
@@ -40,39 +59,206 @@ async def call_tool(tool_call: ToolCall) -> ToolMessage:
     return ToolMessage(content=content, tool_call_id=tool_call["id"])
 
 
-@task
-async def call_llm(model: ChatOpenAI, messages: list[BaseMessage]) -> AIMessage:
-    """LLM decides whether to call a tool or not"""
-    return await model.ainvoke(
-        [
-            SystemMessage(
-                content="你是一个手机推荐助手，根据用户的需求，使用search_phones tool从数据库中搜索手机信息，并返回给用户。注意只能推荐数据库里的手机，不能推荐其他手机。"
-            )
-        ]
-        + messages
-    )
+async def call_search_phones_merged(tool_calls: list[ToolCall]) -> Dict[str, ToolMessage]:
+    """把同一轮中的多个 search_phones 调用合并为一次数据库查询，再拆分回各自的 ToolMessage"""
+    params_by_id = {}
+    for tool_call in tool_calls:
+        try:
+            params_by_id[tool_call["id"]] = build_search_params(**tool_call["args"])
+        except Exception:
+            # 参数不合法的调用单独执行，沿用工具自身的错误处理
+            logger.warning("Invalid search_phones args, skip merging: %s", tool_call["args"])
+
+    if len(params_by_id) < 2:
+        return {}
+
+    logger.info("Merging %d search_phones calls into one query", len(params_by_id))
+    try:
+        results = await phone_service.search_phones_many(list(params_by_id.values()))
+    except Exception as e:
+        logger.error("Error in merged phone search, falling back to single calls: %s", e, exc_info=True)
+        return {}
+
+    return {
+        tool_call_id: ToolMessage(content=str(phones), tool_call_id=tool_call_id)
+        for tool_call_id, phones in zip(params_by_id, results)
+    }
+
+
+async def execute_tool_calls(tool_calls: list[ToolCall]) -> list[ToolMessage]:
+    """执行模型一轮输出的全部工具调用，结果顺序与 tool_calls 一致"""
+    search_calls = [tool_call for tool_call in tool_calls if tool_call["name"] == search_phones.name]
+    results = await call_search_phones_merged(search_calls) if len(search_calls) > 1 else {}
+    for tool_call in tool_calls:
+        if tool_call["id"] not in results:
+            results[tool_call["id"]] = await call_tool(tool_call)
+    return [results[tool_call["id"]] for tool_call in tool_calls]
+
+
+@dataclass
+class AgentRun:
+    """
+    一次 agent 循环的运行状态，取消时用于读取未完成的模型输出
+
+    累计模型调用次数、耗时和 token 用量；设置 budget 时每次调用模型前检查，超出则停止循环。
+    """
+
+    partial: Optional[AIMessageChunk] = None
+    input_tokens: int = 0
+    output_tokens: int = 0
+    model_calls: int = 0
+    model_seconds: float = 0.0
+    model: Optional[str] = None  # 最近一次调用的模型
+    budget: Optional[UsageBudget] = None
+
+    @property
+    def total_tokens(self) -> int:
+        return self.input_tokens + self.output_tokens
+
+
+class SharedStep(NamedTuple):
+    """共享执行产出的一个步骤，附带产出时共享执行的累计用量"""
+
+    message: BaseMessage
+    usage: AgentRun
+    run: AgentRun
+
+
+def charge_shared_step(run: AgentRun, step: SharedStep, charged: AgentRun) -> None:
+    """
+    把共享执行在该步骤之前的模型调用计入订阅者自己的 run，charged 记录已计入的部分
+
+    模型调用已由共享执行完成，这里按订阅者自己的预算在计入前检查，超出时该订阅者停止。
+    """
+    calls = step.usage.model_calls - charged.model_calls
+    if calls <= 0:
+        return
+    if run.budget is not None:
+        run.budget.check(run.total_tokens, run.model_calls)
+    run.input_tokens += step.usage.input_tokens - charged.input_tokens
+    run.output_tokens += step.usage.output_tokens - charged.output_tokens
+    run.model_calls += calls
+    run.model_seconds += step.usage.model_seconds - charged.model_seconds
+    run.model = step.usage.model
+    charged.input_tokens, charged.output_tokens = step.usage.input_tokens, step.usage.output_tokens
+    charged.model_calls, charged.model_seconds = step.usage.model_calls, step.usage.model_seconds
+
+
+async def invoke_streaming(
+    model: Runnable[LanguageModelInput, AIMessage],
+    input_messages: list[BaseMessage],
+    run: AgentRun,
+    model_name: Optional[str] = None,
+) -> AIMessage:
+    """
+    以流式方式调用模型并累积为完整消息，过程中的部分输出记录在 run.partial
+
+    model_name 不为空时覆盖请求中的模型名
+    """
+    run.partial = None
+    kwargs = {"model": model_name} if model_name else {}
+    started = time.monotonic()
+    async for chunk in model.astream(input_messages, **kwargs):
+        run.partial = chunk if run.partial is None else run.partial + chunk
+    if run.partial is None:
+        raise RuntimeError("Model returned an empty stream")
+    response = message_chunk_to_message(run.partial)
+    run.partial = None
+    run.model_calls += 1
+    run.model_seconds += time.monotonic() - started
+    run.model = response.response_metadata.get("model_name") or model_name or settings.openai_model
+    if response.usage_metadata:
+        run.input_tokens += response.usage_metadata.get("input_tokens", 0)
+        run.output_tokens += response.usage_metadata.get("output_tokens", 0)
+    return response
+
+
+async def invoke_routed(
+    model: Runnable[LanguageModelInput, AIMessage],
+    input_messages: list[BaseMessage],
+    run: AgentRun,
+    router: ModelRouter,
+) -> AIMessage:
+    """按路由结果选择模型调用，并记录各级别模型的耗时与 token 用量"""
+    decision = router.route(input_messages)
+    while True:
+        started = time.monotonic()
+        input_tokens, output_tokens = run.input_tokens, run.output_tokens
+        response = await invoke_streaming(model, input_messages, run, router.model_for(decision.tier))
+        router.record(
+            decision,
+            time.monotonic() - started,
+            run.input_tokens - input_tokens,
+            run.output_tokens - output_tokens,
+        )
+        if not router.should_escalate(decision, response):
+            return response
+        decision = decision.escalated()
+
+
+def unanswered_tool_calls(messages: Sequence[BaseMessage]) -> list[ToolCall]:
+    """最后一个带工具调用的 AIMessage 中还没有对应 ToolMessage 的调用"""
+    answered: set[str] = set()
+    for message in reversed(messages):
+        if isinstance(message, ToolMessage):
+            answered.add(message.tool_call_id)
+        elif isinstance(message, AIMessage):
+            return [tool_call for tool_call in message.tool_calls if tool_call["id"] not in answered]
+    return []
+
+
+def add_messages(left: Sequence[BaseMessage], right: Sequence[BaseMessage]) -> list[BaseMessage]:
+    """按消息 ID 合并消息列表；langgraph 导入较慢，首次使用时才导入，启动时由 warm_up 在后台预先导入"""
+    from langgraph.graph import add_messages as merge
+
+    return merge(list(left), list(right))
 
 
 async def agent_stream_core(
-    model: Runnable[LanguageModelInput, AIMessage], messages: list[BaseMessage]
+    model: Runnable[LanguageModelInput, AIMessage],
+    messages: list[BaseMessage],
+    run: Optional[AgentRun] = None,
+    router: Optional[ModelRouter] = None,
+    checkpoint: Sequence[BaseMessage] = (),
 ) -> AsyncIterator[BaseMessage]:
-    new_messages: list[BaseMessage] = []
+    """
+    agent 循环：调用模型，执行工具调用，直到模型给出最终回答
+
+    checkpoint 为同一次生成中已经完成的步骤，从其后继续，不再重复调用模型和已完成的工具。
+    """
+    run = run or AgentRun()
+    new_messages: list[BaseMessage] = list(checkpoint)
+    if new_messages:
+        last = new_messages[-1]
+        if isinstance(last, AIMessage) and not last.tool_calls:
+            return
+        pending = unanswered_tool_calls(new_messages)
+        if pending:
+            tool_results = await execute_tool_calls(pending)
+            for tool_result in tool_results:
+                yield tool_result
+            new_messages = add_messages(new_messages, tool_results)
     while True:
         input_messages = add_messages(
             [
                 SystemMessage(
-                    content="你是一个手机推荐助手，根据用户的需求，使用search_phones tool从数据库中搜索手机信息，并返回给用户。注意只能推荐数据库里的手机，不能推荐其他手机。"
+                    content=SYSTEM_PROMPT
                 )
             ],
             messages + new_messages,
         )
-        model_response = await model.ainvoke(input_messages)
+        if run.budget is not None:
+            run.budget.check(run.total_tokens, run.model_calls)
+        if router is not None:
+            model_response = await invoke_routed(model, input_messages, run, router)
+        else:
+            model_response = await invoke_streaming(model, input_messages, run)
         yield model_response
         if not model_response.tool_calls:
             break
 
         # Execute tools
-        tool_results = [await call_tool(tool_call) for tool_call in model_response.tool_calls]
+        tool_results = await execute_tool_calls(model_response.tool_calls)
         for tool_result in tool_results:
             yield tool_result
         new_messages = add_messages(new_messages, [model_response, *tool_results])
@@ -82,19 +268,25 @@ class LLMService:
     """LLM 服务"""
 
     def __init__(self) -> None:
-        client_kwargs: Dict[str, Any] = {
-            "model": settings.openai_model,
-            "temperature": 0.7,
-            "streaming": True,
-            "api_key": settings.openai_api_key,
-        }
-        if settings.openai_api_base:
-            client_kwargs["base_url"] = settings.openai_api_base
-
-        self.llm = ChatOpenAI(**client_kwargs)
+        self.llm = LLMBackendPool.from_settings()
         self.tools: List[BaseTool] = []
-        self.llm_with_tools = self.llm
-        logger.info("Initialized ChatOpenAI model %s", settings.openai_model)
+        self.llm_with_tools: Any = self.llm
+        self._tool_schemas: Optional[List[Dict[str, Any]]] = None
+        self._warm_up: Optional[asyncio.Future] = None
+        self.flights: SingleFlight[SharedStep] = SingleFlight("llm")
+        # 每次生成 token 数的指数移动平均，用于估算取消节省的用量和排队预算
+        self.expected_output_tokens = 0.0
+        self.expected_total_tokens = 0.0
+        self.scheduler = GenerationScheduler()
+        self.router = ModelRouter()
+        if self.router.enabled:
+            logger.info(
+                "Initialized LLM service with model routing: small=%s, large=%s",
+                self.router.small_model,
+                self.router.large_model,
+            )
+        else:
+            logger.info("Initialized LLM service with model %s", settings.openai_model)
 
     def bind_tools(self, tools: List[BaseTool]) -> None:
         """
@@ -104,9 +296,50 @@ class LLMService:
             tools: 工具列表
         """
         self.tools = tools
+        self._tool_schemas = None
         self.llm_with_tools = self.llm.bind_tools(tools)
         logger.info("Bound %d tools to LLM: %s", len(tools), [t.name for t in tools])
 
+    @property
+    def tool_schemas(self) -> List[Dict[str, Any]]:
+        if self._tool_schemas is None:
+            from langchain_core.utils.function_calling import convert_to_openai_tool
+
+            self._tool_schemas = [convert_to_openai_tool(tool) for tool in self.tools]
+        return self._tool_schemas
+
+    def warm_up(self) -> None:
+        """构建模型客户端和工具 schema，并导入 langgraph；耗时较长，在后台线程中执行"""
+        started = time.perf_counter()
+        self.llm.warm_up()
+        schemas = self.tool_schemas
+        add_messages([], [])
+        logger.info("LLM service warmed up in %.2fs (%d tool schemas)", time.perf_counter() - started, len(schemas))
+
+    def start_warm_up(self) -> None:
+        """启动时调用，后台预热，不阻塞启动"""
+        if self._warm_up is None:
+            self._warm_up = asyncio.ensure_future(asyncio.to_thread(self.warm_up))
+            self._warm_up.add_done_callback(self._warm_up_done)
+
+    def _warm_up_done(self, future: asyncio.Future) -> None:
+        """预热失败时记录日志并清空，下次使用时重新预热"""
+        if future.cancelled():
+            error: Optional[BaseException] = asyncio.CancelledError()
+        else:
+            error = future.exception()
+        if error is None:
+            return
+        logger.error("LLM warm-up failed, will retry on next use: %r", error)
+        if self._warm_up is future:
+            self._warm_up = None
+
+    async def ensure_ready(self) -> None:
+        """首次使用前等待预热完成，避免在事件循环中同步导入"""
+        self.start_warm_up()
+        assert self._warm_up is not None
+        await asyncio.shield(self._warm_up)
+
     async def chat_stream(
         self,
         messages: list[BaseMessage],
@@ -122,6 +355,7 @@ class LLMService:
         Yields:
             str: 流式返回的文本片段
         """
+        await self.ensure_ready()
         llm = self.llm_with_tools
 
         # 首次调用 LLM - 累积所有 chunks
@@ -222,27 +456,161 @@ class LLMService:
                 if content:
                     yield content
 
-    async def agent_stream(self, messages: list[BaseMessage]) -> AsyncIterator[BaseMessage]:
-        async for message in agent_stream_core(self.llm_with_tools, messages):
+    async def agent_stream(
+        self,
+        messages: list[BaseMessage],
+        run: Optional[AgentRun] = None,
+        checkpoint: Sequence[BaseMessage] = (),
+    ) -> AsyncIterator[BaseMessage]:
+        """
+        运行 agent 循环，只产出 checkpoint 之后的新步骤
+
+        规范化后相同的并发请求只运行一次，输出分发给所有调用方；
+        共享执行的模型调用按步骤计入每个调用方的 run，并按各自的预算检查。
+        """
+        await self.ensure_ready()
+        key = self.request_key([*messages, *checkpoint])
+        if not settings.single_flight_enabled:
+            async for message in self._agent_stream(messages, key, run, checkpoint):
+                yield message
+            return
+
+        charged = AgentRun()
+        shared: Optional[AgentRun] = None
+        try:
+            async for step in self.flights.stream(key, lambda: self._shared_agent_stream(messages, key, checkpoint)):
+                shared = step.run
+                if run is not None:
+                    charge_shared_step(run, step, charged)
+                yield step.message
+        finally:
+            # 已读到共享执行的最新步骤时，未完成的模型输出属于这个调用方的下一步
+            if run is not None and shared is not None and shared.model_calls == charged.model_calls:
+                run.partial = shared.partial
+
+    async def _shared_agent_stream(
+        self, messages: list[BaseMessage], key: str, checkpoint: Sequence[BaseMessage]
+    ) -> AsyncIterator[SharedStep]:
+        """共享执行：用量记在独立的 run 上，不带预算，每个步骤附带当时的累计用量"""
+        run = AgentRun()
+        async for message in self._agent_stream(messages, key, run, checkpoint):
+            yield SharedStep(message, replace(run, partial=None), run)
+
+    async def _agent_stream(
+        self,
+        messages: list[BaseMessage],
+        key: str,
+        run: Optional[AgentRun],
+        checkpoint: Sequence[BaseMessage],
+    ) -> AsyncIterator[BaseMessage]:
+        """开启响应缓存时，命中则直接回放缓存的完整消息序列；未命中时正常生成，完整结束后写入缓存"""
+        if not response_cache.enabled:
+            async for message in agent_stream_core(self.llm_with_tools, messages, run, self.router, checkpoint):
+                yield message
+            return
+
+        catalog_version = await phone_service.catalog_version()
+        cached = await response_cache.get(key, catalog_version)
+        if cached is not None:
+            logger.info("Replaying cached response %s", key[:12])
+            async for message in response_cache.replay(cached):
+                yield message
+            return
+
+        produced: list[BaseMessage] = []
+        async for message in agent_stream_core(self.llm_with_tools, messages, run, self.router, checkpoint):
+            produced.append(message)
             yield message
+        await response_cache.put(key, catalog_version, produced)
+
+    def request_key(self, messages: list[BaseMessage]) -> str:
+        """模型、系统提示词、工具定义和规范化后的对话历史共同决定请求键"""
+        return cache_key(
+            {
+                "models": [settings.openai_model, self.router.small_model, self.router.large_model],
+                "backends": [backend.model for backend in settings.llm_backends],
+                "system": SYSTEM_PROMPT,
+                "tools": self.tool_schemas,
+                "messages": [normalize_message(message) for message in messages],
+            }
+        )
+
+    async def aclose(self) -> None:
+        """关闭后端池共享的 HTTP 连接和响应缓存"""
+        await self.llm.aclose()
+        response_cache.close()
+
+    def record_completed_run(self, run: AgentRun) -> None:
+        """记录一次完整生成的输出 token 数"""
+        if not run.output_tokens:
+            return
+        if not self.expected_output_tokens:
+            self.expected_output_tokens = float(run.output_tokens)
+            self.expected_total_tokens = float(run.total_tokens)
+        else:
+            self.expected_output_tokens = 0.9 * self.expected_output_tokens + 0.1 * run.output_tokens
+            self.expected_total_tokens = 0.9 * self.expected_total_tokens + 0.1 * run.total_tokens
+
+    def estimate_generation_tokens(self) -> int:
+        """排队时预占的 token 数，结束后按实际用量修正"""
+        return round(self.expected_total_tokens) or settings.llm_estimated_tokens_per_generation
+
+    def estimate_tokens_saved(self, run: AgentRun) -> int:
+        """按历史平均值估算被取消的生成还会产生多少输出 token"""
+        return max(0, round(self.expected_output_tokens) - run.output_tokens)
+
+    def format_checkpoint(self, steps: list[dict]) -> list[BaseMessage]:
+        """
+        把一次生成已完成的步骤转换为 LangChain 消息，用于断点续跑
+
+        与 format_messages 不同，保留还没有结果的工具调用，续跑时由 unanswered_tool_calls 补执行；
+        只有文本、没有工具调用的 assistant 步骤才表示生成已给出最终回答。
+        """
+        formatted: list[BaseMessage] = []
+        for msg in steps:
+            if msg["role"] == "assistant":
+                tool_calls = [
+                    ToolCall(name=call["name"], args=call["args"], id=call["id"])
+                    for call in msg.get("tool_calls") or []
+                ]
+                formatted.append(AIMessage(content=msg["content"], tool_calls=tool_calls))
+            elif msg["role"] == "tool":
+                formatted.append(ToolMessage(content=msg["content"], tool_call_id=msg["tool_call_id"]))
+        return formatted
 
     def format_messages(self, history: list[dict]) -> list[BaseMessage]:
         """
         格式化消息历史为 LangChain 消息格式
 
+        没有对应 ToolMessage 的工具调用（生成中断时留下的）会被去掉，
+        没有对应工具调用的 ToolMessage 也会被跳过，否则模型接口会拒绝这段历史。
+        生成中断时保存的未完成输出（partial）不是完整回答，不发给模型。
+
         Args:
-            history: 消息历史列表，每个元素包含 role 和 content
+            history: 消息历史列表，每个元素包含 role 和 content，
+                assistant 消息可带 tool_calls，tool 消息带 tool_call_id
 
         Returns:
             list[BaseMessage]: LangChain 消息列表
         """
-        formatted = []
+        answered = {msg.get("tool_call_id") for msg in history if msg["role"] == "tool"}
+        requested: set[str] = set()
+        formatted: list[BaseMessage] = []
         for msg in history:
+            if msg.get("partial"):
+                continue
             if msg["role"] == "user":
                 formatted.append(HumanMessage(content=msg["content"]))
             elif msg["role"] == "assistant":
-                formatted.append(AIMessage(content=msg["content"]))
-            elif msg["role"] == "tool":
+                tool_calls = [
+                    ToolCall(name=call["name"], args=call["args"], id=call["id"])
+                    for call in msg.get("tool_calls") or []
+                    if call["id"] in answered
+                ]
+                requested.update(call["id"] for call in tool_calls)
+                if msg["content"] or tool_calls:
+                    formatted.append(AIMessage(content=msg["content"], tool_calls=tool_calls))
+            elif msg["role"] == "tool" and msg.get("tool_call_id") in requested:
                 formatted.append(ToolMessage(content=msg["content"], tool_call_id=msg["tool_call_id"]))
         return formatted
 
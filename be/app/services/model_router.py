@@ -0,0 +1,109 @@
+"""模型分级路由 - 按 agent 步骤类型、对话长度和本地意图分类选择小模型或大模型"""
+
+import logging
+import re
+from dataclasses import dataclass, replace
+from typing import List, Optional, Sequence, Tuple
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage
+
+from app.config import settings
+from app.metrics import registry
+
+logger = logging.getLogger("app.model_router")
+
+STEPS = registry.counter("llm_router_steps_total", "Agent steps by model tier, step type and routing reason")
+ESCALATIONS = registry.counter("llm_router_escalations_total", "Small-model steps re-run on the large model")
+STEP_LATENCY = registry.histogram("llm_step_seconds", "Model call duration per agent step by tier")
+STEP_TOKENS = registry.counter("llm_step_tokens_total", "Tokens used per model tier, split into input and output")
+
+SMALL = "small"
+LARGE = "large"
+
+# 工具选择：根据用户请求决定是否调用工具及参数；回答：拿到工具结果后撰写推荐
+STEP_TOOL_SELECTION = "tool_selection"
+STEP_ANSWER = "answer"
+
+# (特征, 权重)，正分表示可以直接落到搜索参数上的请求，负分表示需要比较、解释等推理
+_INTENT_FEATURES: List[Tuple[re.Pattern, float]] = [
+    (re.compile(r"\d+\s*(元|块|k|千|w|万)|预算|价位|以内|以下|左右", re.IGNORECASE), 2.0),
+    (re.compile(r"推荐|想要|想买|找|搜|有没有|来一款|给我"), 1.5),
+    (re.compile(r"续航|电池|拍照|影像|游戏|屏幕|内存|存储|快充|轻薄|性价比"), 1.0),
+    (re.compile(r"华为|小米|红米|苹果|iphone|oppo|vivo|荣耀|三星|一加|realme|魅族|iqoo", re.IGNORECASE), 1.0),
+    (re.compile(r"为什么|区别|对比|比较|哪个好|哪款更|优缺点|值不值|分析|解释|怎么样|\bvs\b", re.IGNORECASE), -3.0),
+]
+SEARCH_INTENT_THRESHOLD = 1.5
+
+
+def search_intent_score(text: str) -> float:
+    """对用户请求打分，分数越高越像可以直接转换为搜索参数的请求"""
+    return sum(weight for pattern, weight in _INTENT_FEATURES if pattern.search(text))
+
+
+def _text(message: BaseMessage) -> str:
+    content = message.content
+    if isinstance(content, str):
+        return content
+    return "".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in content)
+
+
+@dataclass(frozen=True)
+class RouteDecision:
+    """一个 agent 步骤的路由结果"""
+
+    tier: str
+    step: str
+    reason: str
+
+    def escalated(self) -> "RouteDecision":
+        return replace(self, tier=LARGE, reason="escalated")
+
+
+class ModelRouter:
+    """
+    模型路由器
+
+    工具选择和参数抽取交给小模型，最终回答保留给大模型；对话过长或分类器判断需要推理时，
+    工具选择也直接使用大模型。小模型没有调用工具而是想直接回答时，改由大模型重新生成该步骤。
+    """
+
+    def __init__(self) -> None:
+        self.small_model = settings.llm_small_model
+        self.large_model = settings.llm_large_model or settings.openai_model
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.small_model)
+
+    def model_for(self, tier: str) -> Optional[str]:
+        """返回该级别的模型名；未启用路由时返回 None，沿用后端自身配置的模型"""
+        if not self.enabled:
+            return None
+        return self.small_model if tier == SMALL else self.large_model
+
+    def route(self, messages: Sequence[BaseMessage]) -> RouteDecision:
+        conversation = [message for message in messages if not isinstance(message, SystemMessage)]
+        last = conversation[-1] if conversation else None
+        if isinstance(last, ToolMessage):
+            return RouteDecision(tier=LARGE, step=STEP_ANSWER, reason="answer")
+        if not self.enabled:
+            return RouteDecision(tier=LARGE, step=STEP_TOOL_SELECTION, reason="disabled")
+        if len(conversation) > settings.llm_router_max_history_messages:
+            return RouteDecision(tier=LARGE, step=STEP_TOOL_SELECTION, reason="long_history")
+        if not isinstance(last, HumanMessage) or search_intent_score(_text(last)) < SEARCH_INTENT_THRESHOLD:
+            return RouteDecision(tier=LARGE, step=STEP_TOOL_SELECTION, reason="classifier")
+        return RouteDecision(tier=SMALL, step=STEP_TOOL_SELECTION, reason="classifier")
+
+    def should_escalate(self, decision: RouteDecision, response: AIMessage) -> bool:
+        """小模型给出的是最终回答而不是工具调用时，交给大模型重新生成"""
+        if decision.tier != SMALL or response.tool_calls or not settings.llm_router_escalate_on_answer:
+            return False
+        ESCALATIONS.inc()
+        logger.info("Small model answered without tool calls, escalating to %s", self.large_model)
+        return True
+
+    def record(self, decision: RouteDecision, seconds: float, input_tokens: int, output_tokens: int) -> None:
+        STEPS.inc(tier=decision.tier, step=decision.step, reason=decision.reason)
+        STEP_LATENCY.observe(seconds, tier=decision.tier)
+        STEP_TOKENS.inc(input_tokens, tier=decision.tier, kind="input")
+        STEP_TOKENS.inc(output_tokens, tier=decision.tier, kind="output")
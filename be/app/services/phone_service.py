@@ -1,42 +1,609 @@
 from __future__ import annotations
 
+import asyncio
+import base64
+import json
 import logging
-from datetime import datetime
-from typing import Any, Dict, List, Optional
+import math
+import re
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
 
-from motor.motor_asyncio import AsyncIOMotorCollection
+from bson import ObjectId
+from pymongo import ReadPreference, UpdateOne
+from pymongo.errors import OperationFailure, PyMongoError
 
+from app.config import settings
 from app.database import get_phones_collection
-from app.models import Phone, PhoneSearchParams, PhoneSku
+from app.metrics import registry
+from app.models import (
+    FacetBucket,
+    HistogramBucket,
+    Phone,
+    PhoneBulkUpsertResult,
+    PhoneFacetResult,
+    PhonePage,
+    PhoneSearchParams,
+    PhoneSku,
+    PhoneUpsert,
+)
+from app.repository import Repository
+from app.services.catalog_snapshot import catalog_snapshots
+from app.services.skyline_service import PRICE_BANDS, skyline_service
+from app.utils.cache import TTLCache
+from app.utils.singleflight import SingleFlight
 
 logger = logging.getLogger("app.phone_service")
 
+PRICE_HISTOGRAM_BOUNDARIES: List[float] = [low for low, _ in PRICE_BANDS] + [math.inf]
+BATTERY_HISTOGRAM_BOUNDARIES: List[float] = [0, 4000, 4500, 5000, 5500, 6000, math.inf]
+FACET_LIMIT = 20
+PHONE_FIELDS = frozenset(name for name in Phone.model_fields if name != "id")
+
+PREFETCH_HITS = registry.counter(
+    "phone_search_prefetch_hits_total", "Searches answered by an entry warmed by the prefetcher, by heuristic"
+)
+SYNC_CHANGES = registry.counter("catalog_sync_changes_total", "Catalog changes applied by the sync, by source and operation")
+SYNC_RESYNCS = registry.counter("catalog_sync_resyncs_total", "Full catalog reloads triggered by the sync, by reason")
+
+CHANGE_STREAM_HISTORY_LOST = 286
+CHANGE_STREAM_NOT_SUPPORTED = 40573
+
+
+def search_params_key(params: PhoneSearchParams) -> str:
+    """搜索参数的规范化键，语义相同的参数得到相同的键"""
+    normalized = params.model_copy(
+        update={
+            "keyword": params.keyword.strip() if params.keyword else None,
+            "brand": params.brand.strip() if params.brand else None,
+            "tags": sorted({tag.strip() for tag in params.tags if tag.strip()}),
+            "ram": params.ram.strip() if params.ram else None,
+            "storage": params.storage.strip() if params.storage else None,
+        }
+    )
+    return normalized.model_dump_json()
+
+
+@dataclass
+class _CachedSearch:
+    """搜索缓存条目；由预取写入时记录所用的启发式，首次命中时计入预取命中"""
+
+    params: PhoneSearchParams
+    phones: List[Phone]
+    heuristic: Optional[str] = None
+    used: bool = False
+
+
+class InvalidCursorError(ValueError):
+    """分页游标无法解析"""
+
+
+def _to_millis(value: datetime) -> int:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp() * 1000)
+
+
+def encode_cursor(doc: Dict[str, Any]) -> str:
+    """用排序键 (updated_at, _id) 生成不透明的分页游标"""
+    payload = json.dumps({"u": _to_millis(doc["updated_at"]), "i": str(doc["_id"])}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, ObjectId]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        updated_at = datetime.fromtimestamp(payload["u"] / 1000, tz=timezone.utc)
+        return updated_at, ObjectId(payload["i"])
+    except Exception as e:
+        raise InvalidCursorError(cursor) from e
+
+
+def document_matches(query: Dict[str, Any], doc: Dict[str, Any]) -> bool:
+    """
+    在内存中判断文档是否满足查询
+
+    只实现 build_search_query 用到的操作符；遇到不支持的操作符时保守地视为匹配。
+    """
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(document_matches(clause, doc) for clause in condition):
+                return False
+        elif not _value_matches(doc.get(field), condition):
+            return False
+    return True
+
+
+def _value_matches(value: Any, condition: Any) -> bool:
+    values = value if isinstance(value, list) else [value]
+    if not isinstance(condition, dict):
+        return condition in values
+    for operator, operand in condition.items():
+        if operator == "$options":
+            continue
+        if operator == "$regex":
+            try:
+                pattern = re.compile(operand, re.IGNORECASE if "i" in condition.get("$options", "") else 0)
+            except re.error:
+                return True
+            if not any(isinstance(item, str) and pattern.search(item) for item in values):
+                return False
+        elif operator == "$all":
+            if not set(operand).issubset(values):
+                return False
+        elif operator == "$gte":
+            if not any(item is not None and item >= operand for item in values):
+                return False
+        elif operator == "$lte":
+            if not any(item is not None and item <= operand for item in values):
+                return False
+        elif operator == "$elemMatch":
+            if not any(isinstance(item, dict) and document_matches(operand, item) for item in values):
+                return False
+        else:
+            return True
+    return True
+
 
 class PhoneService:
-    """手机数据服务，仅提供查询功能供 LLM 工具使用。"""
+    """手机数据服务"""
 
     def __init__(self) -> None:
-        self._collection: Optional[AsyncIOMotorCollection] = None
+        self._collection: Optional[Repository] = None
+        self._catalog_version: Optional[str] = None
+        self._catalog_version_at = 0.0
+        self.catalog_epoch = 0
+        self._search_flights: SingleFlight[List[Phone]] = SingleFlight("phone_search")
+        self._search_cache: TTLCache[str, _CachedSearch] = TTLCache(
+            "phone_search",
+            settings.phone_search_cache_max_entries,
+            settings.phone_search_cache_ttl_seconds,
+        )
 
     @property
-    def collection(self) -> AsyncIOMotorCollection:
+    def collection(self) -> Repository:
         if self._collection is None:
             self._collection = get_phones_collection()
         return self._collection
 
+    async def catalog_version(self) -> str:
+        """
+        目录版本号，由文档数量和最近的 updated_at 派生
+
+        多个 worker 得到的版本一致，可直接用于强 ETag；短时间内复用计算结果。
+        """
+        age = time.monotonic() - self._catalog_version_at
+        if self._catalog_version is not None and age < settings.catalog_version_ttl_seconds:
+            return self._catalog_version
+
+        count = await self.collection.count_documents({})
+        latest = await self.collection.find_one({}, {"updated_at": 1}, sort=[("updated_at", -1)])
+        latest_millis = _to_millis(latest["updated_at"]) if latest else 0
+        self._catalog_version = f"{count}-{latest_millis}"
+        self._catalog_version_at = time.monotonic()
+        return self._catalog_version
+
+    async def list_phones(
+        self,
+        limit: int = 20,
+        cursor: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+        brand: Optional[str] = None,
+        tag: Optional[str] = None,
+    ) -> PhonePage:
+        """
+        按 (updated_at, _id) 倒序的 keyset 分页
+
+        Raises:
+            InvalidCursorError: 游标无法解析
+        """
+        query: Dict[str, Any] = {}
+        if brand:
+            query["brand"] = brand
+        if tag:
+            query["tags"] = tag
+        if cursor:
+            updated_at, last_id = decode_cursor(cursor)
+            query["$or"] = [
+                {"updated_at": {"$lt": updated_at}},
+                {"updated_at": updated_at, "_id": {"$lt": last_id}},
+            ]
+
+        projection = self._projection(fields, required=("updated_at",))
+        docs = (
+            await self.collection.find(query, projection)
+            .sort([("updated_at", -1), ("_id", -1)])
+            .limit(limit + 1)
+            .to_list(length=limit + 1)
+        )
+        next_cursor = encode_cursor(docs[limit - 1]) if len(docs) > limit else None
+        items = [self._public_doc(doc, fields) for doc in docs[:limit]]
+        return PhonePage(items=items, next_cursor=next_cursor)
+
+    async def get_phone(self, phone_id: str, fields: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        """按 ID 获取手机，ID 不合法时视为不存在"""
+        if not ObjectId.is_valid(phone_id):
+            return None
+        doc = await self.collection.find_one({"_id": ObjectId(phone_id)}, self._projection(fields))
+        return self._public_doc(doc, fields) if doc else None
+
+    @staticmethod
+    def _projection(fields: Optional[List[str]], required: tuple[str, ...] = ()) -> Optional[Dict[str, int]]:
+        if not fields:
+            return None
+        return {field: 1 for field in (*fields, *required)}
+
+    @staticmethod
+    def _public_doc(doc: Dict[str, Any], fields: Optional[List[str]]) -> Dict[str, Any]:
+        """转换为可 JSON 序列化的文档，只保留请求的字段"""
+        if not fields:
+            return Phone.model_validate(doc).py(mode="json")
+        public: Dict[str, Any] = {"_id": str(doc["_id"])}
+        for field in fields:
+            if field in doc:
+                value = doc[field]
+                public[field] = value.isoformat() if isinstance(value, datetime) else value
+        return public
+
     async def search_phones(self, params: PhoneSearchParams) -> List[Phone]:
-        """按照参数搜索手机列表"""
-        query = self._build_search_query(params)
+        """按照参数搜索手机列表，结果短时间缓存；相同参数的并发搜索只查询一次数据库"""
+        key = search_params_key(params)
+        cached = self._cached_search(key)
+        if cached is not None:
+            return cached
+        return await self._search_uncached(key, params)
+
+    def peek_search(self, params: PhoneSearchParams) -> Optional[List[Phone]]:
+        """读取搜索缓存，不计入命中统计"""
+        entry = self._search_cache.peek(search_params_key(params))
+        return list(entry.phones) if entry is not None else None
+
+    async def prefetch_search(self, params: PhoneSearchParams, heuristic: str) -> bool:
+        """
+        预取搜索结果写入缓存，已缓存或正在查询时跳过
+
+        Returns:
+            bool: 是否实际执行了查询
+        """
+        key = search_params_key(params)
+        if self._search_cache.peek(key) is not None or self._search_flights.in_flight(key):
+            return False
+        epoch = self.catalog_epoch
+        phones = await self._search_phones(params, max_time_ms=settings.prefetch_max_time_ms)
+        if self._search_cache.peek(key) is None:
+            self._cache_search(key, _CachedSearch(params, phones, heuristic=heuristic), epoch)
+        return True
+
+    def invalidate_search_cache(self) -> None:
+        """目录数据变化后清空搜索缓存"""
+        self._search_cache.clear()
+
+    def catalog_changed(
+        self,
+        docs: Iterable[Dict[str, Any]] = (),
+        removed_ids: Iterable[str] = (),
+        full: bool = False,
+    ) -> int:
+        """
+        目录发生变化：递增进程内的目录纪元，下次读取目录版本时重新计算，并失效受影响的搜索缓存
+
+        结果中包含变化手机的条目，以及查询条件能匹配变化后文档的条目会被删除；full 时清空全部缓存。
+        变化前开始、变化后才完成的查询通过纪元判断，结果不会写入缓存。
+
+        Returns:
+            int: 失效的缓存条目数
+        """
+        self.catalog_epoch += 1
+        self._catalog_version_at = 0.0
+        if full:
+            invalidated = len(self._search_cache)
+            self.invalidate_search_cache()
+            return invalidated
+
+        docs = list(docs)
+        phone_ids = {str(doc["_id"]) for doc in docs} | set(removed_ids)
+        stale = [
+            key
+            for key, entry in self._search_cache.items()
+            if any(str(phone.id) in phone_ids for phone in entry.phones)
+            or any(document_matches(self._invalidation_query(entry.params), doc) for doc in docs)
+        ]
+        for key in stale:
+            self._search_cache.pop(key)
+        return len(stale)
+
+    def _invalidation_query(self, params: PhoneSearchParams) -> Dict[str, Any]:
+        # best_value 结果由 skyline 决定，只受标签和价格区间影响
+        if params.best_value:
+            params = PhoneSearchParams(tags=params.tags, min_price=params.min_price, max_price=params.max_price)
+        return self.build_search_query(params)
+
+    async def bulk_upsert(self, items: Sequence[PhoneUpsert]) -> PhoneBulkUpsertResult:
+        """
+        按 SKU 粒度批量写入
+
+        每款手机先写入提供的手机级字段（按 brand + model 定位且不存在时新建），
+        再对每个 SKU 依次执行“已存在则只更新提供的字段”和“不存在则追加”两个操作；
+        全部操作放入一次有序 bulk_write，出错时后续操作不再执行。
+        写入后增量更新 skyline，并只失效受影响的搜索缓存条目。
+
+        Raises:
+            BulkWriteError: 某个操作失败，之前的操作已生效
+            PyMongoError: 写入成功但读回受影响的手机失败
+        """
+        now = datetime.now(timezone.utc)
+        operations: List[UpdateOne] = []
+        phone_filters: List[Dict[str, Any]] = []
+        for item in items:
+            fields = item.model_dump(exclude_unset=True, exclude={"phone_id", "skus"})
+            update: Dict[str, Any] = {"$set": {**fields, "updated_at": now}}
+            if item.phone_id is not None:
+                phone_filter: Dict[str, Any] = {"_id": ObjectId(item.phone_id)}
+            else:
+                phone_filter = {"brand": item.brand, "model": item.model}
+                defaults = {"created_at": now, "tags": [], "features": [], "specs": {}, "skus": []}
+                update["$setOnInsert"] = {key: value for key, value in defaults.items() if key not in fields}
+            phone_filters.append(phone_filter)
+            operations.append(UpdateOne(phone_filter, update, upsert=item.phone_id is None))
+
+            for sku in item.skus:
+                values = sku.model_dump(exclude_unset=True)
+                sku_fields = {f"skus.$.{key}": value for key, value in values.items() if key != "sku_id"}
+                if sku_fields:
+                    operations.append(
+                        UpdateOne({**phone_filter, "skus.sku_id": sku.sku_id}, {"$set": {**sku_fields, "updated_at": now}})
+                    )
+                new_sku = PhoneSku.model_validate({key: value for key, value in values.items() if value is not None})
+                operations.append(
+                    UpdateOne(
+                        {**phone_filter, "skus.sku_id": {"$ne": sku.sku_id}},
+                        {"$push": {"skus": new_sku.model_dump()}, "$set": {"updated_at": now}},
+                    )
+                )
+
+        docs: List[Dict[str, Any]] = []
+        read_error: Optional[PyMongoError] = None
+        try:
+            result = await self.collection.bulk_write(operations, ordered=True)
+        finally:
+            # 出错时之前的操作已经生效，同样需要刷新；从主节点读取，目录读偏好为从节点时也能读到刚写入的数据
+            try:
+                primary = self.collection.with_options(read_preference=ReadPreference.PRIMARY)
+                docs = await primary.find({"$or": phone_filters}).to_list(length=None)
+            except PyMongoError as e:
+                # 不能掩盖写入时的错误；无法确定变化了哪些手机，失效全部搜索缓存，skyline 由同步任务或定期刷新补上
+                logger.warning("Failed to read back phones after bulk upsert: %s", e)
+                read_error = e
+                invalidated = self.catalog_changed(full=True)
+            else:
+                for doc in docs:
+                    skyline_service.apply_phone_change(doc)
+                invalidated = self.catalog_changed(docs)
+        if read_error is not None:
+            raise read_error
+
+        found = {str(doc["_id"]) for doc in docs}
+        logger.info(
+            "Bulk upsert of %d phones (%d operations), invalidated %d cached searches",
+            len(items),
+            len(operations),
+            invalidated,
+        )
+        return PhoneBulkUpsertResult(
+            matched=result.matched_count,
+            modified=result.modified_count,
+            upserted=result.upserted_count,
+            phone_ids=sorted(found),
+            not_found=[item.phone_id for item in items if item.phone_id is not None and item.phone_id not in found],
+            invalidated=invalidated,
+        )
+
+    def _cache_search(self, key: str, entry: _CachedSearch, epoch: int) -> None:
+        if epoch == self.catalog_epoch:
+            self._search_cache.set(key, entry)
+
+    def _cached_search(self, key: str) -> Optional[List[Phone]]:
+        entry = self._search_cache.get(key)
+        if entry is None:
+            return None
+        if entry.heuristic is not None and not entry.used:
+            entry.used = True
+            PREFETCH_HITS.inc(heuristic=entry.heuristic)
+        return list(entry.phones)
+
+    async def _search_uncached(self, key: str, params: PhoneSearchParams) -> List[Phone]:
+        if not settings.single_flight_enabled:
+            return list(await self._search_and_cache(key, params))
+        return list(await self._search_flights.call(key, lambda: self._search_and_cache(key, params)))
+
+    async def _search_and_cache(self, key: str, params: PhoneSearchParams) -> List[Phone]:
+        epoch = self.catalog_epoch
+        phones = await self._search_phones(params)
+        self._cache_search(key, _CachedSearch(params, phones), epoch)
+        return phones
+
+    async def _search_phones(self, params: PhoneSearchParams, max_time_ms: Optional[int] = None) -> List[Phone]:
+        if params.best_value:
+            return await self.search_best_value(params)
+
+        query = self.build_search_query(params)
         logger.debug("Phone search query: %s", query)
 
         cursor = self.collection.find(query).sort("updated_at", -1).limit(params.limit)
+        if max_time_ms:
+            cursor = cursor.max_time_ms(max_time_ms)
 
         results: List[Phone] = []
         async for doc in cursor:
             results.append(Phone.model_validate(doc))
         return results
 
-    def _build_search_query(self, params: PhoneSearchParams) -> Dict[str, Any]:
+    async def search_phones_batch(self, params_list: List[PhoneSearchParams]) -> List[List[Phone]]:
+        """批量搜索，相同的搜索参数只执行一次，其余合并为一次数据库查询"""
+        return await self.search_phones_many(params_list)
+
+    async def search_phones_many(self, params_list: List[PhoneSearchParams]) -> List[List[Phone]]:
+        """
+        一次数据库往返执行多组搜索
+
+        外层用各查询的 $or 缩小扫描范围，再用 $facet 为每组参数分别排序、截断，
+        结果与 params_list 一一对应。best_value 查询走 skyline，不参与合并。
+        """
+        unique: Dict[str, PhoneSearchParams] = {}
+        keys: List[str] = []
+        for params in params_list:
+            key = search_params_key(params)
+            unique.setdefault(key, params)
+            keys.append(key)
+
+        results_by_key: Dict[str, List[Phone]] = {}
+        for key in unique:
+            cached = self._cached_search(key)
+            if cached is not None:
+                results_by_key[key] = cached
+        pending = {key: params for key, params in unique.items() if key not in results_by_key}
+
+        mergeable = {key: params for key, params in pending.items() if not params.best_value}
+        for key, params in pending.items():
+            if params.best_value:
+                results_by_key[key] = await self.search_best_value(params)
+
+        if len(mergeable) == 1:
+            (key, params), = mergeable.items()
+            results_by_key[key] = await self._search_uncached(key, params)
+        elif mergeable:
+            epoch = self.catalog_epoch
+            merged = await self._search_merged(mergeable)
+            for key, phones in merged.items():
+                self._cache_search(key, _CachedSearch(mergeable[key], phones), epoch)
+            results_by_key.update(merged)
+
+        logger.debug("Merged search: %d queries, %d unique", len(params_list), len(unique))
+        return [results_by_key[key] for key in keys]
+
+    async def _search_merged(self, params_by_key: Dict[str, PhoneSearchParams]) -> Dict[str, List[Phone]]:
+        queries = {key: self.build_search_query(params) for key, params in params_by_key.items()}
+        facet_names = {key: f"q{index}" for index, key in enumerate(queries)}
+
+        pipeline: List[Dict[str, Any]] = []
+        if all(queries.values()):
+            pipeline.append({"$match": {"$or": list(queries.values())}})
+        pipeline.append(
+            {
+                "$facet": {
+                    facet_names[key]: [
+                        {"$match": query},
+                        {"$sort": {"updated_at": -1}},
+                        {"$limit": params_by_key[key].limit},
+                    ]
+                    for key, query in queries.items()
+                }
+            }
+        )
+        logger.debug("Merged phone search pipeline: %s", pipeline)
+
+        facets = (await self.collection.aggregate(pipeline))[0]
+        return {key: [Phone.model_validate(doc) for doc in facets[name]] for key, name in facet_names.items()}
+
+    async def facet_search(self, params: PhoneSearchParams) -> PhoneFacetResult:
+        """一次 $facet 聚合同时返回命中结果、分面计数和直方图"""
+        query = self.build_search_query(params)
+        pipeline = [
+            {"$match": query},
+            {
+                "$facet": {
+                    "hits": [{"$sort": {"updated_at": -1}}, {"$limit": params.limit}],
+                    "total": [{"$count": "count"}],
+                    "brands": [{"$sortByCount": "$brand"}, {"$limit": FACET_LIMIT}],
+                    "tags": [{"$unwind": "$tags"}, {"$sortByCount": "$tags"}, {"$limit": FACET_LIMIT}],
+                    "price": [
+                        {"$project": {"value": {"$min": "$skus.price"}}},
+                        {
+                            "$bucket": {
+                                "groupBy": "$value",
+                                "boundaries": PRICE_HISTOGRAM_BOUNDARIES,
+                                "default": "unknown",
+                            }
+                        },
+                    ],
+                    "battery": [
+                        {
+                            "$bucket": {
+                                "groupBy": "$battery",
+                                "boundaries": BATTERY_HISTOGRAM_BOUNDARIES,
+                                "default": "unknown",
+                            }
+                        },
+                    ],
+                }
+            },
+        ]
+        logger.debug("Phone facet pipeline: %s", pipeline)
+
+        facets = (await self.collection.aggregate(pipeline))[0]
+        total = facets["total"][0]["count"] if facets["total"] else 0
+        return PhoneFacetResult(
+            total=total,
+            hits=[Phone.model_validate(doc) for doc in facets["hits"]],
+            brands=[FacetBucket(value=str(b["_id"]), count=b["count"]) for b in facets["brands"]],
+            tags=[FacetBucket(value=str(b["_id"]), count=b["count"]) for b in facets["tags"]],
+            price_histogram=self._histogram(facets["price"], PRICE_HISTOGRAM_BOUNDARIES),
+            battery_histogram=self._histogram(facets["battery"], BATTERY_HISTOGRAM_BOUNDARIES),
+        )
+
+    @staticmethod
+    def _histogram(buckets: List[Dict[str, Any]], boundaries: List[float]) -> List[HistogramBucket]:
+        """把 $bucket 的输出转换为完整的直方图，空区间计数为 0"""
+        counts = {bucket["_id"]: bucket["count"] for bucket in buckets}
+        histogram = [
+            HistogramBucket(
+                lower=lower,
+                upper=None if math.isinf(upper) else upper,
+                count=counts.get(lower, 0),
+            )
+            for lower, upper in zip(boundaries, boundaries[1:])
+        ]
+        if counts.get("unknown"):
+            histogram.append(HistogramBucket(lower=None, upper=None, count=counts["unknown"]))
+        return histogram
+
+    async def search_best_value(self, params: PhoneSearchParams) -> List[Phone]:
+        """从预计算的 skyline 中返回性价比最优的手机，只保留位于 skyline 上的 SKU"""
+        snapshot = catalog_snapshots.current()
+        # 导出之后的目录变化不在快照里，同步任务的水位线也不会补上，只在版本一致时开始使用快照；
+        # 使用中的快照之后的变化已增量合并，刷新周期内继续使用
+        if (
+            snapshot is not None
+            and not skyline_service.serves(snapshot)
+            and snapshot.version != await self.catalog_version()
+        ):
+            snapshot = None
+        await skyline_service.ensure_loaded(snapshot)
+        points = skyline_service.skyline(params.tags, params.min_price, params.max_price)
+
+        sku_ids_by_phone: Dict[str, set[str]] = {}
+        phone_order: List[str] = []
+        for point in points:
+            if point.phone_id not in sku_ids_by_phone:
+                sku_ids_by_phone[point.phone_id] = set()
+                phone_order.append(point.phone_id)
+            sku_ids_by_phone[point.phone_id].add(point.sku_id)
+        phone_order = phone_order[: params.limit]
+        if not phone_order:
+            return []
+
+        cursor = self.collection.find({"_id": {"$in": [ObjectId(phone_id) for phone_id in phone_order]}})
+        phones_by_id: Dict[str, Phone] = {}
+        async for doc in cursor:
+            phone = Phone.model_validate(doc)
+            phone.skus = [sku for sku in phone.skus if sku.sku_id in sku_ids_by_phone[str(phone.id)]]
+            phones_by_id[str(phone.id)] = phone
+        return [phones_by_id[phone_id] for phone_id in phone_order if phone_id in phones_by_id]
+
+    def build_search_query(self, params: PhoneSearchParams) -> Dict[str, Any]:
         """构建 MongoDB 查询"""
         query: Dict[str, Any] = {}
 
@@ -98,3 +665,206 @@ class PhoneService:
 
 
 phone_service = PhoneService()
+
+
+class CatalogSync:
+    """
+    目录增量同步
+
+    连接副本集或分片集群时跟随 change stream，否则按 (updated_at, _id) 水位线轮询；
+    每个变化增量应用到 skyline，并通过 catalog_changed 让下游缓存失效。
+    轮询看不到删除，也看不到 updated_at 早于水位线的插入，因此文档数与已知 _id 数不一致时对比一次 _id 集合。
+    """
+
+    def __init__(self, phones: PhoneService) -> None:
+        self.phones = phones
+        self.mode: Optional[str] = None
+        self._watermark: Optional[Tuple[datetime, ObjectId]] = None
+        self._known_ids: Set[ObjectId] = set()
+        self._primed = False
+        self._resume_token: Optional[Dict[str, Any]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    async def start(self) -> None:
+        """启动后台任务；同步方式的探测也在后台进行，不阻塞启动"""
+        if settings.catalog_sync_mode == "off":
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        mode = settings.catalog_sync_mode
+        if mode == "auto":
+            try:
+                mode = "change_stream" if await self._supports_change_streams() else "poll"
+            except PyMongoError as e:
+                logger.warning("Cannot detect change stream support, falling back to polling: %s", e)
+                mode = "poll"
+        self.mode = mode
+        logger.info("Catalog sync started (%s)", mode)
+        if mode == "change_stream":
+            await self._watch()
+            # 部署不支持 change stream 时 _watch 返回，回退为轮询
+            self.mode = "poll"
+        await self._poll()
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def resync(self, reason: str) -> None:
+        """无法增量同步时全量重建"""
+        SYNC_RESYNCS.inc(reason=reason)
+        logger.warning("Full catalog resync: %s", reason)
+        await skyline_service.refresh()
+        self.phones.catalog_changed(full=True)
+
+    async def poll_once(self) -> int:
+        """拉取水位线之后的变化并应用，返回变化的文档数"""
+        if not self._primed:
+            await self._load_watermark()
+        batch_size = settings.catalog_sync_batch_size
+        changed: List[Dict[str, Any]] = []
+        removed: List[ObjectId] = []
+        while True:
+            docs = (
+                await self.phones.collection.find(self._after_watermark())
+                .sort([("updated_at", 1), ("_id", 1)])
+                .limit(batch_size)
+                .to_list(length=batch_size)
+            )
+            for doc in docs:
+                self._upsert(doc)
+            changed.extend(docs)
+            SYNC_CHANGES.inc(len(docs), source="poll", operation="upsert")
+            if len(docs) < batch_size:
+                break
+
+        if await self.phones.collection.count_documents({}) != len(self._known_ids):
+            added, removed = await self._reconcile_ids()
+            changed.extend(added)
+        if changed or removed:
+            self.phones.catalog_changed(changed, [str(phone_id) for phone_id in removed])
+        return len(changed) + len(removed)
+
+    async def apply_change(self, change: Dict[str, Any]) -> None:
+        """应用一条 change stream 事件"""
+        operation = change["operationType"]
+        SYNC_CHANGES.inc(source="change_stream", operation=operation)
+        if operation in ("insert", "update", "replace"):
+            doc = change.get("fullDocument")
+            if doc is None:
+                # 查询完整文档前已被删除
+                self._remove(change["documentKey"]["_id"])
+                self.phones.catalog_changed(removed_ids=[str(change["documentKey"]["_id"])])
+            else:
+                self._upsert(doc)
+                self.phones.catalog_changed([doc])
+        elif operation == "delete":
+            self._remove(change["documentKey"]["_id"])
+            self.phones.catalog_changed(removed_ids=[str(change["documentKey"]["_id"])])
+        elif operation in ("drop", "rename", "dropDatabase", "invalidate"):
+            self._resume_token = None
+            await self.resync(operation)
+
+    async def _supports_change_streams(self) -> bool:
+        hello = await self.phones.collection.command("hello")
+        return "setName" in hello or hello.get("msg") == "isdbgrid"
+
+    async def _watch(self) -> None:
+        backoff = 1.0
+        resync_reason: Optional[str] = None
+        while True:
+            try:
+                # 全量重建放在重试范围内，失败时按退避重试，不会让后台任务退出
+                if resync_reason is not None:
+                    await self.resync(resync_reason)
+                    resync_reason = None
+                if self._resume_token is None:
+                    # 没有续传点，启动前的变化可能未被观察到
+                    self.phones.catalog_changed(full=True)
+                async with self.phones.collection.watch(
+                    full_document="updateLookup", resume_after=self._resume_token
+                ) as stream:
+                    backoff = 1.0
+                    async for change in stream:
+                        await self.apply_change(change)
+                        self._resume_token = stream.resume_token
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAM_NOT_SUPPORTED:
+                    logger.error("Change streams are not supported by this deployment, falling back to polling: %s", e)
+                    return
+                if e.code != CHANGE_STREAM_HISTORY_LOST:
+                    logger.warning("Catalog change stream failed, retrying in %.0fs: %s", backoff, e)
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 30.0)
+                    continue
+                self._resume_token = None
+                resync_reason = "history_lost"
+            except PyMongoError as e:
+                logger.warning("Catalog change stream failed, retrying in %.0fs: %s", backoff, e)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    async def _poll(self) -> None:
+        while True:
+            try:
+                await self.poll_once()
+            except PyMongoError as e:
+                logger.warning("Catalog poll failed: %s", e)
+            await asyncio.sleep(settings.catalog_sync_poll_seconds)
+
+    async def _load_watermark(self) -> None:
+        self._known_ids.clear()
+        async for doc in self.phones.collection.find({}, {"updated_at": 1}):
+            self._known_ids.add(doc["_id"])
+            self._advance(doc)
+        self._primed = True
+
+    async def _reconcile_ids(self) -> Tuple[List[Dict[str, Any]], List[ObjectId]]:
+        """对比 _id 集合，返回 (新出现的文档, 已删除的 _id)"""
+        current = {doc["_id"] async for doc in self.phones.collection.find({}, {"_id": 1})}
+        removed = list(self._known_ids - current)
+        added_ids = current - self._known_ids
+        for phone_id in removed:
+            self._remove(phone_id)
+        added: List[Dict[str, Any]] = []
+        if added_ids:
+            async for doc in self.phones.collection.find({"_id": {"$in": list(added_ids)}}):
+                self._upsert(doc)
+                added.append(doc)
+        SYNC_CHANGES.inc(len(removed), source="poll", operation="delete")
+        SYNC_CHANGES.inc(len(added), source="poll", operation="upsert")
+        return added, removed
+
+    def _after_watermark(self) -> Dict[str, Any]:
+        if self._watermark is None:
+            return {}
+        updated_at, last_id = self._watermark
+        return {"$or": [{"updated_at": {"$gt": updated_at}}, {"updated_at": updated_at, "_id": {"$gt": last_id}}]}
+
+    def _advance(self, doc: Dict[str, Any]) -> None:
+        updated_at = doc.get("updated_at")
+        if updated_at is None:
+            return
+        position = (updated_at, doc["_id"])
+        if self._watermark is None or position > self._watermark:
+            self._watermark = position
+
+    def _upsert(self, doc: Dict[str, Any]) -> None:
+        self._known_ids.add(doc["_id"])
+        self._advance(doc)
+        skyline_service.apply_phone_change(doc)
+
+    def _remove(self, phone_id: ObjectId) -> None:
+        self._known_ids.discard(phone_id)
+        skyline_service.remove_phone(str(phone_id))
+
+
+catalog_sync = CatalogSync(phone_service)
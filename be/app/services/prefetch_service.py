@@ -0,0 +1,173 @@
+"""追问搜索预取 - 一轮回答结束后，根据最后一次搜索推测可能的追问并预热搜索缓存"""
+
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import Callable, Deque, List, Optional, Sequence, Set, Tuple
+
+from langchain_core.messages import AIMessage, BaseMessage
+
+from app.config import settings
+from app.metrics import registry
+from app.models import Phone, PhoneSearchParams
+from app.services.phone_service import phone_service
+from app.tools.search_phones import build_search_params, search_phones
+
+logger = logging.getLogger("app.prefetch_service")
+
+PREFETCHES = registry.counter("phone_search_prefetches_total", "Prefetch attempts by heuristic and outcome")
+
+# 追问“换个方向”时常见的相邻标签
+TAG_ALTERNATIVES = {
+    "拍照手机": "长续航",
+    "游戏手机": "长续航",
+    "长续航": "拍照手机",
+    "旗舰机": "性价比",
+    "性价比": "长续航",
+    "商务手机": "拍照手机",
+}
+LARGE_BATTERY = 5000
+
+
+def _round_price(value: float) -> float:
+    return float(max(100, int(value) // 100 * 100))
+
+
+def _prices(phones: Sequence[Phone]) -> List[float]:
+    return [sku.price for phone in phones for sku in phone.skus if sku.price is not None]
+
+
+def cheaper(params: PhoneSearchParams, phones: Sequence[Phone]) -> Optional[PhoneSearchParams]:
+    """“更便宜的呢”：价格上限降到当前结果最低价或原上限的八折以下"""
+    prices = _prices(phones)
+    ceiling = min(prices) if prices else params.max_price
+    if ceiling is None:
+        return None
+    max_price = _round_price(min(ceiling, params.max_price or math.inf) * 0.8)
+    min_price = params.min_price if params.min_price is not None and params.min_price < max_price else None
+    return params.model_copy(update={"min_price": min_price, "max_price": max_price})
+
+
+def bigger_battery(params: PhoneSearchParams, phones: Sequence[Phone]) -> Optional[PhoneSearchParams]:
+    """“有没有大电池的”：电池下限提高到当前结果的最大值或 5000mAh"""
+    batteries = [phone.battery for phone in phones if phone.battery]
+    target = max([LARGE_BATTERY, *batteries])
+    if params.min_battery is not None and params.min_battery >= target:
+        return None
+    return params.model_copy(update={"min_battery": target})
+
+
+def same_brand(params: PhoneSearchParams, phones: Sequence[Phone]) -> Optional[PhoneSearchParams]:
+    """追问列表中的某款手机：同品牌、同价位的其他型号"""
+    if params.brand or not phones:
+        return None
+    return params.model_copy(update={"brand": phones[0].brand, "tags": [], "keyword": None})
+
+
+def tag_swap(params: PhoneSearchParams, phones: Sequence[Phone]) -> Optional[PhoneSearchParams]:
+    """换一个侧重点：把第一个有相邻标签的标签替换掉"""
+    for index, tag in enumerate(params.tags):
+        alternative = TAG_ALTERNATIVES.get(tag)
+        if alternative and alternative not in params.tags:
+            tags = [*params.tags[:index], alternative, *params.tags[index + 1 :]]
+            return params.model_copy(update={"tags": tags})
+    return None
+
+
+Heuristic = Callable[[PhoneSearchParams, Sequence[Phone]], Optional[PhoneSearchParams]]
+
+# 按优先级排列，每轮最多取 prefetch_max_queries_per_turn 个
+HEURISTICS: List[Tuple[str, Heuristic]] = [
+    ("cheaper", cheaper),
+    ("bigger_battery", bigger_battery),
+    ("same_brand", same_brand),
+    ("tag_swap", tag_swap),
+]
+
+
+def derive_followups(params: PhoneSearchParams, phones: Sequence[Phone]) -> List[Tuple[str, PhoneSearchParams]]:
+    """根据一次搜索及其结果推测可能的追问搜索"""
+    followups: List[Tuple[str, PhoneSearchParams]] = []
+    for name, heuristic in HEURISTICS:
+        followup = heuristic(params, phones)
+        if followup is not None and followup != params:
+            followups.append((name, followup))
+    return followups[: settings.prefetch_max_queries_per_turn]
+
+
+def last_search_params(messages: Sequence[BaseMessage]) -> Optional[PhoneSearchParams]:
+    """找到本轮最后一次 search_phones 调用的参数"""
+    for message in reversed(messages):
+        if not isinstance(message, AIMessage):
+            continue
+        for tool_call in reversed(message.tool_calls):
+            if tool_call["name"] != search_phones.name:
+                continue
+            try:
+                return build_search_params(**tool_call["args"])
+            except Exception:
+                return None
+    return None
+
+
+class PrefetchService:
+    """
+    低优先级的搜索预取
+
+    预取在后台串行执行，受每分钟查询数上限和单次查询的 maxTimeMS 约束；
+    有生成在排队时说明系统繁忙，直接放弃本轮预取。
+    """
+
+    def __init__(self) -> None:
+        self._issued_at: Deque[float] = deque()
+        self._tasks: Set[asyncio.Task] = set()
+        self._lock = asyncio.Lock()
+
+    def schedule(self, messages: Sequence[BaseMessage], busy: bool = False) -> None:
+        """一轮生成完成后调用，不等待预取完成"""
+        if not settings.prefetch_enabled or busy:
+            return
+        params = last_search_params(messages)
+        if params is None:
+            return
+        task = asyncio.create_task(self._prefetch(params))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def shutdown(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _take_budget(self) -> bool:
+        current = time.monotonic()
+        while self._issued_at and current - self._issued_at[0] > 60:
+            self._issued_at.popleft()
+        if len(self._issued_at) >= settings.prefetch_max_queries_per_minute:
+            return False
+        self._issued_at.append(current)
+        return True
+
+    async def _prefetch(self, params: PhoneSearchParams) -> None:
+        phones = phone_service.peek_search(params) or []
+        async with self._lock:
+            for heuristic, followup in derive_followups(params, phones):
+                if not self._take_budget():
+                    PREFETCHES.inc(heuristic=heuristic, outcome="over_budget")
+                    continue
+                try:
+                    issued = await phone_service.prefetch_search(followup, heuristic)
+                except Exception as e:
+                    PREFETCHES.inc(heuristic=heuristic, outcome="error")
+                    logger.debug("Prefetch %s failed: %s", heuristic, e)
+                    continue
+                if not issued:
+                    # 已在缓存中，没有产生查询，归还预算
+                    self._issued_at.pop()
+                PREFETCHES.inc(heuristic=heuristic, outcome="issued" if issued else "cached")
+                logger.debug("Prefetch %s: %s", heuristic, "issued" if issued else "already cached")
+
+
+prefetch_service = PrefetchService()
@@ -0,0 +1,172 @@
+"""LLM 响应缓存 - 以规范化请求的哈希为键，把完整的 agent 消息序列持久化到本地 SQLite"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence
+
+from langchain_core.messages import AIMessage, BaseMessage, messages_from_dict, messages_to_dict
+
+from app.config import settings
+from app.metrics import registry
+
+logger = logging.getLogger("app.response_cache")
+
+LOOKUPS = registry.counter("llm_response_cache_lookups_total", "Response cache lookups by result")
+STORED_BYTES = registry.gauge("llm_response_cache_bytes", "Bytes stored in the response cache")
+
+_WHITESPACE = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = re.compile(r"[\s。.！!？?～~]+$")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    catalog_version TEXT NOT NULL,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);
+"""
+
+
+def normalize_text(text: str) -> str:
+    """全角转半角、合并空白、去掉句末标点，使仅有书写差异的问题命中同一条缓存"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = _WHITESPACE.sub(" ", text).strip()
+    return _TRAILING_PUNCTUATION.sub("", text)
+
+
+def normalize_message(message: BaseMessage) -> Dict[str, Any]:
+    """只保留影响模型输出的部分；消息 id 与 tool_call_id 每次生成都不同，不参与键计算"""
+    content = message.content if isinstance(message.content, str) else json.dumps(message.content, sort_keys=True)
+    normalized: Dict[str, Any] = {"type": message.type, "content": normalize_text(content)}
+    if isinstance(message, AIMessage) and message.tool_calls:
+        normalized["tool_calls"] = [{"name": call["name"], "args": call["args"]} for call in message.tool_calls]
+    return normalized
+
+
+def cache_key(parts: Dict[str, Any]) -> str:
+    """对请求各组成部分做规范 JSON 序列化后取 SHA-256"""
+    canonical = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    磁盘上的响应缓存
+
+    每条记录保存一次完整生成的消息序列（包括工具调用和工具结果），带 TTL；
+    总大小超过上限时按最近访问时间淘汰。目录版本变化时旧版本的记录全部失效。
+    SQLite 调用在线程池中执行，不阻塞事件循环。
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path or settings.llm_response_cache_path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._catalog_version: Optional[str] = None
+
+    @property
+    def enabled(self) -> bool:
+        return settings.llm_response_cache_enabled
+
+    async def get(self, key: str, catalog_version: str) -> Optional[List[BaseMessage]]:
+        messages = await asyncio.to_thread(self._get, key, catalog_version)
+        LOOKUPS.inc(result="hit" if messages is not None else "miss")
+        return messages
+
+    async def put(self, key: str, catalog_version: str, messages: Sequence[BaseMessage]) -> None:
+        await asyncio.to_thread(self._put, key, catalog_version, list(messages))
+
+    async def replay(self, messages: Sequence[BaseMessage]) -> AsyncIterator[BaseMessage]:
+        """按原顺序回放缓存的消息，可按字符速率模拟生成耗时"""
+        rate = settings.llm_response_cache_replay_chars_per_second
+        for message in messages:
+            if rate > 0 and isinstance(message, AIMessage) and isinstance(message.content, str):
+                await asyncio.sleep(len(message.content) / rate)
+            yield message
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+            STORED_BYTES.set(self._total_bytes())
+        return self._conn
+
+    def _total_bytes(self) -> int:
+        assert self._conn is not None
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def _invalidate_stale(self, catalog_version: str) -> None:
+        if catalog_version == self._catalog_version:
+            return
+        deleted = self._connect().execute(
+            "DELETE FROM responses WHERE catalog_version != ?", (catalog_version,)
+        ).rowcount
+        self._catalog_version = catalog_version
+        if deleted:
+            logger.info("Catalog version changed to %s, dropped %d cached responses", catalog_version, deleted)
+            STORED_BYTES.set(self._total_bytes())
+
+    def _get(self, key: str, catalog_version: str) -> Optional[List[BaseMessage]]:
+        with self._lock:
+            self._invalidate_stale(catalog_version)
+            conn = self._connect()
+            current = time.time()
+            row = conn.execute(
+                "SELECT value FROM responses WHERE key = ? AND catalog_version = ? AND expires_at > ?",
+                (key, catalog_version, current),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (current, key))
+        return messages_from_dict(json.loads(row[0]))
+
+    def _put(self, key: str, catalog_version: str, messages: List[BaseMessage]) -> None:
+        value = json.dumps(messages_to_dict(messages), ensure_ascii=False).encode("utf-8")
+        max_bytes = settings.llm_response_cache_max_bytes
+        if len(value) > max_bytes:
+            return
+        with self._lock:
+            self._invalidate_stale(catalog_version)
+            conn = self._connect()
+            current = time.time()
+            conn.execute("DELETE FROM responses WHERE expires_at <= ?", (current,))
+            conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, catalog_version, value, len(value), current + settings.llm_response_cache_ttl_seconds, current),
+            )
+            total = self._total_bytes()
+            if total > max_bytes:
+                # 按最近访问时间从旧到新淘汰，直到总大小回到上限以内
+                victims: List[str] = []
+                for victim, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+                    if total <= max_bytes:
+                        break
+                    victims.append(victim)
+                    total -= size
+                conn.executemany("DELETE FROM responses WHERE key = ?", [(victim,) for victim in victims])
+                logger.debug("Evicted %d cached responses", len(victims))
+            STORED_BYTES.set(total)
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,221 @@
+"""生成调度 - 全局并发上限、token 速率预算和按用户/线程的公平排队"""
+
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Dict, List, Optional
+
+from app.config import settings
+from app.metrics import registry
+
+logger = logging.getLogger("app.scheduler")
+
+QUEUE_DEPTH = registry.gauge("generation_queue_depth", "Generations waiting for admission")
+RUNNING = registry.gauge("generations_running", "Generations currently admitted")
+QUEUE_WAIT = registry.histogram("generation_queue_wait_seconds", "Time spent waiting for admission")
+REJECTED = registry.counter("generations_rejected_total", "Generations rejected by admission control")
+
+
+class AdmissionRejected(Exception):
+    """队列已满，retry_after 为建议的重试等待秒数"""
+
+    def __init__(self, retry_after: float, reason: str) -> None:
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+@dataclass
+class Ticket:
+    """一次生成的排队凭证"""
+
+    key: str
+    estimated_tokens: int
+    enqueued_at: float = field(default_factory=time.monotonic)
+    admitted_at: Optional[float] = None
+    tokens_used: Optional[int] = None
+    # 调用 wait 后才参与准入；生成在等待线程轮次时不占用并发槽位
+    waiting: bool = False
+    released: bool = False
+    _admitted: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+QueueUpdate = Callable[[int, float], Awaitable[None]]
+
+
+class GenerationScheduler:
+    """
+    生成调度器
+
+    每个 key（用户或线程）有独立的 FIFO 队列，每次准入最久未被服务的 key，一个用户的突发请求不会饿死其他人。
+    准入同时受并发上限和 token 桶约束；队列有界，满时立即拒绝并给出重试建议。
+    """
+
+    def __init__(self) -> None:
+        self._queues: "OrderedDict[str, Deque[Ticket]]" = OrderedDict()
+        # key 最近一次被准入的序号，越小越优先
+        self._last_served: Dict[str, int] = {}
+        self._admissions = 0
+        self._queued = 0
+        self._running = 0
+        self._tokens = float(settings.llm_tokens_per_minute)
+        self._tokens_updated_at = time.monotonic()
+        # 单次生成耗时的指数移动平均，用于估算等待时间
+        self._avg_service_seconds = 10.0
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def enqueue(self, key: str, estimated_tokens: int) -> Ticket:
+        """
+        申请排队名额；队列上限在这里检查，准入要等到 wait 被调用
+
+        Raises:
+            AdmissionRejected: 全局队列或该 key 的队列已满
+        """
+        queue = self._queues.get(key)
+        if self._queued >= settings.llm_max_queued_generations:
+            REJECTED.inc(reason="queue_full")
+            raise AdmissionRejected(self._estimate_wait(self._queued + 1), "Generation queue is full")
+        if queue is not None and len(queue) >= settings.llm_max_queued_per_key:
+            REJECTED.inc(reason="key_limit")
+            raise AdmissionRejected(self._estimate_wait(len(queue) + 1), "Too many pending generations")
+
+        ticket = Ticket(key=key, estimated_tokens=estimated_tokens)
+        self._queues.setdefault(key, deque()).append(ticket)
+        self._queued += 1
+        QUEUE_DEPTH.set(self._queued)
+        return ticket
+
+    async def wait(self, ticket: Ticket, on_update: Optional[QueueUpdate] = None) -> None:
+        """等待准入，排队期间定期回报排队位置和预计等待时间；被取消时退出队列"""
+        last_report = None
+        ticket.waiting = True
+        try:
+            while not ticket._admitted.is_set():
+                self._dispatch()
+                if ticket._admitted.is_set():
+                    break
+                position = self.position(ticket)
+                report = (position, round(self._estimate_wait(position)))
+                if on_update is not None and report != last_report:
+                    await on_update(*report)
+                    last_report = report
+                try:
+                    await asyncio.wait_for(ticket._admitted.wait(), settings.llm_queue_update_interval_seconds)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self.cancel(ticket)
+            raise
+
+    def release(self, ticket: Ticket) -> None:
+        """生成结束，归还并发槽位并按实际用量修正 token 桶"""
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket.admitted_at is None:
+            self.cancel(ticket)
+            return
+
+        self._running -= 1
+        RUNNING.set(self._running)
+        elapsed = time.monotonic() - ticket.admitted_at
+        self._avg_service_seconds = 0.8 * self._avg_service_seconds + 0.2 * elapsed
+        if ticket.tokens_used is not None and settings.llm_tokens_per_minute:
+            self._refill()
+            self._tokens += ticket.estimated_tokens - ticket.tokens_used
+        self._dispatch()
+
+    def cancel(self, ticket: Ticket) -> None:
+        """从队列中移除尚未准入的凭证"""
+        if ticket._admitted.is_set():
+            self.release(ticket)
+            return
+        queue = self._queues.get(ticket.key)
+        if queue is None or ticket not in queue:
+            return
+        queue.remove(ticket)
+        if not queue:
+            del self._queues[ticket.key]
+        self._queued -= 1
+        QUEUE_DEPTH.set(self._queued)
+
+    def position(self, ticket: Ticket) -> int:
+        """按出队顺序估算排在该凭证之前的数量（从 1 开始）"""
+        queue = self._queues.get(ticket.key)
+        if queue is None or ticket not in queue:
+            return 0
+        index = queue.index(ticket)
+        ahead = index
+        before = True
+        for key in self._service_order():
+            if key == ticket.key:
+                before = False
+                continue
+            ahead += min(len(self._queues[key]), index + 1 if before else index)
+        return ahead + 1
+
+    def _service_order(self) -> List[str]:
+        """等待中的 key 按最近被服务的先后排序，从未被服务的排最前，同等条件下按入队顺序"""
+        return sorted(self._queues, key=lambda key: self._last_served.get(key, -1))
+
+    def _estimate_wait(self, position: int) -> float:
+        if position <= 0:
+            return 0.0
+        limit = max(1, settings.llm_max_concurrent_generations)
+        return math.ceil(position / limit) * self._avg_service_seconds
+
+    def _refill(self) -> None:
+        capacity = settings.llm_tokens_per_minute
+        current = time.monotonic()
+        self._tokens = min(capacity, self._tokens + (current - self._tokens_updated_at) * capacity / 60)
+        self._tokens_updated_at = current
+
+    def _next_waiting(self) -> Optional[Ticket]:
+        """最久未被服务的 key 中第一个已在等待准入的凭证"""
+        for key in self._service_order():
+            for ticket in self._queues[key]:
+                if ticket.waiting:
+                    return ticket
+        return None
+
+    def _dispatch(self) -> None:
+        """依次准入最久未被服务的 key，直到并发槽位或 token 预算用尽"""
+        if settings.llm_tokens_per_minute:
+            self._refill()
+        while self._queues and self._running < settings.llm_max_concurrent_generations:
+            ticket = self._next_waiting()
+            if ticket is None:
+                break
+            key = ticket.key
+            queue = self._queues[key]
+            if settings.llm_tokens_per_minute:
+                needed = min(ticket.estimated_tokens, settings.llm_tokens_per_minute)
+                if self._tokens < needed:
+                    break
+                self._tokens -= ticket.estimated_tokens
+
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[key]
+            self._admissions += 1
+            self._last_served[key] = self._admissions
+            if len(self._last_served) > 10000:
+                self._last_served = {k: v for k, v in self._last_served.items() if k in self._queues}
+            self._queued -= 1
+            self._running += 1
+            ticket.admitted_at = time.monotonic()
+            ticket._admitted.set()
+            QUEUE_WAIT.observe(ticket.admitted_at - ticket.enqueued_at)
+            logger.debug("Admitted generation for %s after %.2fs", key, ticket.admitted_at - ticket.enqueued_at)
+
+        QUEUE_DEPTH.set(self._queued)
+        RUNNING.set(self._running)
@@ -0,0 +1,333 @@
+"""性价比（Pareto 前沿 / skyline）计算与缓存
+
+“性价比最高”本质上是在 价格↓ / 电池↑ / 屏幕↑ / 内存↑ 四个维度上找不被其他 SKU 全面超越的集合。
+这里按 (标签组合, 价格段) 预计算并缓存 skyline，手机数据变化时增量维护。
+使用目录快照时候选点直接从快照的数值列读取，进程内只保存快照之后变化的手机。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import math
+import re
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from app.config import settings
+from app.database import get_phones_collection
+
+if TYPE_CHECKING:
+    from app.services.catalog_snapshot import CatalogSnapshot
+
+logger = logging.getLogger("app.skyline_service")
+
+# 价格段划分，左闭右开
+PRICE_BANDS: List[Tuple[float, float]] = [
+    (0, 1000),
+    (1000, 2000),
+    (2000, 3000),
+    (3000, 4000),
+    (4000, 5000),
+    (5000, 6000),
+    (6000, 8000),
+    (8000, math.inf),
+]
+
+SKYLINE_PROJECTION = {"tags": 1, "battery": 1, "display_size": 1, "skus": 1}
+
+_RAM_PATTERN = re.compile(r"(\d+(?:\.\d+)?)\s*(TB|GB|MB)?", re.IGNORECASE)
+
+CacheKey = Tuple[Tuple[str, ...], int]
+
+
+def parse_ram(value: Optional[str]) -> float:
+    """把 “12GB” 之类的描述转换为以 GB 为单位的数值，无法解析时返回 0"""
+    if not value:
+        return 0.0
+    match = _RAM_PATTERN.search(value)
+    if not match:
+        return 0.0
+    amount = float(match.group(1))
+    unit = (match.group(2) or "GB").upper()
+    if unit == "TB":
+        return amount * 1024
+    if unit == "MB":
+        return amount / 1024
+    return amount
+
+
+@dataclass(frozen=True)
+class SkylinePoint:
+    """skyline 中的一个候选点，对应一个 SKU"""
+
+    phone_id: str
+    sku_id: str
+    price: float
+    battery: float
+    display_size: float
+    ram: float
+
+    def dominates(self, other: "SkylinePoint") -> bool:
+        """各维度都不差于 other，且至少一个维度严格更好"""
+        if (
+            self.price > other.price
+            or self.battery < other.battery
+            or self.display_size < other.display_size
+            or self.ram < other.ram
+        ):
+            return False
+        return (
+            self.price < other.price
+            or self.battery > other.battery
+            or self.display_size > other.display_size
+            or self.ram > other.ram
+        )
+
+    def sort_key(self) -> Tuple[float, float, float, float]:
+        # 字典序是支配关系的一个线性扩展：支配者一定排在被支配者之前
+        return (self.price, -self.battery, -self.display_size, -self.ram)
+
+
+def compute_skyline(points: Iterable[SkylinePoint]) -> List[SkylinePoint]:
+    """Sort-Filter-Skyline：排序后单趟扫描，每个点只需与已确定的 skyline 比较"""
+    skyline: List[SkylinePoint] = []
+    for point in sorted(points, key=SkylinePoint.sort_key):
+        if not any(candidate.dominates(point) for candidate in skyline):
+            skyline.append(point)
+    return skyline
+
+
+def points_from_doc(doc: Dict[str, Any]) -> List[SkylinePoint]:
+    """把 phones 文档展开为 SKU 级别的候选点，没有价格的 SKU 不参与计算"""
+    phone_id = str(doc["_id"])
+    battery = float(doc.get("battery") or 0)
+    display_size = float(doc.get("display_size") or 0)
+    points: List[SkylinePoint] = []
+    for sku in doc.get("skus") or []:
+        price = sku.get("price")
+        if price is None:
+            continue
+        points.append(
+            SkylinePoint(
+                phone_id=phone_id,
+                sku_id=sku["sku_id"],
+                price=float(price),
+                battery=battery,
+                display_size=display_size,
+                ram=parse_ram(sku.get("ram")),
+            )
+        )
+    return points
+
+
+def _band_index(price: float) -> int:
+    for index, (low, high) in enumerate(PRICE_BANDS):
+        if low <= price < high:
+            return index
+    return len(PRICE_BANDS) - 1
+
+
+class SkylineService:
+    """按 (标签组合, 价格段) 缓存 skyline，并在手机变化时增量维护"""
+
+    def __init__(self) -> None:
+        # 从数据库加载时是全部手机；使用快照时只是快照之后变化的手机
+        self._points: Dict[str, List[SkylinePoint]] = {}
+        self._tags: Dict[str, Set[str]] = {}
+        self._cache: Dict[CacheKey, List[SkylinePoint]] = {}
+        self._loaded_at: Optional[float] = None
+        self._snapshot: Optional[CatalogSnapshot] = None
+        # 已被变化覆盖或删除的快照行
+        self._superseded: Set[int] = set()
+        self._snapshot_rows: Optional[Dict[str, int]] = None
+        self._snapshot_tags: Optional[Dict[str, int]] = None
+        self._lock = asyncio.Lock()
+
+    async def ensure_loaded(self, snapshot: Optional[CatalogSnapshot] = None) -> None:
+        """
+        首次使用或超过刷新周期时全量加载
+
+        有目录快照时直接使用快照，不再扫描数据库；快照版本变化后切换。
+        不再使用快照（如快照落后于数据库）时立即从数据库重新加载。
+        """
+        if snapshot is not None:
+            if self._snapshot is None or snapshot.version != self._snapshot.version:
+                self.load_snapshot(snapshot)
+            return
+        if self._fresh():
+            return
+        async with self._lock:
+            if self._fresh():
+                return
+            await self.refresh()
+
+    def _fresh(self) -> bool:
+        if self._loaded_at is None or self._snapshot is not None:
+            return False
+        return time.monotonic() - self._loaded_at < settings.skyline_refresh_seconds
+
+    def serves(self, snapshot: CatalogSnapshot) -> bool:
+        """
+        快照已在使用中且未超过刷新周期
+
+        快照加载时与数据库版本一致，之后的变化已增量合并，因此数据库版本前进后仍可继续使用，
+        直到导出新版本或超过刷新周期。
+        """
+        if self._snapshot is None or self._snapshot.version != snapshot.version or self._loaded_at is None:
+            return False
+        return time.monotonic() - self._loaded_at < settings.skyline_refresh_seconds
+
+    async def refresh(self) -> None:
+        """从数据库全量重建候选点，丢弃所有已缓存的 skyline"""
+        cursor = get_phones_collection().find({}, SKYLINE_PROJECTION)
+        docs = [doc async for doc in cursor]
+        self.load_docs(docs)
+        logger.info("Loaded %d phones for skyline computation", len(docs))
+
+    def load_docs(self, docs: Iterable[Dict[str, Any]]) -> None:
+        self._reset(None)
+        for doc in docs:
+            phone_id = str(doc["_id"])
+            self._points[phone_id] = points_from_doc(doc)
+            self._tags[phone_id] = set(doc.get("tags") or [])
+
+    def load_snapshot(self, snapshot: CatalogSnapshot) -> None:
+        """改为从目录快照的数值列计算，不复制候选点，丢弃所有已缓存的 skyline"""
+        self._reset(snapshot)
+        logger.info("Using snapshot %s (%d phones) for skyline computation", snapshot.version, snapshot.phone_count)
+
+    def _reset(self, snapshot: Optional[CatalogSnapshot]) -> None:
+        self._points.clear()
+        self._tags.clear()
+        self._cache.clear()
+        self._snapshot = snapshot
+        self._superseded = set()
+        self._snapshot_rows = None
+        self._snapshot_tags = None
+        self._loaded_at = time.monotonic()
+
+    def skyline(
+        self,
+        tags: Sequence[str] = (),
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None,
+    ) -> List[SkylinePoint]:
+        """
+        获取价格区间内的 skyline
+
+        完全落在区间内的价格段直接使用缓存，部分覆盖的价格段按区间过滤后参与计算；
+        skyline(A ∪ B) = skyline(skyline(A) ∪ skyline(B))，因此可以按段合并。
+        """
+        tag_key = tuple(sorted({tag.strip() for tag in tags if tag.strip()}))
+        low = min_price if min_price is not None else 0.0
+        high = max_price if max_price is not None else math.inf
+
+        candidates: List[SkylinePoint] = []
+        for index, (band_low, band_high) in enumerate(PRICE_BANDS):
+            if band_high <= low or band_low > high:
+                continue
+            if low <= band_low and band_high <= high:
+                candidates.extend(self._band_skyline(tag_key, index))
+            else:
+                candidates.extend(
+                    point for point in self._band_points(tag_key, index) if low <= point.price <= high
+                )
+        return compute_skyline(candidates)
+
+    def apply_phone_change(self, doc: Dict[str, Any]) -> None:
+        """手机新增或更新后增量维护已缓存的 skyline"""
+        phone_id = str(doc["_id"])
+        self.remove_phone(phone_id)
+
+        new_points = points_from_doc(doc)
+        tags = set(doc.get("tags") or [])
+        self._points[phone_id] = new_points
+        self._tags[phone_id] = tags
+
+        for (tag_key, index), skyline in self._cache.items():
+            if not tags.issuperset(tag_key):
+                continue
+            for point in new_points:
+                if _band_index(point.price) != index:
+                    continue
+                if any(candidate.dominates(point) for candidate in skyline):
+                    continue
+                skyline[:] = [candidate for candidate in skyline if not point.dominates(candidate)]
+                skyline.append(point)
+
+    def remove_phone(self, phone_id: str) -> None:
+        """手机删除后使包含它的 skyline 失效，其余缓存不受影响"""
+        removed = bool(self._points.pop(phone_id, None))
+        self._tags.pop(phone_id, None)
+        row = self._snapshot_row(phone_id)
+        if row is not None and row not in self._superseded:
+            self._superseded.add(row)
+            removed = True
+        if not removed:
+            return
+        # 被删除的点可能曾支配其他点，只能对相关条目重新计算
+        stale = [key for key, skyline in self._cache.items() if any(p.phone_id == phone_id for p in skyline)]
+        for key in stale:
+            del self._cache[key]
+
+    def _band_points(self, tag_key: Tuple[str, ...], index: int) -> List[SkylinePoint]:
+        points: List[SkylinePoint] = []
+        for phone_id, phone_points in self._points.items():
+            if not self._tags.get(phone_id, set()).issuperset(tag_key):
+                continue
+            points.extend(point for point in phone_points if _band_index(point.price) == index)
+        if self._snapshot is not None:
+            points.extend(self._snapshot_band_points(self._snapshot, tag_key, index))
+        return points
+
+    def _snapshot_band_points(
+        self, snapshot: CatalogSnapshot, tag_key: Tuple[str, ...], index: int
+    ) -> List[SkylinePoint]:
+        """扫描快照的数值列，只为落在价格段内的 SKU 创建候选点"""
+        if self._snapshot_tags is None:
+            self._snapshot_tags = snapshot.tag_table()
+        if any(tag not in self._snapshot_tags for tag in tag_key):
+            return []
+        required = {self._snapshot_tags[tag] for tag in tag_key}
+
+        points: List[SkylinePoint] = []
+        for phone_index in range(snapshot.phone_count):
+            if phone_index in self._superseded:
+                continue
+            if required and not required.issubset(snapshot.tag_ids(phone_index)):
+                continue
+            for sku_index in snapshot.skus(phone_index):
+                price = snapshot.sku_price[sku_index]
+                if math.isnan(price) or _band_index(price) != index:
+                    continue
+                points.append(
+                    SkylinePoint(
+                        phone_id=snapshot.phone_id(phone_index),
+                        sku_id=snapshot.sku_id(sku_index),
+                        price=price,
+                        battery=snapshot.battery[phone_index],
+                        display_size=snapshot.display_size[phone_index],
+                        ram=snapshot.sku_ram[sku_index],
+                    )
+                )
+        return points
+
+    def _snapshot_row(self, phone_id: str) -> Optional[int]:
+        """手机在快照中的行号；首次有变化时才建立索引"""
+        if self._snapshot is None:
+            return None
+        if self._snapshot_rows is None:
+            snapshot = self._snapshot
+            self._snapshot_rows = {snapshot.phone_id(row): row for row in range(snapshot.phone_count)}
+        return self._snapshot_rows.get(phone_id)
+
+    def _band_skyline(self, tag_key: Tuple[str, ...], index: int) -> List[SkylinePoint]:
+        key = (tag_key, index)
+        if key not in self._cache:
+            self._cache[key] = compute_skyline(self._band_points(tag_key, index))
+        return self._cache[key]
+
+
+skyline_service = SkylineService()
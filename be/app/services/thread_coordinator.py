@@ -0,0 +1,207 @@
+"""同一线程的生成协调 - 串行执行生成，并合并短时间内重复提交的相同消息"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import socket
+import time
+import uuid
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import TYPE_CHECKING, AsyncIterator, Dict, Optional, Tuple
+
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from app.config import settings
+from app.database import get_thread_leases_collection
+from app.metrics import registry
+from app.services.generation_service import GenerationStopped
+from app.utils.datetime import now
+
+if TYPE_CHECKING:
+    from app.services.generation_service import Generation
+
+logger = logging.getLogger("app.thread_coordinator")
+
+COALESCED = registry.counter(
+    "generations_coalesced_total", "Duplicate message submissions attached to an existing generation"
+)
+TURN_WAIT = registry.histogram(
+    "generation_turn_wait_seconds", "Time a generation waited for the previous generation on the same thread"
+)
+LEASE_LOST = registry.counter("thread_lease_lost_total", "Thread leases that expired before the generation finished")
+
+# 本进程持有租约时使用的标识前缀
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class LeaseLost(GenerationStopped):
+    """生成期间线程租约过期并被其他 worker 接管，停止生成以免两边的消息交错"""
+
+    code = "lease_lost"
+
+
+@dataclass
+class SubmissionClaim:
+    """一次消息提交；窗口内相同的提交等待第一次提交的生成任务"""
+
+    key: Tuple[str, str]
+    expires_at: float
+    generation: "asyncio.Future[Generation]" = field(default_factory=lambda: asyncio.get_running_loop().create_future())
+
+    async def wait(self) -> "Generation":
+        # 多个重复提交共享同一个 future，单个请求被取消不影响其他请求
+        return await asyncio.shield(self.generation)
+
+    def finished(self) -> bool:
+        """首次提交的生成已结束；之后相同的提交是新的提问，不再合并"""
+        if not self.generation.done() or self.generation.cancelled() or self.generation.exception() is not None:
+            return False
+        return self.generation.result().done
+
+
+@dataclass
+class _ThreadTurn:
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    users: int = 0
+
+
+class ThreadCoordinator:
+    """
+    线程级的生成协调
+
+    同一线程的生成按到达顺序逐个执行，两次生成的 assistant 消息不会交错；
+    多 worker 部署时开启 Mongo 租约，跨进程互斥，租约丢失时停止生成。重复提交的合并只在本进程内进行。
+    """
+
+    def __init__(self) -> None:
+        self._turns: Dict[str, _ThreadTurn] = {}
+        self._claims: Dict[Tuple[str, str], SubmissionClaim] = {}
+
+    def claim(self, thread_id: str, content: str) -> Tuple[SubmissionClaim, bool]:
+        """
+        登记一次消息提交，返回 (提交, 是否为首次)
+
+        同步执行，调用前后之间没有 await，并发的重复请求中只有一个得到首次提交。
+        只在窗口内且首次提交的生成仍在进行时合并。
+        """
+        loop_now = time.monotonic()
+        self._claims = {
+            key: claim
+            for key, claim in self._claims.items()
+            if claim.expires_at > loop_now and not claim.finished()
+        }
+        key = (thread_id, hashlib.sha256(content.encode("utf-8")).hexdigest())
+        existing = self._claims.get(key)
+        if existing is not None:
+            COALESCED.inc()
+            logger.info("Coalescing duplicate message for thread %s", thread_id)
+            return existing, False
+        claim = SubmissionClaim(key=key, expires_at=loop_now + settings.generation_dedupe_window_seconds)
+        if settings.generation_dedupe_window_seconds > 0:
+            self._claims[key] = claim
+        return claim, True
+
+    def resolve(self, claim: SubmissionClaim, generation: "Generation") -> None:
+        """首次提交的生成任务已启动，等待中的重复提交附加到它的事件流"""
+        if not claim.generation.done():
+            claim.generation.set_result(generation)
+
+    def abandon(self, claim: SubmissionClaim, error: BaseException) -> None:
+        """首次提交失败（线程不存在、排队被拒等），重复提交得到相同的错误，之后的提交重新开始"""
+        if self._claims.get(claim.key) is claim:
+            del self._claims[claim.key]
+        if claim.generation.done():
+            return
+        if isinstance(error, Exception):
+            claim.generation.set_exception(error)
+            # 没有重复提交在等待时避免 "exception was never retrieved"
+            claim.generation.exception()
+        else:
+            claim.generation.cancel()
+
+    @asynccontextmanager
+    async def turn(self, thread_id: str) -> AsyncIterator[None]:
+        """在线程的生成轮次内执行；等待前一个生成结束"""
+        state = self._turns.setdefault(thread_id, _ThreadTurn())
+        state.users += 1
+        started = time.monotonic()
+        try:
+            async with state.lock:
+                if settings.generation_thread_lease:
+                    async with self._lease(thread_id):
+                        TURN_WAIT.observe(time.monotonic() - started)
+                        yield
+                else:
+                    TURN_WAIT.observe(time.monotonic() - started)
+                    yield
+        finally:
+            state.users -= 1
+            if state.users == 0 and self._turns.get(thread_id) is state:
+                del self._turns[thread_id]
+
+    @asynccontextmanager
+    async def _lease(self, thread_id: str) -> AsyncIterator[None]:
+        """thread_leases 集合中的租约：过期的租约可被抢占，持有期间定期续期"""
+        owner = f"{WORKER_ID}:{uuid.uuid4().hex[:8]}"
+        ttl = timedelta(seconds=settings.generation_thread_lease_ttl_seconds)
+        leases = get_thread_leases_collection()
+        delay = 0.05
+        while True:
+            current = now()
+            try:
+                await leases.update_one(
+                    {"_id": thread_id, "expires_at": {"$lte": current}},
+                    {"$set": {"owner": owner, "acquired_at": current, "expires_at": current + ttl}},
+                    upsert=True,
+                )
+                break
+            except DuplicateKeyError:
+                # 租约被其他 worker 持有且未过期
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 1.0)
+
+        renewal = asyncio.create_task(self._renew(thread_id, owner, ttl, asyncio.current_task()))
+        try:
+            yield
+        except asyncio.CancelledError:
+            # 由续期任务取消的生成转换为带 code 的停止错误
+            if renewal.done() and not renewal.cancelled() and renewal.result():
+                current = asyncio.current_task()
+                if current is not None:
+                    current.uncancel()
+                raise LeaseLost("对话已在其他位置继续生成，本次回答已停止") from None
+            raise
+        finally:
+            renewal.cancel()
+            await asyncio.gather(renewal, return_exceptions=True)
+            try:
+                await asyncio.shield(leases.delete_one({"_id": thread_id, "owner": owner}))
+            except PyMongoError as e:
+                # 释放失败时租约在 TTL 后自然过期
+                logger.warning("Failed to release lease on thread %s: %s", thread_id, e)
+
+    @staticmethod
+    async def _renew(thread_id: str, owner: str, ttl: timedelta, holder: Optional[asyncio.Task]) -> bool:
+        """定期续期；租约已被接管时取消持有租约的生成并返回 True"""
+        leases = get_thread_leases_collection()
+        while True:
+            await asyncio.sleep(ttl.total_seconds() / 3)
+            try:
+                result = await leases.update_one(
+                    {"_id": thread_id, "owner": owner}, {"$set": {"expires_at": now() + ttl}}
+                )
+            except PyMongoError as e:
+                logger.warning("Failed to renew lease on thread %s: %s", thread_id, e)
+                continue
+            if result.matched_count == 0:
+                LEASE_LOST.inc()
+                logger.warning("Lease on thread %s expired and was taken over, stopping generation", thread_id)
+                if holder is not None:
+                    holder.cancel()
+                return True
+
+
+thread_coordinator = ThreadCoordinator()
@@ -0,0 +1,191 @@
+"""用量计量 - 按天、用户和模型累计 token 用量，计算费用，并给出每次生成的预算"""
+
+import logging
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from pymongo.errors import PyMongoError
+
+from app.config import ModelPrice, settings
+from app.database import get_usage_collection
+from app.metrics import registry
+from app.models.usage import MessageUsage, UsageReport, UsageReportRow
+from app.services.generation_service import GenerationStopped
+from app.utils.datetime import now
+
+logger = logging.getLogger("app.usage_service")
+
+MODEL_TOKENS = registry.counter("llm_model_tokens_total", "Tokens used per model, split into input and output")
+BUDGET_STOPS = registry.counter("generation_budget_stops_total", "Generations stopped by a usage budget, by limit")
+
+
+class BudgetExceeded(GenerationStopped):
+    """生成超出用量预算，在下一次模型调用前停止"""
+
+    code = "budget_exceeded"
+
+    def __init__(self, limit: str, message: str) -> None:
+        super().__init__(message)
+        self.limit = limit
+
+
+@dataclass
+class UsageBudget:
+    """一次生成的预算；None 表示不限制"""
+
+    max_tokens: Optional[int] = None
+    max_model_calls: Optional[int] = None
+    # max_tokens 受当天剩余额度约束（比单次上限更紧）时，为对应的每日上限名称
+    daily_limit: Optional[str] = None
+
+    def check(self, tokens: int, model_calls: int) -> None:
+        """每次调用模型前检查；已用量只在调用结束后可知，最后一次调用可能略微超出"""
+        if self.max_model_calls is not None and model_calls >= self.max_model_calls:
+            BUDGET_STOPS.inc(limit="model_calls")
+            raise BudgetExceeded("model_calls", f"已达到单次回答的模型调用次数上限（{self.max_model_calls}），回答已停止")
+        if self.max_tokens is not None and tokens >= self.max_tokens:
+            if self.daily_limit is not None:
+                BUDGET_STOPS.inc(limit=self.daily_limit)
+                raise BudgetExceeded(self.daily_limit, "今日 token 用量已达上限，请明天再试")
+            BUDGET_STOPS.inc(limit="tokens_per_turn")
+            raise BudgetExceeded("tokens_per_turn", f"已达到单次回答的 token 上限（{self.max_tokens}），回答已停止")
+
+
+def price_for(model: str) -> Optional[ModelPrice]:
+    """模型单价；带版本号的模型名（如 gpt-4o-2024-08-06）按最长前缀匹配"""
+    if model in settings.llm_prices:
+        return settings.llm_prices[model]
+    prefixes = [name for name in settings.llm_prices if model.startswith(name)]
+    return settings.llm_prices[max(prefixes, key=len)] if prefixes else None
+
+
+def cost_of(model: str, input_tokens: int, output_tokens: int) -> Optional[float]:
+    price = price_for(model)
+    if price is None:
+        return None
+    return (input_tokens * price.input_per_million + output_tokens * price.output_per_million) / 1_000_000
+
+
+class UsageService:
+    """
+    用量计量
+
+    每次模型调用的用量按 (日期, 用户, 模型) 累加到 usage_daily 集合，日期按北京时间；
+    用户为 X-User-Id，缺省按线程，与生成调度的排队 key 相同。
+    请求头由客户端提供，按用户的每日上限只是提示性的；所有用户合计的每日上限不受其影响。
+    """
+
+    @staticmethod
+    def today() -> str:
+        return now().date().isoformat()
+
+    async def budget(self, key: str) -> UsageBudget:
+        """按配置和当天已用量给出一次生成的预算"""
+        budget = UsageBudget(
+            max_tokens=settings.usage_max_tokens_per_turn or None,
+            max_model_calls=settings.usage_max_model_calls_per_turn or None,
+        )
+        daily_limits = [
+            ("tokens_per_day", settings.usage_max_tokens_per_day, key),
+            ("tokens_per_day_total", settings.usage_max_tokens_per_day_total, None),
+        ]
+        for limit, max_tokens, limit_key in daily_limits:
+            if not max_tokens:
+                continue
+            remaining = max(0, max_tokens - await self.used_today(limit_key))
+            if budget.max_tokens is None or remaining < budget.max_tokens:
+                budget.max_tokens = remaining
+                budget.daily_limit = limit
+        return budget
+
+    async def used_today(self, key: Optional[str] = None) -> int:
+        """某个用户当天所有模型的 token 用量；key 为 None 时统计所有用户"""
+        query: Dict[str, object] = {"day": self.today()}
+        if key is not None:
+            query["key"] = key
+        docs = await get_usage_collection().find(query, {"input_tokens": 1, "output_tokens": 1}).to_list(length=None)
+        return sum(doc.get("input_tokens", 0) + doc.get("output_tokens", 0) for doc in docs)
+
+    async def record(self, key: str, usage: MessageUsage) -> None:
+        """累加一条 assistant 消息的用量；写入失败只记录日志，不影响生成"""
+        model = usage.model or settings.openai_model
+        MODEL_TOKENS.inc(usage.input_tokens, model=model, kind="input")
+        MODEL_TOKENS.inc(usage.output_tokens, model=model, kind="output")
+        day = self.today()
+        try:
+            await get_usage_collection().update_one(
+                {"_id": f"{day}|{key}|{model}"},
+                {
+                    "$setOnInsert": {"day": day, "key": key, "model": model},
+                    "$inc": {
+                        "input_tokens": usage.input_tokens,
+                        "output_tokens": usage.output_tokens,
+                        "model_calls": usage.model_calls,
+                        "latency_ms": usage.latency_ms,
+                    },
+                },
+                upsert=True,
+            )
+        except PyMongoError as e:
+            logger.warning("Failed to record usage for %s: %s", key, e)
+
+    async def report(self, since: date, until: date, key: Optional[str] = None) -> UsageReport:
+        """[since, until] 区间内按天、按模型汇总的用量与费用"""
+        match: Dict[str, object] = {"day": {"$gte": since.isoformat(), "$lte": until.isoformat()}}
+        if key is not None:
+            match["key"] = key
+        pipeline = [
+            {"$match": match},
+            {
+                "$group": {
+                    "_id": {"day": "$day", "model": "$model"},
+                    "input_tokens": {"$sum": "$input_tokens"},
+                    "output_tokens": {"$sum": "$output_tokens"},
+                    "model_calls": {"$sum": "$model_calls"},
+                    "latency_ms": {"$sum": "$latency_ms"},
+                }
+            },
+            {"$sort": {"_id.day": 1, "_id.model": 1}},
+        ]
+        groups = await get_usage_collection().aggregate(pipeline)
+
+        rows: List[UsageReportRow] = []
+        totals: Dict[str, Tuple[int, int, int, float]] = {}
+        for group in groups:
+            model = group["_id"]["model"]
+            counts = (group["input_tokens"], group["output_tokens"], group["model_calls"], group["latency_ms"])
+            rows.append(self._row(date.fromisoformat(group["_id"]["day"]), model, *counts))
+            previous = totals.get(model, (0, 0, 0, 0.0))
+            totals[model] = tuple(a + b for a, b in zip(previous, counts))  # type: ignore[assignment]
+
+        by_model = [self._row(since, model, *counts) for model, counts in sorted(totals.items())]
+        return UsageReport(
+            since=since,
+            until=until,
+            rows=rows,
+            by_model=by_model,
+            total_cost=sum(row.cost or 0.0 for row in by_model),
+            unpriced_models=[row.model for row in by_model if row.cost is None],
+        )
+
+    @staticmethod
+    def _row(day: date, model: str, input_tokens: int, output_tokens: int, calls: int, latency: float) -> UsageReportRow:
+        return UsageReportRow(
+            day=day,
+            model=model,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            model_calls=calls,
+            latency_ms=latency,
+            cost=cost_of(model, input_tokens, output_tokens),
+        )
+
+    @staticmethod
+    def default_range(days: int = 30) -> Tuple[date, date]:
+        """默认报表区间：包含今天在内的最近 days 天"""
+        until = now().date()
+        return until - timedelta(days=days - 1), until
+
+
+usage_service = UsageService()
@@ -0,0 +1,403 @@
+"""消息写入的 write-behind 队列 - 先写本地日志再异步合并为 bulk_write 批量落库"""
+
+import asyncio
+import fcntl
+import glob
+import logging
+import os
+import socket
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import IO, Any, Dict, List, Optional, Sequence, Tuple
+
+from bson import ObjectId, json_util
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from app.config import settings
+from app.database import get_threads_collection
+from app.metrics import registry
+
+logger = logging.getLogger("app.write_behind")
+
+BATCH_SIZE = registry.histogram(
+    "write_behind_batch_size", "Queued writes per bulk_write batch", buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+)
+BATCH_OPERATIONS = registry.histogram(
+    "write_behind_batch_operations", "Coalesced update operations per bulk_write", buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)
+)
+FLUSH_LATENCY = registry.histogram("write_behind_flush_seconds", "Duration of one bulk_write flush")
+PENDING = registry.gauge("write_behind_pending", "Writes waiting to be flushed")
+FLUSH_ERRORS = registry.counter("write_behind_flush_errors_total", "Failed flushes by kind")
+
+
+@dataclass
+class PendingWrite:
+    """
+    一次追加消息和/或更新字段的写入
+
+    inc_fields 是累加的计数（如线程用量），只能与消息一起写入：
+    消息 _id 作为幂等条件，重试或重放不会重复累加。
+    """
+
+    thread_id: str
+    messages: List[Dict[str, Any]] = field(default_factory=list)
+    set_fields: Dict[str, Any] = field(default_factory=dict)
+    inc_fields: Dict[str, Any] = field(default_factory=dict)
+
+    def to_json(self) -> str:
+        return json_util.dumps(
+            {"thread_id": self.thread_id, "messages": self.messages, "set": self.set_fields, "inc": self.inc_fields}
+        )
+
+    @classmethod
+    def from_json(cls, line: str) -> "PendingWrite":
+        data = json_util.loads(line)
+        return cls(
+            thread_id=data["thread_id"],
+            messages=data["messages"],
+            set_fields=data["set"],
+            inc_fields=data.get("inc") or {},
+        )
+
+
+def update_spec(write: PendingWrite) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    """
+    写入对应的 (filter, update)
+
+    过滤条件带上第一条消息的 _id，重试已经成功执行的更新不会重复追加。
+    """
+    query: Dict[str, Any] = {"_id": ObjectId(write.thread_id)}
+    update: Dict[str, Any] = {}
+    if write.messages:
+        query["messages._id"] = {"$ne": write.messages[0]["_id"]}
+        update["$push"] = {"messages": {"$each": write.messages}}
+    if write.set_fields:
+        update["$set"] = write.set_fields
+    if write.inc_fields and write.messages:
+        update["$inc"] = write.inc_fields
+    return (query, update) if update else None
+
+
+def increment(doc: Dict[str, Any], path: str, amount: Any) -> None:
+    """按点分路径累加，中间的子文档复制后修改，不影响原文档"""
+    head, _, rest = path.partition(".")
+    if not rest:
+        doc[head] = (doc.get(head) or 0) + amount
+        return
+    child = dict(doc.get(head) or {})
+    increment(child, rest, amount)
+    doc[head] = child
+
+
+def coalesce(writes: Sequence[PendingWrite]) -> List[UpdateOne]:
+    """把同一线程的多次写入按到达顺序合并为一个 UpdateOne"""
+    grouped: "OrderedDict[str, PendingWrite]" = OrderedDict()
+    for write in writes:
+        merged = grouped.setdefault(write.thread_id, PendingWrite(thread_id=write.thread_id))
+        merged.messages.extend(write.messages)
+        merged.set_fields.update(write.set_fields)
+        for path, amount in write.inc_fields.items():
+            merged.inc_fields[path] = merged.inc_fields.get(path, 0) + amount
+    specs = (update_spec(merged) for merged in grouped.values())
+    return [UpdateOne(query, update) for query, update in filter(None, specs)]
+
+
+class WriteBehindQueue:
+    """
+    线程消息的 write-behind 队列
+
+    写入先追加到本地日志再返回，后台任务定期把多个请求的写入合并成一次 bulk_write；
+    同一线程的写入在一个批次里合并为一个按序 $push，批次串行执行，保证线程内顺序。
+    失败的批次原样重试，成功前不取新的写入。队列有界，满时写入方等待。
+    未落库的写入通过 overlay 合并到读取结果中，保证读己之写；进程重启时重放日志。
+
+    每个进程写自己的日志 <journal_path>.<主机名>.<pid>，存活期间持有其 .lock 文件的排他锁；
+    启动时在恢复锁内接管锁已释放的日志（进程已退出），不会读到或截断其他运行中进程的写入。
+    """
+
+    def __init__(self, journal_path: Optional[str] = None) -> None:
+        self.base_path = journal_path or settings.write_behind_journal_path
+        # 在 start 中确定，fork 出的 worker 各自使用自己的 pid
+        self.journal_path = self.base_path
+        self._owner_lock: Optional[IO[str]] = None
+        self._pending: List[PendingWrite] = []
+        self._retry: Optional[Tuple[List[PendingWrite], List[UpdateOne]]] = None
+        self._journal_lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._space = asyncio.Condition()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    async def start(self) -> None:
+        """接管已退出进程的日志，重放未落库的写入并启动后台刷写任务"""
+        if not settings.write_behind_enabled:
+            return
+        self.journal_path = f"{self.base_path}.{socket.gethostname()}.{os.getpid()}"
+        adopted = await asyncio.to_thread(self._adopt_orphans)
+        if adopted:
+            logger.info("Adopted %d journals left by exited processes", adopted)
+        replayed = await asyncio.to_thread(self._read_journal)
+        if replayed:
+            self._pending = await self._drop_applied(replayed)
+            logger.info(
+                "Replaying %d journaled writes (%d already applied)",
+                len(self._pending),
+                len(replayed) - len(self._pending),
+            )
+            await self._rewrite_journal()
+        PENDING.set(len(self._pending))
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """停止后台任务并刷写全部剩余写入"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        while self._pending or self._retry:
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Final flush failed, %d writes left in journal", len(self.writes()))
+                break
+        # 剩余写入留在日志中，锁释放后由下一个启动的进程接管
+        await asyncio.to_thread(self._release_journal, not self.writes())
+
+    async def append(
+        self,
+        thread_id: str,
+        messages: Sequence[Dict[str, Any]] = (),
+        set_fields: Optional[Dict[str, Any]] = None,
+        inc_fields: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """追加消息、更新字段并累加计数；日志写入成功即返回，落库由后台完成"""
+        if inc_fields and not messages:
+            raise ValueError("inc_fields must be written together with messages")
+        write = PendingWrite(
+            thread_id=thread_id,
+            messages=list(messages),
+            set_fields=dict(set_fields or {}),
+            inc_fields=dict(inc_fields or {}),
+        )
+        if self._task is None:
+            spec = update_spec(write)
+            if spec is not None:
+                await get_threads_collection().update_one(*spec)
+            return
+
+        async with self._space:
+            await self._space.wait_for(lambda: len(self._pending) < settings.write_behind_max_pending)
+        async with self._journal_lock:
+            await asyncio.to_thread(self._append_journal, write.to_json())
+            self._pending.append(write)
+        PENDING.set(len(self._pending))
+        if len(self._pending) >= settings.write_behind_max_batch:
+            self._wakeup.set()
+
+    def writes(self, thread_id: Optional[str] = None) -> List[PendingWrite]:
+        """尚未确认落库的写入，按到达顺序"""
+        writes = (self._retry[0] if self._retry else []) + self._pending
+        return [write for write in writes if thread_id is None or write.thread_id == thread_id]
+
+    def apply_overlay(self, thread_id: str, doc: Dict[str, Any]) -> Dict[str, Any]:
+        """把未落库的写入合并到从数据库读出的线程文档上"""
+        writes = self.writes(thread_id)
+        if not writes:
+            return doc
+        doc = dict(doc)
+        messages = list(doc.get("messages") or [])
+        seen = {message.get("_id") for message in messages}
+        for write in writes:
+            # 消息已在读到的文档中时，其累加也已生效
+            if any(message["_id"] not in seen for message in write.messages):
+                for path, amount in write.inc_fields.items():
+                    increment(doc, path, amount)
+            messages.extend(message for message in write.messages if message["_id"] not in seen)
+            doc.update(write.set_fields)
+        doc["messages"] = messages
+        return doc
+
+    def discard(self, thread_id: str) -> None:
+        """线程被删除后丢弃其未落库的写入"""
+        self._pending = [write for write in self._pending if write.thread_id != thread_id]
+        PENDING.set(len(self._pending))
+
+    async def drain(self, thread_id: str) -> None:
+        """等待某个线程的写入全部落库，用于必须在其后执行的直接更新"""
+        while self.writes(thread_id):
+            await self.flush()
+
+    async def flush(self) -> None:
+        """执行一个批次；失败时保留批次等待重试"""
+        async with self._flush_lock:
+            if self._retry is None:
+                if not self._pending:
+                    return
+                batch = self._pending[: settings.write_behind_max_batch]
+                self._pending = self._pending[len(batch) :]
+                self._retry = (batch, coalesce(batch))
+                BATCH_SIZE.observe(len(batch))
+            batch, operations = self._retry
+
+            started = asyncio.get_running_loop().time()
+            try:
+                if operations:
+                    await get_threads_collection().bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                # 单条更新失败（如文档超限）重试也不会成功，记录后丢弃
+                FLUSH_ERRORS.inc(kind="write_error")
+                logger.error("Dropping %d failed writes: %s", len(e.details.get("writeErrors", [])), e.details)
+            except Exception:
+                FLUSH_ERRORS.inc(kind="transient")
+                raise
+            finally:
+                FLUSH_LATENCY.observe(asyncio.get_running_loop().time() - started)
+
+            self._retry = None
+            BATCH_OPERATIONS.observe(len(operations))
+            PENDING.set(len(self._pending))
+            await self._rewrite_journal()
+        async with self._space:
+            self._space.notify_all()
+
+    async def _run(self) -> None:
+        backoff = settings.write_behind_flush_interval_seconds
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), backoff)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                backoff = settings.write_behind_flush_interval_seconds
+            except Exception as e:
+                backoff = min(backoff * 2, 5.0)
+                logger.warning("Write-behind flush failed, retrying in %.1fs: %s", backoff, e)
+
+    async def _drop_applied(self, writes: List[PendingWrite]) -> List[PendingWrite]:
+        """重放前去掉已经落库的消息，只剩字段更新的写入保留（重复执行 $set 无副作用）"""
+        thread_ids = {ObjectId(write.thread_id) for write in writes if write.messages}
+        applied = set()
+        cursor = get_threads_collection().find({"_id": {"$in": list(thread_ids)}}, {"messages._id": 1})
+        async for doc in cursor:
+            applied.update(message["_id"] for message in doc.get("messages") or [])
+        remaining = []
+        for write in writes:
+            write.messages = [message for message in write.messages if message["_id"] not in applied]
+            if not write.messages:
+                # 消息已落库说明同一次更新中的累加也已生效
+                write.inc_fields = {}
+            if write.messages or write.set_fields:
+                remaining.append(write)
+        return remaining
+
+    def _read_journal(self) -> List[PendingWrite]:
+        if not os.path.exists(self.journal_path):
+            return []
+        with open(self.journal_path, encoding="utf-8") as journal:
+            writes = [PendingWrite.from_json(line) for line in journal if line.strip()]
+        # 接管过程中崩溃时同一写入可能出现两次，按消息 _id 去重，累加随消息一起去掉
+        seen = set()
+        unique = []
+        for write in writes:
+            if write.messages and all(message["_id"] in seen for message in write.messages):
+                continue
+            seen.update(message["_id"] for message in write.messages)
+            unique.append(write)
+        return unique
+
+    def _adopt_orphans(self) -> int:
+        """
+        锁定本进程的日志，并在恢复锁内把已退出进程的日志追加到本进程日志后删除
+
+        包括升级前所有进程共用的 journal_path 本身。返回接管的日志数。
+        """
+        directory = os.path.dirname(self.base_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._owner_lock = _try_lock(self.journal_path + ".lock")
+        if self._owner_lock is None:
+            raise RuntimeError(f"Write-behind journal {self.journal_path} is locked by another process")
+
+        with open(self.base_path + ".recover.lock", "a") as recover:
+            fcntl.flock(recover, fcntl.LOCK_EX)
+            adopted = 0
+            for path in [self.base_path, *sorted(glob.glob(glob.escape(self.base_path) + ".*"))]:
+                if path == self.journal_path or path.endswith((".lock", ".tmp")) or not os.path.isfile(path):
+                    continue
+                owner = None
+                if path != self.base_path:
+                    owner = _try_lock(path + ".lock")
+                    if owner is None:
+                        continue  # 进程仍在运行
+                with open(path, encoding="utf-8") as orphan:
+                    lines = [line.rstrip("\n") for line in orphan if line.strip()]
+                if lines:
+                    self._append_journal("\n".join(lines))
+                os.remove(path)
+                if owner is not None:
+                    os.remove(path + ".lock")
+                    owner.close()
+                adopted += 1
+            return adopted
+
+    def _release_journal(self, remove: bool) -> None:
+        """释放本进程日志的锁；日志已清空时一并删除"""
+        if self._owner_lock is None:
+            return
+        if remove:
+            for path in (self.journal_path, self.journal_path + ".lock"):
+                if os.path.exists(path):
+                    os.remove(path)
+        self._owner_lock.close()
+        self._owner_lock = None
+
+    def _append_journal(self, line: str) -> None:
+        directory = os.path.dirname(self.journal_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.journal_path, "a", encoding="utf-8") as journal:
+            journal.write(line + "\n")
+            journal.flush()
+            if settings.write_behind_fsync:
+                os.fsync(journal.fileno())
+
+    async def _rewrite_journal(self) -> None:
+        """日志只保留尚未确认的写入"""
+        async with self._journal_lock:
+            lines = [write.to_json() for write in self.writes()]
+            await asyncio.to_thread(self._replace_journal, lines)
+
+    def _replace_journal(self, lines: List[str]) -> None:
+        if not lines:
+            if os.path.exists(self.journal_path):
+                os.truncate(self.journal_path, 0)
+            return
+        temporary = self.journal_path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as journal:
+            journal.write("\n".join(lines) + "\n")
+            journal.flush()
+            if settings.write_behind_fsync:
+                os.fsync(journal.fileno())
+        os.replace(temporary, self.journal_path)
+
+
+def _try_lock(path: str) -> Optional[IO[str]]:
+    """以非阻塞方式对文件加排他锁，成功时返回需要保持打开的文件对象"""
+    handle = open(path, "a")
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        handle.close()
+        return None
+    return handle
+
+
+message_writes = WriteBehindQueue()
@@ -1,5 +1,6 @@
 """LangChain Tools for AI Agent"""
 
+from app.tools.facet_phones import facet_phones
 from app.tools.search_phones import search_phones
 
-__all__ = ["search_phones"]
+__all__ = ["facet_phones", "search_phones"]
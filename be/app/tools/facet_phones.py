@@ -0,0 +1,72 @@
+"""手机分面统计工具 - 让 AI Agent 一次获取候选手机的品牌、标签、价格与电池分布"""
+
+import logging
+from typing import List, Optional
+
+from langchain_core.tools import tool
+
+from app.models.phone import PhoneFacetResult, PhoneSearchParams
+from app.services.phone_service import phone_service
+
+logger = logging.getLogger("app.tools.phone_facets")
+
+
+@tool
+async def facet_phones(
+    keyword: Optional[str] = None,
+    brand: Optional[str] = None,
+    tags: Optional[List[str]] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    ram: Optional[str] = None,
+    storage: Optional[str] = None,
+    min_display_size: Optional[float] = None,
+    max_display_size: Optional[float] = None,
+    min_battery: Optional[int] = None,
+    max_battery: Optional[int] = None,
+    limit: int = 5,
+) -> Optional[PhoneFacetResult]:
+    """
+    统计符合条件的手机分布。
+
+    与 search_phones 使用相同的筛选条件，但除了前若干条结果外，还会返回：
+    - 匹配总数
+    - 每个品牌、每个标签的手机数量
+    - 按价格段、电池容量分段的数量分布
+
+    适合在用户需求还比较模糊时先了解候选范围，再决定如何进一步筛选，避免多次逐个搜索。
+
+    Args:
+        keyword: 关键词搜索
+        brand: 品牌名称
+        tags: 标签列表
+        min_price: 最低价格
+        max_price: 最高价格
+        ram: 运行内存
+        storage: 存储容量
+        limit: 返回的示例结果数量（1-20，默认5）
+
+    Returns:
+        PhoneFacetResult: 分面统计结果
+    """
+    try:
+        params = PhoneSearchParams(
+            keyword=keyword,
+            brand=brand,
+            tags=tags or [],
+            min_price=min_price,
+            max_price=max_price,
+            ram=ram,
+            storage=storage,
+            min_display_size=min_display_size,
+            max_display_size=max_display_size,
+            min_battery=min_battery,
+            max_battery=max_battery,
+            limit=limit,
+        )
+        logger.info("Faceting phones with params: %s", params.model_dump(exclude_defaults=True))
+        return await phone_service.facet_search(params)
+
+    except Exception as e:
+        logger.error("Error faceting phones: %s", e, exc_info=True)
+        return None
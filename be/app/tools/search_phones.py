@@ -3,7 +3,7 @@
 import logging
 from typing import Any, Dict, List, Optional
 
-from langchain.tools import tool
+from langchain_core.tools import tool
 from pydantic import BaseModel, Field
 
 from app.models.phone import Phone, PhoneSearchParams
@@ -12,6 +12,11 @@ from app.services.phone_service import phone_service
 logger = logging.getLogger("app.tools.phone_search")
 
 
+def build_search_params(tags: Optional[List[str]] = None, **kwargs: Any) -> PhoneSearchParams:
+    """把工具调用参数转换为 PhoneSearchParams，供工具本身和批量合并执行共用"""
+    return PhoneSearchParams(tags=tags or [], **{key: value for key, value in kwargs.items() if value is not None})
+
+
 @tool
 async def search_phones(
     keyword: Optional[str] = None,
@@ -26,6 +31,7 @@ async def search_phones(
     min_battery: Optional[int] = None,
     max_battery: Optional[int] = None,
     limit: int = 5,
+    best_value: bool = False,
 ) -> list[Phone]:
     """
     从数据库搜索手机信息。
@@ -38,6 +44,7 @@ async def search_phones(
     - 硬件配置：运行内存、存储容量
     - 屏幕尺寸：最小与最大屏幕尺寸（英寸）
     - 电池容量：最小与最大电池容量（mAh）
+    - 性价比：best_value=True 时只返回价格、电池、屏幕、内存不被其他机型全面超越的手机
 
     Args:
         keyword: 关键词搜索
@@ -48,6 +55,7 @@ async def search_phones(
         ram: 运行内存
         storage: 存储容量
         limit: 返回结果数量（1-20，默认5）
+        best_value: 是否只返回性价比最优的手机（仅结合标签与价格区间），适合“性价比最高”类问题
 
     Returns:
         list[Phone]: 手机列表
@@ -55,10 +63,10 @@ async def search_phones(
     print("calling", locals())
     try:
         # 构建搜索参数
-        params = PhoneSearchParams(
+        params = build_search_params(
             keyword=keyword,
             brand=brand,
-            tags=tags or [],
+            tags=tags,
             min_price=min_price,
             max_price=max_price,
             ram=ram,
@@ -68,12 +76,13 @@ async def search_phones(
             min_battery=min_battery,
             max_battery=max_battery,
             limit=limit,
+            best_value=best_value,
         )
 
         logger.info(
             "Searching phones with params: keyword=%s, brand=%s, tags=%s, "
             "min_price=%s, max_price=%s, ram=%s, storage=%s, "
-            "min_display_size=%s, max_display_size=%s, min_battery=%s, max_battery=%s, limit=%s",
+            "min_display_size=%s, max_display_size=%s, min_battery=%s, max_battery=%s, limit=%s, best_value=%s",
             keyword,
             brand,
             tags,
@@ -86,6 +95,7 @@ async def search_phones(
             min_battery,
             max_battery,
             limit,
+            best_value,
         )
 
         # 执行搜索
@@ -1,6 +1,20 @@
 """Utility helpers for the application."""
 
+from .cache import TTLCache
 from .datetime import now
+from .http import conditional_headers, etag_matches, http_date, is_not_modified, not_modified_since, weak_etag
+from .singleflight import FlightCancelled, SingleFlight
 
-__all__ = ["now"]
+__all__ = [
+    "now",
+    "conditional_headers",
+    "etag_matches",
+    "http_date",
+    "is_not_modified",
+    "not_modified_since",
+    "weak_etag",
+    "FlightCancelled",
+    "SingleFlight",
+    "TTLCache",
+]
 
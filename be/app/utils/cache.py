@@ -0,0 +1,73 @@
+"""进程内 TTL + LRU 缓存"""
+
+import time
+from collections import OrderedDict
+from typing import Generic, Hashable, List, Optional, Tuple, TypeVar
+
+from app.metrics import registry
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+LOOKUPS = registry.counter("cache_lookups_total", "In-process cache lookups by cache name and result")
+EVICTIONS = registry.counter("cache_evictions_total", "In-process cache evictions by cache name")
+
+
+class TTLCache(Generic[K, V]):
+    """
+    带过期时间的 LRU 缓存
+
+    条目超过 ttl_seconds 后视为不存在；条目数超过 max_entries 时淘汰最久未使用的条目。
+    max_entries 为 0 时缓存关闭，get 总是返回 None。
+    """
+
+    def __init__(self, name: str, max_entries: int, ttl_seconds: float) -> None:
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[K, Tuple[float, V]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: K) -> Optional[V]:
+        value = self.peek(key)
+        if value is None:
+            LOOKUPS.inc(cache=self.name, result="miss")
+            return None
+        self._entries.move_to_end(key)
+        LOOKUPS.inc(cache=self.name, result="hit")
+        return value
+
+    def peek(self, key: K) -> Optional[V]:
+        """读取但不计入命中统计，也不调整淘汰顺序"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[key]
+            return None
+        return value
+
+    def set(self, key: K, value: V, ttl_seconds: Optional[float] = None) -> None:
+        if self.max_entries <= 0:
+            return
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            EVICTIONS.inc(cache=self.name)
+
+    def items(self) -> List[Tuple[K, V]]:
+        """未过期的条目，不调整淘汰顺序"""
+        current = time.monotonic()
+        return [(key, value) for key, (expires_at, value) in self._entries.items() if current < expires_at]
+
+    def pop(self, key: K) -> Optional[V]:
+        entry = self._entries.pop(key, None)
+        return entry[1] if entry is not None else None
+
+    def clear(self) -> None:
+        self._entries.clear()
@@ -6,4 +6,11 @@ BJ = timezone(timedelta(hours=8))
 
 
 def now() -> datetime:
-    return datetime.now(tz=BJ)
\ No newline at end of file
+    return datetime.now(tz=BJ)
+
+
+def as_utc(value: datetime) -> datetime:
+    """转换为带时区的 UTC 时间；没有时区的时间按 UTC 解释，与 MongoDB 存储的时间一致"""
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
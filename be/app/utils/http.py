@@ -0,0 +1,67 @@
+"""HTTP caching helpers."""
+
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Dict, Optional
+
+
+def _opaque_tag(etag: str) -> str:
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+def weak_etag(*parts: object) -> str:
+    """由若干版本信息派生弱 ETag"""
+    digest = hashlib.sha1(repr(parts).encode()).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """按 If-None-Match 的弱比较规则判断 ETag 是否命中"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (tag.strip() for tag in if_none_match.split(","))
+    return any(_opaque_tag(tag) == _opaque_tag(etag) for tag in candidates if tag)
+
+
+def http_date(value: datetime) -> str:
+    """格式化为 HTTP-date（RFC 7231）"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+
+
+def not_modified_since(if_modified_since: Optional[str], last_modified: datetime) -> bool:
+    """If-Modified-Since 不早于资源的最后修改时间（精确到秒）时返回 True"""
+    if not if_modified_since:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    return int(last_modified.timestamp()) <= int(since.timestamp())
+
+
+def conditional_headers(etag: str, last_modified: datetime) -> Dict[str, str]:
+    """私有且每次都需重新验证的缓存头"""
+    return {
+        "ETag": etag,
+        "Last-Modified": http_date(last_modified),
+        "Cache-Control": "private, no-cache",
+    }
+
+
+def is_not_modified(
+    etag: str,
+    last_modified: datetime,
+    if_none_match: Optional[str],
+    if_modified_since: Optional[str],
+) -> bool:
+    """If-None-Match 优先，未携带时才使用 If-Modified-Since"""
+    if if_none_match:
+        return etag_matches(if_none_match, etag)
+    return not_modified_since(if_modified_since, last_modified)
@@ -0,0 +1,123 @@
+"""Single-flight - 相同 key 的并发调用只执行一次，结果分发给所有调用方"""
+
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Dict, Generic, List, Optional, TypeVar
+
+from app.metrics import registry
+
+logger = logging.getLogger("app.singleflight")
+
+T = TypeVar("T")
+
+CALLS = registry.counter("singleflight_calls_total", "Single-flight calls by group and role (leader/follower)")
+
+
+class FlightCancelled(RuntimeError):
+    """加入的共享执行在结束前被取消；订阅者本身没有被取消，因此不使用 CancelledError"""
+
+
+@dataclass
+class _StreamFlight(Generic[T]):
+    """一次共享的流式执行，产出保存在只追加的列表中，每个订阅者各自持有读取位置"""
+
+    items: List[T] = field(default_factory=list)
+    done: bool = False
+    error: Optional[BaseException] = None
+    subscribers: int = 0
+    task: Optional[asyncio.Task] = None
+    _changed: asyncio.Condition = field(default_factory=asyncio.Condition)
+
+
+class SingleFlight(Generic[T]):
+    """
+    合并相同 key 的并发调用
+
+    call 用于普通协程，stream 用于异步迭代器。流式执行由后台任务驱动，产出写入共享列表后立即继续，
+    不会等待任何订阅者，慢的消费者只会落后于列表末尾而不会拖慢生产者和其他订阅者。
+    所有订阅者都离开后取消后台任务，并立即移除该执行，之后的调用重新开始。
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._calls: Dict[str, "asyncio.Future[T]"] = {}
+        self._streams: Dict[str, _StreamFlight[T]] = {}
+
+    def in_flight(self, key: str) -> bool:
+        return key in self._calls or key in self._streams
+
+    async def call(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """同一 key 执行中时等待已有的执行结果，调用方被取消不影响其他等待者"""
+        future = self._calls.get(key)
+        if future is None:
+            CALLS.inc(group=self.name, role="leader")
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda done: self._finish_call(key, done))
+        else:
+            CALLS.inc(group=self.name, role="follower")
+            logger.debug("Joined in-flight %s call %s", self.name, key[:12])
+        return await asyncio.shield(future)
+
+    def _finish_call(self, key: str, future: "asyncio.Future[T]") -> None:
+        self._calls.pop(key, None)
+        # 所有等待者都已取消时也要取走异常，避免 "exception was never retrieved"
+        if not future.cancelled():
+            future.exception()
+
+    async def stream(self, key: str, factory: Callable[[], AsyncIterator[T]]) -> AsyncIterator[T]:
+        """订阅 key 对应的流式执行，没有时由 factory 创建；每个订阅者都会从头收到完整输出"""
+        flight = self._streams.get(key)
+        if flight is None:
+            CALLS.inc(group=self.name, role="leader")
+            flight = _StreamFlight()
+            self._streams[key] = flight
+            flight.task = asyncio.create_task(self._drive(key, flight, factory))
+        else:
+            CALLS.inc(group=self.name, role="follower")
+            logger.debug("Joined in-flight %s stream %s", self.name, key[:12])
+
+        flight.subscribers += 1
+        cursor = 0
+        try:
+            while True:
+                async with flight._changed:
+                    await flight._changed.wait_for(lambda: len(flight.items) > cursor or flight.done)
+                    pending = flight.items[cursor:]
+                    finished = flight.done
+                for item in pending:
+                    cursor += 1
+                    yield item
+                if finished and cursor >= len(flight.items):
+                    if isinstance(flight.error, asyncio.CancelledError):
+                        raise FlightCancelled(f"In-flight {self.name} stream was cancelled")
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and flight.task is not None and not flight.task.done():
+                logger.debug("No subscribers left for %s stream %s, cancelling", self.name, key[:12])
+                # 取消要等到后台任务下次运行才生效，先移除，期间到达的调用不会加入将被取消的执行
+                if self._streams.get(key) is flight:
+                    del self._streams[key]
+                flight.task.cancel()
+
+    async def _drive(self, key: str, flight: _StreamFlight[T], factory: Callable[[], AsyncIterator[T]]) -> None:
+        try:
+            async for item in factory():
+                async with flight._changed:
+                    flight.items.append(item)
+                    flight._changed.notify_all()
+        except BaseException as e:
+            flight.error = e
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            # 结束后新的调用重新执行，不复用已完成的结果
+            if self._streams.get(key) is flight:
+                del self._streams[key]
+            async with flight._changed:
+                flight.done = True
+                flight._changed.notify_all()
@@ -0,0 +1,238 @@
+"""Mongo 驱动基准：在同一份数据上用线上的查询组合比较 Motor、PyMongo 原生异步客户端和内存实现
+
+用法:
+    uv run python scripts/bench_mongo_drivers.py
+    uv run python scripts/bench_mongo_drivers.py --drivers motor pymongo --concurrency 64 --duration 30
+
+每个驱动各自连接、写入测试数据（默认库 phone_recommend_bench，结束后删除），预热后并发执行
+按权重混合的线程读写与手机搜索，输出每种操作的 ops/sec、p50、p99，以及总吞吐最高的驱动。
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import sys
+import time
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from bson import ObjectId
+
+from app.config import settings
+from app.database import close_mongo_connection, connect_to_mongo, get_phones_collection, get_threads_collection
+from app.models import PhoneSearchParams
+from app.repository import Repository
+from app.services.phone_service import phone_service
+from app.utils.datetime import now
+from seed_phones import SAMPLE_PHONES
+
+Operation = Callable[[random.Random], Awaitable[Any]]
+
+TAGS = sorted({tag for phone in SAMPLE_PHONES for tag in phone.tags})
+BRANDS = sorted({phone.brand for phone in SAMPLE_PHONES})
+
+
+class Workload:
+    """与 ChatService / PhoneService 相同形状的查询；直接走 Repository，不经过服务层缓存"""
+
+    def __init__(self, threads: Repository, phones: Repository) -> None:
+        self.threads = threads
+        self.phones = phones
+        self.thread_ids: List[ObjectId] = []
+        self.phone_ids: List[ObjectId] = []
+
+    async def seed(self, phone_count: int, thread_count: int, messages_per_thread: int) -> None:
+        await self.phones.delete_many({})
+        await self.threads.delete_many({})
+        started = now()
+        phones = []
+        for index in range(phone_count):
+            doc = SAMPLE_PHONES[index % len(SAMPLE_PHONES)].py()
+            doc.pop("_id", None)
+            doc["model"] = f"{doc['model']} #{index}"
+            doc["updated_at"] = started - timedelta(seconds=index)
+            for sku in doc["skus"]:
+                sku["price"] = round(sku["price"] * random.uniform(0.8, 1.2))
+            phones.append(doc)
+        self.phone_ids = (await self.phones.insert_many(phones)).inserted_ids
+        threads = [
+            {
+                "title": f"bench {index}",
+                "created_at": started,
+                "updated_at": started - timedelta(seconds=index),
+                "messages": [
+                    {
+                        "_id": str(ObjectId()),
+                        "role": "user" if position % 2 == 0 else "assistant",
+                        "content": "推荐一款拍照好的手机" * 5,
+                        "created_at": started - timedelta(seconds=messages_per_thread - position),
+                    }
+                    for position in range(messages_per_thread)
+                ],
+            }
+            for index in range(thread_count)
+        ]
+        self.thread_ids = (await self.threads.insert_many(threads)).inserted_ids
+
+    def operations(self) -> List[Tuple[str, int, Operation]]:
+        """(名称, 权重, 操作)；权重大致对应一轮对话中各查询的次数"""
+        return [
+            ("threads.get", 20, self.get_thread),
+            ("threads.list", 5, self.list_threads),
+            ("threads.append", 20, self.append_message),
+            ("threads.messages_since", 10, self.messages_since),
+            ("phones.search", 20, self.search_phones),
+            ("phones.list", 10, self.list_phones),
+            ("phones.get", 10, self.get_phone),
+            ("phones.facets", 5, self.facet_phones),
+        ]
+
+    async def get_thread(self, rng: random.Random) -> Any:
+        return await self.threads.find_one({"_id": rng.choice(self.thread_ids)})
+
+    async def list_threads(self, rng: random.Random) -> Any:
+        return await self.threads.find().sort("updated_at", -1).limit(100).to_list(length=100)
+
+    async def append_message(self, rng: random.Random) -> Any:
+        message = {"_id": str(ObjectId()), "role": "user", "content": "还有别的推荐吗", "created_at": now()}
+        return await self.threads.update_one(
+            {"_id": rng.choice(self.thread_ids), "messages._id": {"$ne": message["_id"]}},
+            {"$push": {"messages": {"$each": [message]}}, "$set": {"updated_at": now()}},
+        )
+
+    async def messages_since(self, rng: random.Random) -> Any:
+        since = now() - timedelta(seconds=rng.randint(1, 30))
+        pipeline = [
+            {"$match": {"_id": rng.choice(self.thread_ids)}},
+            {
+                "$project": {
+                    "messages": {
+                        "$filter": {
+                            "input": {"$ifNull": ["$messages", []]},
+                            "cond": {"$gt": ["$$this.created_at", since]},
+                        }
+                    }
+                }
+            },
+        ]
+        return await self.threads.aggregate(pipeline)
+
+    async def search_phones(self, rng: random.Random) -> Any:
+        params = PhoneSearchParams(tags=[rng.choice(TAGS)], max_price=rng.choice([2000, 3000, 5000]), limit=5)
+        query = phone_service.build_search_query(params)
+        return await self.phones.find(query).sort("updated_at", -1).limit(params.limit).to_list(length=params.limit)
+
+    async def list_phones(self, rng: random.Random) -> Any:
+        query = {"brand": rng.choice(BRANDS)}
+        cursor = self.phones.find(query).sort([("updated_at", -1), ("_id", -1)]).limit(21)
+        return await cursor.to_list(length=21)
+
+    async def get_phone(self, rng: random.Random) -> Any:
+        return await self.phones.find_one({"_id": rng.choice(self.phone_ids)})
+
+    async def facet_phones(self, rng: random.Random) -> Any:
+        query = phone_service.build_search_query(PhoneSearchParams(tags=[rng.choice(TAGS)]))
+        pipeline = [
+            {"$match": query},
+            {
+                "$facet": {
+                    "hits": [{"$sort": {"updated_at": -1}}, {"$limit": 10}],
+                    "total": [{"$count": "count"}],
+                    "brands": [{"$sortByCount": "$brand"}, {"$limit": 10}],
+                }
+            },
+        ]
+        return await self.phones.aggregate(pipeline)
+
+
+async def run_mix(workload: Workload, concurrency: int, duration: float, seed: int) -> Dict[str, List[float]]:
+    """并发执行 duration 秒，返回每种操作的耗时（秒）"""
+    operations = workload.operations()
+    names = [name for name, _, _ in operations]
+    weights = [weight for _, weight, _ in operations]
+    by_name = {name: operation for name, _, operation in operations}
+    latencies: Dict[str, List[float]] = {name: [] for name in names}
+    deadline = time.perf_counter() + duration
+
+    async def worker(index: int) -> None:
+        rng = random.Random(seed + index)
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            started = time.perf_counter()
+            await by_name[name](rng)
+            latencies[name].append(time.perf_counter() - started)
+
+    await asyncio.gather(*(worker(index) for index in range(concurrency)))
+    return latencies
+
+
+def percentile(values: List[float], quantile: float) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[int(quantile * 100) - 1]
+
+
+async def bench_driver(driver: str, args: argparse.Namespace) -> Dict[str, Any]:
+    settings.mongodb_driver = driver
+    await connect_to_mongo()
+    try:
+        workload = Workload(get_threads_collection(), get_phones_collection())
+        await workload.seed(args.phones, args.threads, args.messages)
+        await run_mix(workload, args.concurrency, args.warmup, args.seed)
+        latencies = await run_mix(workload, args.concurrency, args.duration, args.seed)
+        if not args.keep:
+            await workload.phones.delete_many({})
+            await workload.threads.delete_many({})
+    finally:
+        await close_mongo_connection()
+
+    every = [value for values in latencies.values() for value in values]
+    return {
+        "driver": driver,
+        "ops_per_sec": len(every) / args.duration,
+        "p50_ms": percentile(every, 0.5) * 1000,
+        "p99_ms": percentile(every, 0.99) * 1000,
+        "operations": {
+            name: (len(values) / args.duration, percentile(values, 0.5) * 1000, percentile(values, 0.99) * 1000)
+            for name, values in latencies.items()
+        },
+    }
+
+
+async def main(args: argparse.Namespace) -> int:
+    settings.mongodb_db_name = args.db
+    results = []
+    for driver in args.drivers:
+        print(f"== {driver}", flush=True)
+        result = await bench_driver(driver, args)
+        for name, (ops, p50, p99) in result["operations"].items():
+            print(f"  {name:24s} {ops:9.0f} ops/s  p50 {p50:7.2f} ms  p99 {p99:7.2f} ms")
+        print(
+            f"  {'total':24s} {result['ops_per_sec']:9.0f} ops/s  "
+            f"p50 {result['p50_ms']:7.2f} ms  p99 {result['p99_ms']:7.2f} ms"
+        )
+        results.append(result)
+
+    # 内存实现只作对照，不参与默认驱动的选择
+    candidates = [result for result in results if result["driver"] != "memory"]
+    if candidates:
+        best = max(candidates, key=lambda result: result["ops_per_sec"])
+        print(f"fastest: {best['driver']} ({best['ops_per_sec']:.0f} ops/s, p99 {best['p99_ms']:.2f} ms)")
+        print(f"suggested setting: MONGODB_DRIVER={best['driver']}")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare MongoDB drivers on the chat and catalog query mix")
+    parser.add_argument("--drivers", nargs="+", default=["motor", "pymongo"], choices=["motor", "pymongo", "memory"])
+    parser.add_argument("--db", default="phone_recommend_bench", help="database to seed; its collections are emptied")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--phones", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=20, help="messages per seeded thread")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--keep", action="store_true", help="keep the seeded data")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,109 @@
+"""启动耗时基准：`import app.main` 的导入耗时，以及从启动 uvicorn 到 /health 首次返回 200 的冷启动耗时
+
+用法:
+    uv run python scripts/bench_startup.py
+    uv run python scripts/bench_startup.py --runs 5 --import-budget-ms 1500 --top 15
+
+导入耗时的中位数超过预算时以非零状态退出，可放进 CI 防止重新引入启动时的重量级导入。
+"""
+
+import argparse
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_PROBE = "import time; started = time.perf_counter(); import app.main; print(time.perf_counter() - started)"
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def _run_python(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *args], cwd=ROOT, capture_output=True, text=True, check=True)
+
+
+def measure_import(runs: int) -> List[float]:
+    """每次在新进程中导入 app.main，返回各次耗时（秒）"""
+    return [float(_run_python("-c", IMPORT_PROBE).stdout.strip()) for _ in range(runs)]
+
+
+def slowest_imports(top: int) -> List[Tuple[str, int, int]]:
+    """`-X importtime` 中累计耗时最长的模块，返回 (模块, 自身微秒, 累计微秒)"""
+    stderr = _run_python("-X", "importtime", "-c", "import app.main").stderr
+    totals: Dict[str, Tuple[int, int]] = {}
+    for line in stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            totals[match.group(4)] = (int(match.group(1)), int(match.group(2)))
+    ranked = sorted(totals.items(), key=lambda item: item[1][1], reverse=True)
+    return [(name, own, cumulative) for name, (own, cumulative) in ranked[:top]]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_cold_start(timeout: float) -> float:
+    """启动 uvicorn 并轮询 /health，返回首次健康所用的秒数"""
+    port = _free_port()
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        with httpx.Client(timeout=1.0) as client:
+            while time.perf_counter() - started < timeout:
+                if process.poll() is not None:
+                    raise RuntimeError(f"uvicorn exited with status {process.returncode}")
+                try:
+                    if client.get(f"http://127.0.0.1:{port}/health").status_code == 200:
+                        return time.perf_counter() - started
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.01)
+        raise TimeoutError(f"/health not ready after {timeout:.0f}s")
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Measure import time and cold start to the first healthy /health")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--import-budget-ms", type=float, default=1500)
+    parser.add_argument("--top", type=int, default=10, help="show the N slowest imports")
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    imports = measure_import(args.runs)
+    import_ms = statistics.median(imports) * 1000
+    print(f"import app.main: median {import_ms:.0f} ms, min {min(imports) * 1000:.0f} ms over {args.runs} runs")
+    print("slowest imports (cumulative ms / self ms):")
+    for name, own, cumulative in slowest_imports(args.top):
+        print(f"  {cumulative / 1000:8.1f} {own / 1000:8.1f}  {name}")
+
+    cold_starts = [measure_cold_start(args.timeout) for _ in range(args.runs)]
+    print(f"cold start to healthy /health: median {statistics.median(cold_starts) * 1000:.0f} ms")
+
+    if import_ms > args.import_budget_ms:
+        print(f"import time {import_ms:.0f} ms exceeds budget {args.import_budget_ms:.0f} ms", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,54 @@
+"""把 phones 集合导出为二进制目录快照，供多个 uvicorn worker 以只读 mmap 共享
+
+用法:
+    uv run python scripts/export_catalog_snapshot.py
+    uv run python scripts/export_catalog_snapshot.py --watch 30
+
+--watch 模式按间隔检查目录版本，版本变化时导出新快照并原子切换 CURRENT 指针；
+worker 在 CATALOG_SNAPSHOT_CHECK_SECONDS 内发现新版本并重新映射。
+"""
+
+import argparse
+import asyncio
+import logging
+from typing import Optional
+
+from app.config import settings
+from app.database import close_mongo_connection, connect_to_mongo, get_phones_collection
+from app.services.catalog_snapshot import SNAPSHOT_PROJECTION, CatalogSnapshotStore
+from app.services.phone_service import phone_service
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def export_once(store: CatalogSnapshotStore, last_version: Optional[str] = None) -> str:
+    """目录版本与上次导出不同时导出新快照，返回当前版本"""
+    version = await phone_service.catalog_version()
+    if version == last_version:
+        return version
+    cursor = get_phones_collection().find({}, SNAPSHOT_PROJECTION).sort("_id", 1)
+    docs = [doc async for doc in cursor]
+    path = await asyncio.to_thread(store.publish, docs, version)
+    logger.info("Exported %d phones as snapshot %s to %s", len(docs), version, path)
+    return version
+
+
+async def main(directory: str, watch: float) -> None:
+    await connect_to_mongo()
+    store = CatalogSnapshotStore(directory)
+    try:
+        version = await export_once(store)
+        while watch > 0:
+            await asyncio.sleep(watch)
+            version = await export_once(store, version)
+    finally:
+        await close_mongo_connection()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the phone catalog as a memory-mappable snapshot")
+    parser.add_argument("--dir", default=settings.catalog_snapshot_dir, help="snapshot directory")
+    parser.add_argument("--watch", type=float, default=0, help="re-export every N seconds when the catalog changes")
+    args = parser.parse_args()
+    asyncio.run(main(args.dir, args.watch))
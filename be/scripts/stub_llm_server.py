@@ -0,0 +1,82 @@
+"""OpenAI 兼容的本地桩服务，用于在本地验证 LLM 后端池的负载均衡、故障切换和对冲请求
+
+用法:
+    uv run python scripts/stub_llm_server.py --port 9001 --first-token-delay 0.2
+    uv run python scripts/stub_llm_server.py --port 9002 --first-token-delay 2 --fail-rate 0.2
+
+然后配置:
+    LLM_BACKENDS='[{"name": "a", "base_url": "http://127.0.0.1:9001/v1"}, {"name": "b", "base_url": "http://127.0.0.1:9002/v1"}]'
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+
+def create_app(first_token_delay: float, jitter: float, token_delay: float, fail_rate: float, reply: str) -> FastAPI:
+    app = FastAPI(title="Stub LLM")
+
+    def chunk(completion_id: str, model: str, delta: Dict[str, Any], finish_reason: Any = None) -> str:
+        payload = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        if random.random() < fail_rate:
+            raise HTTPException(status_code=503, detail="stub failure")
+
+        model = body.get("model", "stub")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+        tokens = list(reply)
+
+        async def stream() -> AsyncIterator[str]:
+            await asyncio.sleep(max(0.0, first_token_delay + random.uniform(-jitter, jitter)))
+            yield chunk(completion_id, model, {"role": "assistant", "content": ""})
+            for token in tokens:
+                yield chunk(completion_id, model, {"content": token})
+                await asyncio.sleep(token_delay)
+            yield chunk(completion_id, model, {}, "stop")
+            if include_usage:
+                usage = {"prompt_tokens": 10, "completion_tokens": len(tokens), "total_tokens": 10 + len(tokens)}
+                payload = {"id": completion_id, "object": "chat.completion.chunk", "model": model, "choices": [], "usage": usage}
+                yield f"data: {json.dumps(payload)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9001)
+    parser.add_argument("--first-token-delay", type=float, default=0.1, help="首 token 延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="首 token 延迟的随机抖动（秒）")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="相邻 token 的间隔（秒）")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="直接返回 503 的概率")
+    parser.add_argument("--reply", default="这是一条来自桩服务的回复。")
+    args = parser.parse_args()
+
+    app = create_app(args.first_token_delay, args.jitter, args.token_delay, args.fail_rate, args.reply)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,7 @@ from motor.motor_asyncio import AsyncIOMotorClient
 
 from app.config import settings
 from app.models import Phone, PhoneSku
+from app.services.index_service import index_service
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -426,13 +427,8 @@ async def seed_phones():
     result = await collection.insert_many(documents)
     logger.info("Inserted %d phones successfully", len(result.inserted_ids))
 
-    # 创建索引以提高搜索性能
-    logger.info("Creating indexes...")
-    await collection.create_index("brand")
-    await collection.create_index("model")
-    await collection.create_index("tags")
-    await collection.create_index("updated_at")
-    logger.info("Indexes created successfully")
+    # 创建索引以提高搜索性能，索引声明见 app/services/index_service.py
+    await index_service.ensure_indexes(db)
 
     client.close()
     logger.info("Seeding completed!")
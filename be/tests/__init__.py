@@ -0,0 +1,17 @@
+"""服务层测试 - 使用内存 Repository（MONGODB_DRIVER=memory），不需要 MongoDB 与模型服务
+
+运行:
+    python -m unittest discover -s tests -t .
+"""
+
+import os
+import tempfile
+
+# 必须在导入 app.config 之前设置
+os.environ["MONGODB_DRIVER"] = "memory"
+os.environ["CATALOG_SNAPSHOT_ENABLED"] = "false"
+os.environ["CATALOG_SYNC_MODE"] = "off"
+os.environ["WRITE_BEHIND_JOURNAL_PATH"] = os.path.join(tempfile.mkdtemp(prefix="phone-recommend-tests-"), "journal")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("OPENAI_MODEL", "test")
+os.environ.setdefault("OPENAI_API_BASE", "http://127.0.0.1:9/v1")
@@ -0,0 +1,99 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import uvicorn
+from langchain_core.messages import HumanMessage
+
+from app.config import LLMBackendConfig, settings
+from app.services.llm_pool import LLMBackendPool
+from scripts.stub_llm_server import create_app
+
+
+class LLMBackendPoolTest(unittest.IsolatedAsyncioTestCase):
+    """用 scripts/stub_llm_server.py 的桩服务驱动两个后端"""
+
+    async def asyncSetUp(self) -> None:
+        patches = [
+            mock.patch.object(settings, "llm_hedge_enabled", False),
+            mock.patch.object(settings, "llm_hedge_max_delay_seconds", 0.2),
+            mock.patch.object(settings, "llm_backend_max_retries", 0),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    async def start_backend(self, name: str, first_token_delay: float = 0.0, fail_rate: float = 0.0) -> LLMBackendConfig:
+        app = create_app(first_token_delay, jitter=0.0, token_delay=0.0, fail_rate=fail_rate, reply="好")
+        server = uvicorn.Server(
+            uvicorn.Config(app, host="127.0.0.1", port=0, log_level="critical", timeout_graceful_shutdown=1)
+        )
+        task = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.01)
+        port = server.servers[0].sockets[0].getsockname()[1]
+
+        async def stop() -> None:
+            server.should_exit = True
+            await task
+
+        self.addAsyncCleanup(stop)
+        return LLMBackendConfig(name=name, base_url=f"http://127.0.0.1:{port}/v1", api_key="test", model="stub")
+
+    async def create_pool(self, *configs: LLMBackendConfig) -> LLMBackendPool:
+        pool = LLMBackendPool(configs)
+        self.addAsyncCleanup(pool.aclose)
+        # 与服务启动时一样先构建客户端，避免首次请求在事件循环中同步导入
+        await asyncio.to_thread(pool.warm_up)
+        return pool
+
+    async def test_hedge_loser_is_recorded_as_abandoned(self) -> None:
+        pool = await self.create_pool(
+            await self.start_backend("slow", first_token_delay=5), await self.start_backend("fast")
+        )
+        slow, fast = pool.backends
+        with mock.patch.object(settings, "llm_hedge_enabled", True):
+            response = await pool.ainvoke([HumanMessage("hi")])
+
+        self.assertEqual(response.content, "好")
+        # 落败的后端按已等待的对冲期限计入延迟，下次选择时排在后面
+        self.assertGreaterEqual(slow.latency_ewma, 0.2)
+        self.assertEqual(slow.consecutive_failures, 0)
+        self.assertLess(fast.latency_ewma, slow.latency_ewma)
+        self.assertIs(pool.pick(), fast)
+        self.assertEqual((slow.outstanding, fast.outstanding), (0, 0))
+
+    async def test_caller_cancel_records_nothing(self) -> None:
+        pool = await self.create_pool(
+            await self.start_backend("a", first_token_delay=5), await self.start_backend("b", first_token_delay=5)
+        )
+        with mock.patch.object(settings, "llm_hedge_enabled", True):
+            task = asyncio.create_task(pool.ainvoke([HumanMessage("hi")]))
+            # 已发起对冲，两个请求都还在等待首 token 时取消
+            await asyncio.sleep(0.5)
+            self.assertEqual([backend.outstanding for backend in pool.backends], [1, 1])
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        for backend in pool.backends:
+            self.assertIsNone(backend.latency_ewma)
+            self.assertEqual(backend.consecutive_failures, 0)
+            self.assertEqual(backend.outstanding, 0)
+
+    async def test_failing_backend_fails_over(self) -> None:
+        pool = await self.create_pool(
+            await self.start_backend("broken", fail_rate=1.0), await self.start_backend("healthy")
+        )
+        broken, healthy = pool.backends
+        response = await pool.ainvoke([HumanMessage("hi")])
+
+        self.assertEqual(response.content, "好")
+        self.assertEqual(broken.consecutive_failures, 1)
+        self.assertGreater(broken.error_ewma, 0)
+        self.assertIsNotNone(healthy.latency_ewma)
+        self.assertEqual((broken.outstanding, healthy.outstanding), (0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
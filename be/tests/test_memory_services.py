@@ -0,0 +1,509 @@
+import asyncio
+import os
+from collections import deque
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from typing import List
+from unittest import mock
+
+from bson import ObjectId
+from pymongo.errors import AutoReconnect, BulkWriteError, OperationFailure
+from fastapi import HTTPException
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+
+from app.config import ModelPrice, settings
+from app.database import close_mongo_connection, connect_to_mongo, get_thread_leases_collection
+from app.models.message import MessageCreate
+from app.models.phone import PhoneSearchParams, PhoneSkuUpdate, PhoneUpsert
+from app.models.thread import ThreadCreate, ThreadUpdate
+from app.models.usage import MessageUsage
+from app.services.catalog_snapshot import CatalogSnapshot, CatalogSnapshotStore
+from app.services.chat_service import chat_service
+from app.services.generation_service import Generation
+from app.services.llm_service import llm_service
+from app.services.phone_service import CHANGE_STREAM_HISTORY_LOST, CatalogSync, PhoneService, document_matches
+from app.services.skyline_service import skyline_service
+from app.services.thread_coordinator import LeaseLost, ThreadCoordinator
+from app.services.usage_service import BudgetExceeded, UsageBudget, price_for, usage_service
+from app.services.write_behind import message_writes
+
+
+class MemoryStoreTestCase(unittest.IsolatedAsyncioTestCase):
+    """每个用例使用新的内存库"""
+
+    async def asyncSetUp(self) -> None:
+        await connect_to_mongo()
+
+    async def asyncTearDown(self) -> None:
+        await close_mongo_connection()
+
+
+class ChatServiceTest(MemoryStoreTestCase):
+    async def test_messages_round_trip(self) -> None:
+        thread = await chat_service.create_thread(ThreadCreate(title=None))
+        await chat_service.add_message(thread.id, MessageCreate(content="推荐一款拍照手机"))
+
+        messages = await chat_service.get_messages(thread.id)
+        self.assertEqual([(m.role, m.content) for m in messages], [("user", "推荐一款拍照手机")])
+        self.assertIsInstance(messages[0].id, ObjectId)
+        self.assertEqual((await chat_service.get_thread(thread.id)).title, "推荐一款拍照手机")
+
+    async def test_since_accepts_naive_and_aware_datetimes(self) -> None:
+        thread = await chat_service.create_thread(ThreadCreate(title="t"))
+        await chat_service.add_message(thread.id, MessageCreate(content="hi"))
+        past = datetime.now(timezone.utc) - timedelta(minutes=1)
+
+        self.assertEqual(len(await chat_service.get_messages(thread.id, since=past)), 1)
+        self.assertEqual(len(await chat_service.get_messages(thread.id, since=past.replace(tzinfo=None))), 1)
+        self.assertEqual(len(await chat_service.get_messages(thread.id, since=past + timedelta(hours=1))), 0)
+
+    async def test_update_thread_with_messages(self) -> None:
+        thread = await chat_service.create_thread(ThreadCreate(title="old"))
+        await chat_service.add_message(thread.id, MessageCreate(content="hi"))
+
+        updated = await chat_service.update_thread(thread.id, ThreadUpdate(title="new"))
+        self.assertEqual(updated.title, "new")
+        self.assertEqual([m.content for m in updated.messages], ["hi"])
+
+    async def test_queued_questions_keep_answer_order(self) -> None:
+        thread = await chat_service.create_thread(ThreadCreate(title="t"))
+        await chat_service.add_message(thread.id, MessageCreate(content="q1"), "g1")
+        await chat_service.add_message(thread.id, MessageCreate(content="q2"), "g2")
+        for generation_id in ("g1", "g2"):
+            answer = {
+                "_id": ObjectId(),
+                "role": "assistant",
+                "content": f"a-{generation_id}",
+                "created_at": datetime.now(timezone.utc),
+                "generation_id": generation_id,
+                "step": 1,
+            }
+            await message_writes.append(thread.id, [answer])
+
+        messages = await chat_service.get_messages(thread.id)
+        self.assertEqual([m.content for m in messages], ["q1", "a-g1", "q2", "a-g2"])
+        with self.assertRaises(HTTPException):
+            # g1 之后已有新的问题，不能再重试
+            await chat_service.get_checkpoint(thread.id, "g1")
+        checkpoint = await chat_service.get_checkpoint(thread.id, "g2")
+        self.assertEqual([msg["content"] for msg in checkpoint], ["a-g2"])
+        self.assertIsNone(await chat_service.get_checkpoint(thread.id, "unknown"))
+
+
+    async def test_retry_replaces_partial_output(self) -> None:
+        thread = await chat_service.create_thread(ThreadCreate(title="t"))
+        received: List[List[BaseMessage]] = []
+
+        async def interrupted(messages, run=None, checkpoint=()):
+            run.partial = AIMessageChunk(content="半截")
+            raise asyncio.CancelledError()
+            yield
+
+        async def answer(messages, run=None, checkpoint=()):
+            received.append(list(messages))
+            yield AIMessage(content=f"回答{len(received)}")
+
+        async def generate(generation_id: str, agent_stream) -> None:
+            with mock.patch.object(llm_service, "agent_stream", agent_stream):
+                async for _ in chat_service.generate_response_stream(thread.id, None, generation_id):
+                    pass
+
+        await chat_service.add_message(thread.id, MessageCreate(content="q1"), "g1")
+        with self.assertRaises(asyncio.CancelledError):
+            await generate("g1", interrupted)
+        contents = [m.content for m in await chat_service.get_messages(thread.id)]
+        self.assertEqual(contents, ["q1", "半截"])
+
+        await generate("g1", answer)
+        await chat_service.add_message(thread.id, MessageCreate(content="q2"), "g2")
+        await generate("g2", answer)
+
+        self.assertEqual([m.content for m in received[0]], ["q1"])
+        self.assertEqual([m.content for m in received[1]], ["q1", "回答1", "q2"])
+        contents = [m.content for m in await chat_service.get_messages(thread.id)]
+        self.assertEqual(contents, ["q1", "回答1", "q2", "回答2"])
+
+    def test_partial_output_is_not_sent_to_model(self) -> None:
+        history = [
+            {"role": "user", "content": "q1"},
+            {"role": "assistant", "content": "半截", "partial": True, "generation_id": "g1", "step": 1},
+            {"role": "user", "content": "q2"},
+        ]
+        self.assertEqual([m.content for m in llm_service.format_messages(history)], ["q1", "q2"])
+
+    async def test_failed_warm_up_is_retried(self) -> None:
+        warm_up = mock.Mock(side_effect=[RuntimeError("boom"), None])
+        with mock.patch.object(llm_service, "warm_up", warm_up), mock.patch.object(llm_service, "_warm_up", None):
+            with self.assertRaises(RuntimeError):
+                await llm_service.ensure_ready()
+            await llm_service.ensure_ready()
+        self.assertEqual(warm_up.call_count, 2)
+
+
+class WriteBehindTest(MemoryStoreTestCase):
+    async def asyncSetUp(self) -> None:
+        await super().asyncSetUp()
+        await message_writes.start()
+
+    async def asyncTearDown(self) -> None:
+        await message_writes.stop()
+        await super().asyncTearDown()
+
+    async def test_pending_writes_are_visible_and_drain(self) -> None:
+        thread = await chat_service.create_thread(ThreadCreate(title="t"))
+        await chat_service.add_message(thread.id, MessageCreate(content="hi"))
+        self.assertEqual([m.content for m in await chat_service.get_messages(thread.id)], ["hi"])
+
+        await message_writes.drain(thread.id)
+        self.assertEqual(message_writes.writes(thread.id), [])
+        self.assertEqual([m.content for m in await chat_service.get_messages(thread.id)], ["hi"])
+
+    async def test_clean_stop_removes_journal(self) -> None:
+        thread = await chat_service.create_thread(ThreadCreate(title="t"))
+        await chat_service.add_message(thread.id, MessageCreate(content="hi"))
+        journal = message_writes.journal_path
+
+        await message_writes.stop()
+        self.assertFalse(os.path.exists(journal))
+        await message_writes.start()
+
+
+class DocumentMatchesTest(unittest.TestCase):
+    doc = {
+        "brand": "Acme",
+        "model": "One Pro",
+        "tags": ["拍照", "续航"],
+        "features": ["潜望长焦"],
+        "battery": 5000,
+        "display_size": 6.7,
+        "skus": [
+            {"sku_id": "a", "ram": "8GB", "storage": "256GB", "price": 2999},
+            {"sku_id": "b", "ram": "12GB", "storage": "512GB", "price": 3999},
+        ],
+    }
+
+    def matches(self, **params) -> bool:
+        return document_matches(PhoneService().build_search_query(PhoneSearchParams(**params)), self.doc)
+
+    def test_search_queries(self) -> None:
+        self.assertTrue(self.matches())
+        self.assertTrue(self.matches(brand="acme"))
+        self.assertFalse(self.matches(brand="Zeta"))
+        self.assertTrue(self.matches(keyword="pro"))
+        self.assertTrue(self.matches(keyword="长焦"))
+        self.assertFalse(self.matches(keyword="折叠"))
+        self.assertTrue(self.matches(tags=["拍照", "续航"]))
+        self.assertFalse(self.matches(tags=["拍照", "游戏"]))
+        self.assertTrue(self.matches(min_battery=5000, max_display_size=6.7))
+        self.assertFalse(self.matches(min_display_size=6.8))
+
+    def test_sku_conditions_must_match_the_same_sku(self) -> None:
+        self.assertTrue(self.matches(ram="12gb", min_price=3500))
+        self.assertTrue(self.matches(ram="8GB", storage="256GB", max_price=3000))
+        # 8GB 与 512GB 分属不同 SKU，$elemMatch 要求同一个 SKU 同时满足
+        self.assertFalse(self.matches(ram="8GB", storage="512GB"))
+        self.assertFalse(self.matches(ram="12GB", max_price=3000))
+
+    def test_regex_options_and_unknown_operators(self) -> None:
+        self.assertFalse(document_matches({"brand": {"$regex": "acme"}}, self.doc))
+        self.assertTrue(document_matches({"brand": {"$regex": "acme", "$options": "i"}}, self.doc))
+        # 不支持的操作符保守地视为匹配，宁可多失效缓存
+        self.assertTrue(document_matches({"battery": {"$in": [1]}}, self.doc))
+        self.assertTrue(document_matches({"brand": {"$regex": "("}}, self.doc))
+
+
+class PhoneServiceTest(MemoryStoreTestCase):
+    async def asyncSetUp(self) -> None:
+        await super().asyncSetUp()
+        self.phones = PhoneService()
+        await self.phones.bulk_upsert(
+            [
+                PhoneUpsert(
+                    brand="Acme",
+                    model="One",
+                    battery=5000,
+                    display_size=6.7,
+                    tags=["拍照"],
+                    skus=[PhoneSkuUpdate(sku_id="one-8", ram="8GB", price=2999)],
+                ),
+                PhoneUpsert(
+                    brand="Acme",
+                    model="Two",
+                    battery=4000,
+                    display_size=6.1,
+                    tags=["拍照"],
+                    skus=[PhoneSkuUpdate(sku_id="two-8", ram="8GB", price=3999)],
+                ),
+            ]
+        )
+
+    async def test_search_and_best_value(self) -> None:
+        found = await self.phones.search_phones(PhoneSearchParams(tags=["拍照"], max_price=3500))
+        self.assertEqual([phone.model for phone in found], ["One"])
+
+        # One 更便宜且电池更大、屏幕更大，支配 Two
+        best = await self.phones.search_best_value(PhoneSearchParams(tags=["拍照"]))
+        self.assertEqual([phone.model for phone in best], ["One"])
+
+    async def test_bulk_upsert_merges_skus_and_invalidates_affected_searches(self) -> None:
+        searches = {
+            "cheap": PhoneSearchParams(max_price=2000),
+            "ram": PhoneSearchParams(ram="12GB"),
+            "keyword": PhoneSearchParams(keyword="Two"),
+            "brand": PhoneSearchParams(brand="Zeta"),
+            "tag": PhoneSearchParams(tags=["游戏"]),
+        }
+        for params in searches.values():
+            await self.phones.search_phones(params)
+        [one] = await self.phones.search_phones(PhoneSearchParams(keyword="One"))
+        searches["one"] = PhoneSearchParams(keyword="One")
+
+        result = await self.phones.bulk_upsert(
+            [
+                PhoneUpsert(phone_id=str(one.id), skus=[PhoneSkuUpdate(sku_id="one-8", price=1999)]),
+                PhoneUpsert(brand="Acme", model="Two", skus=[PhoneSkuUpdate(sku_id="two-12", ram="12GB", price=4999)]),
+                PhoneUpsert(
+                    brand="Acme", model="Three", tags=["续航"], skus=[PhoneSkuUpdate(sku_id="three-8", price=999)]
+                ),
+            ]
+        )
+        self.assertEqual(result.upserted, 1)
+        self.assertEqual(len(result.phone_ids), 3)
+        self.assertEqual(result.not_found, [])
+
+        phones = {phone.model: phone for phone in await self.phones.search_phones(PhoneSearchParams(brand="Acme"))}
+        self.assertEqual([(sku.sku_id, sku.ram, sku.price) for sku in phones["One"].skus], [("one-8", "8GB", 1999)])
+        self.assertEqual([sku.sku_id for sku in phones["Two"].skus], ["two-8", "two-12"])
+        self.assertEqual(phones["Three"].tags, ["续航"])
+
+        # 结果中含变化手机或查询能匹配变化后文档的条目失效，其余保留
+        cached = {name for name, params in searches.items() if self.phones.peek_search(params) is not None}
+        self.assertEqual(cached, {"brand", "tag"})
+        self.assertEqual(result.invalidated, 4)
+
+    async def test_read_back_failure_keeps_bulk_write_error(self) -> None:
+        error = BulkWriteError({"writeErrors": [{"index": 0, "code": 11000, "errmsg": "duplicate"}]})
+        primary = mock.Mock()
+        primary.find.side_effect = AutoReconnect("primary stepped down")
+        await self.phones.search_phones(PhoneSearchParams(brand="Zeta"))
+        bulk_write = mock.AsyncMock(side_effect=error)
+        with mock.patch.object(self.phones.collection, "bulk_write", bulk_write), mock.patch.object(
+            self.phones.collection, "with_options", return_value=primary
+        ):
+            with self.assertRaises(BulkWriteError):
+                await self.phones.bulk_upsert([PhoneUpsert(brand="Acme", model="One", battery=5500)])
+        self.assertIsNone(self.phones.peek_search(PhoneSearchParams(brand="Zeta")))
+
+    async def test_best_value_from_snapshot_columns(self) -> None:
+        docs = await self.phones.collection.find({}).to_list(length=None)
+        store = CatalogSnapshotStore(tempfile.mkdtemp(prefix="phone-recommend-snapshot-"))
+        snapshot = CatalogSnapshot(store.publish(docs, await self.phones.catalog_version()))
+
+        with mock.patch("app.services.phone_service.catalog_snapshots") as snapshots:
+            snapshots.current.return_value = snapshot
+            best = await self.phones.search_best_value(PhoneSearchParams(tags=["拍照"]))
+            self.assertEqual([phone.model for phone in best], ["One"])
+            self.assertEqual(skyline_service._points, {})
+
+            # 快照之后的变化增量合并，数据库版本前进后仍使用快照
+            await self.phones.bulk_upsert(
+                [PhoneUpsert(brand="Acme", model="Two", skus=[PhoneSkuUpdate(sku_id="two-8", price=1999)])]
+            )
+            best = await self.phones.search_best_value(PhoneSearchParams(tags=["拍照"]))
+            self.assertTrue(skyline_service.serves(snapshot))
+            self.assertEqual(sorted(phone.model for phone in best), ["One", "Two"])
+            self.assertEqual(
+                [phone.model for phone in await self.phones.search_best_value(PhoneSearchParams(tags=["游戏"]))], []
+            )
+
+    async def test_change_stream_mode_falls_back_to_polling(self) -> None:
+        sync = CatalogSync(self.phones)
+        original = settings.catalog_sync_mode
+        settings.catalog_sync_mode = "change_stream"
+        try:
+            await sync.start()
+            for _ in range(50):
+                if sync.mode == "poll":
+                    break
+                await asyncio.sleep(0.01)
+            self.assertEqual(sync.mode, "poll")
+            self.assertFalse(sync._task.done())
+        finally:
+            await sync.stop()
+            settings.catalog_sync_mode = original
+
+    async def test_failed_resync_is_retried(self) -> None:
+        sync = CatalogSync(self.phones)
+        opened = asyncio.Event()
+
+        class IdleStream:
+            resume_token = None
+
+            async def __aenter__(self):
+                opened.set()
+                return self
+
+            async def __aexit__(self, *exc):
+                return False
+
+            def __aiter__(self):
+                return self
+
+            async def __anext__(self):
+                await asyncio.Event().wait()
+
+        streams = iter([OperationFailure("history lost", code=CHANGE_STREAM_HISTORY_LOST)])
+
+        def watch(**kwargs):
+            error = next(streams, None)
+            if error is not None:
+                raise error
+            return IdleStream()
+
+        refresh = mock.AsyncMock(side_effect=[AutoReconnect("primary stepped down"), None])
+        with mock.patch.object(self.phones.collection, "watch", watch), mock.patch.object(
+            skyline_service, "refresh", refresh
+        ):
+            task = asyncio.create_task(sync._watch())
+            try:
+                await asyncio.wait_for(opened.wait(), timeout=5)
+                self.assertEqual(refresh.await_count, 2)
+                self.assertFalse(task.done())
+            finally:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+
+class UsageServiceTest(MemoryStoreTestCase):
+    def test_budget_check(self) -> None:
+        UsageBudget(max_tokens=100, max_model_calls=2).check(tokens=99, model_calls=1)
+        UsageBudget().check(tokens=10**9, model_calls=10**9)
+        cases = [
+            (UsageBudget(max_model_calls=2), "model_calls"),
+            (UsageBudget(max_tokens=100), "tokens_per_turn"),
+            (UsageBudget(max_tokens=100, daily_limit="tokens_per_day"), "tokens_per_day"),
+        ]
+        for budget, limit in cases:
+            with self.assertRaises(BudgetExceeded) as raised:
+                budget.check(tokens=100, model_calls=2)
+            self.assertEqual(raised.exception.limit, limit)
+            self.assertEqual(raised.exception.code, "budget_exceeded")
+
+    async def test_daily_budgets(self) -> None:
+        await usage_service.record("alice", MessageUsage(model="m", input_tokens=60, output_tokens=20, model_calls=1))
+        await usage_service.record("bob", MessageUsage(model="m", input_tokens=50, model_calls=1))
+
+        with mock.patch.object(settings, "usage_max_tokens_per_turn", 100), mock.patch.object(
+            settings, "usage_max_tokens_per_day", 150
+        ), mock.patch.object(settings, "usage_max_tokens_per_day_total", 0):
+            budget = await usage_service.budget("alice")
+            self.assertEqual((budget.max_tokens, budget.daily_limit), (70, "tokens_per_day"))
+            budget = await usage_service.budget("carol")
+            self.assertEqual((budget.max_tokens, budget.daily_limit), (100, None))
+
+            # 换一个 X-User-Id 不能绕过所有用户合计的上限
+            with mock.patch.object(settings, "usage_max_tokens_per_day_total", 180):
+                budget = await usage_service.budget("carol")
+            self.assertEqual((budget.max_tokens, budget.daily_limit), (50, "tokens_per_day_total"))
+            with self.assertRaises(BudgetExceeded) as raised:
+                budget.check(tokens=50, model_calls=0)
+            self.assertEqual(raised.exception.limit, "tokens_per_day_total")
+
+    def test_price_for_prefers_longest_prefix(self) -> None:
+        prices = {
+            "gpt-4o": ModelPrice(input_per_million=2.5, output_per_million=10),
+            "gpt-4o-mini": ModelPrice(input_per_million=0.15, output_per_million=0.6),
+        }
+        with mock.patch.object(settings, "llm_prices", prices):
+            self.assertIs(price_for("gpt-4o"), prices["gpt-4o"])
+            self.assertIs(price_for("gpt-4o-2024-08-06"), prices["gpt-4o"])
+            self.assertIs(price_for("gpt-4o-mini-2024-07-18"), prices["gpt-4o-mini"])
+            self.assertIsNone(price_for("gpt-4"))
+
+    async def test_report_groups_by_day_and_model(self) -> None:
+        await usage_service.record("alice", MessageUsage(model="priced", input_tokens=1_000_000, model_calls=1))
+        await usage_service.record("bob", MessageUsage(model="priced", output_tokens=500_000, model_calls=2))
+        await usage_service.record("bob", MessageUsage(model="free", input_tokens=10, model_calls=1))
+
+        since, until = usage_service.default_range(days=1)
+        prices = {"priced": ModelPrice(input_per_million=1.0, output_per_million=4.0)}
+        with mock.patch.object(settings, "llm_prices", prices):
+            report = await usage_service.report(since, until)
+            only_bob = await usage_service.report(since, until, "bob")
+
+        self.assertEqual([(row.model, row.model_calls) for row in report.rows], [("free", 1), ("priced", 3)])
+        priced = report.by_model[1]
+        self.assertEqual((priced.input_tokens, priced.output_tokens, priced.cost), (1_000_000, 500_000, 3.0))
+        self.assertEqual(report.total_cost, 3.0)
+        self.assertEqual(report.unpriced_models, ["free"])
+        self.assertEqual(only_bob.total_cost, 2.0)
+
+
+class ThreadCoordinatorTest(MemoryStoreTestCase):
+    async def asyncSetUp(self) -> None:
+        await super().asyncSetUp()
+        self.coordinator = ThreadCoordinator()
+
+    async def test_duplicates_coalesce_while_generation_runs(self) -> None:
+        claim, first = self.coordinator.claim("t", "推荐一款手机")
+        duplicate, duplicate_first = self.coordinator.claim("t", "推荐一款手机")
+        self.assertTrue(first)
+        self.assertFalse(duplicate_first)
+        self.assertIs(duplicate, claim)
+        self.assertTrue(self.coordinator.claim("t", "另一个问题")[1])
+        self.assertTrue(self.coordinator.claim("other", "推荐一款手机")[1])
+
+        generation = Generation(id="g1", thread_id="t", events=deque())
+        self.coordinator.resolve(claim, generation)
+        self.assertIs(await duplicate.wait(), generation)
+        self.assertFalse(self.coordinator.claim("t", "推荐一款手机")[1])
+
+        # 生成结束后，窗口内相同的内容是新的提问
+        await generation.finish()
+        self.assertTrue(self.coordinator.claim("t", "推荐一款手机")[1])
+
+    async def test_abandoned_claim_fails_duplicates(self) -> None:
+        claim, _ = self.coordinator.claim("t", "hi")
+        duplicate, _ = self.coordinator.claim("t", "hi")
+        self.coordinator.abandon(claim, HTTPException(status_code=404))
+        with self.assertRaises(HTTPException):
+            await duplicate.wait()
+        self.assertTrue(self.coordinator.claim("t", "hi")[1])
+
+    async def test_turns_run_one_at_a_time(self) -> None:
+        order: List[str] = []
+
+        async def generate(name: str) -> None:
+            async with self.coordinator.turn("t"):
+                order.append(f"{name} start")
+                await asyncio.sleep(0.01)
+                order.append(f"{name} end")
+
+        with mock.patch.object(settings, "generation_thread_lease", True):
+            await asyncio.gather(generate("a"), generate("b"))
+        self.assertEqual(order, ["a start", "a end", "b start", "b end"])
+        self.assertEqual(self.coordinator._turns, {})
+        self.assertEqual(await get_thread_leases_collection().count_documents({}), 0)
+
+    async def test_lost_lease_stops_generation(self) -> None:
+        leases = get_thread_leases_collection()
+
+        async def generate() -> None:
+            async with self.coordinator.turn("t"):
+                # 其他 worker 在租约过期后接管
+                await leases.update_one({"_id": "t"}, {"$set": {"owner": "other"}})
+                await asyncio.sleep(10)
+
+        with mock.patch.object(settings, "generation_thread_lease", True), mock.patch.object(
+            settings, "generation_thread_lease_ttl_seconds", 0.06
+        ):
+            task = asyncio.create_task(generate())
+            with self.assertRaises(LeaseLost):
+                await asyncio.wait_for(task, timeout=5)
+        self.assertEqual(task.cancelling(), 0)
+        self.assertEqual((await leases.find_one({"_id": "t"}))["owner"], "other")
+
+
+if __name__ == "__main__":
+    unittest.main()
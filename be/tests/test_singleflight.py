@@ -0,0 +1,61 @@
+import asyncio
+import unittest
+
+from app.utils.singleflight import FlightCancelled, SingleFlight
+
+
+class SingleFlightStreamTest(unittest.IsolatedAsyncioTestCase):
+    async def test_followers_receive_full_output(self) -> None:
+        flights: SingleFlight[int] = SingleFlight("test")
+        started = 0
+
+        async def produce():
+            nonlocal started
+            started += 1
+            for item in range(3):
+                await asyncio.sleep(0)
+                yield item
+
+        async def collect():
+            return [item async for item in flights.stream("k", produce)]
+
+        results = await asyncio.gather(collect(), collect())
+        self.assertEqual(results, [[0, 1, 2], [0, 1, 2]])
+        self.assertEqual(started, 1)
+
+    async def test_call_after_last_subscriber_leaves_starts_new_flight(self) -> None:
+        flights: SingleFlight[int] = SingleFlight("test")
+        started = 0
+
+        async def produce():
+            nonlocal started
+            started += 1
+            yield started
+            await asyncio.sleep(10)
+            yield 0
+
+        first = flights.stream("k", produce)
+        self.assertEqual(await first.__anext__(), 1)
+        # 最后一个订阅者离开，后台任务的取消尚未生效时新的调用到达
+        await first.aclose()
+        second = flights.stream("k", produce)
+        self.assertEqual(await second.__anext__(), 2)
+        await second.aclose()
+
+    async def test_cancelled_flight_is_not_reported_as_cancellation(self) -> None:
+        flights: SingleFlight[int] = SingleFlight("test")
+
+        async def produce():
+            yield 1
+            await asyncio.sleep(10)
+            yield 2
+
+        stream = flights.stream("k", produce)
+        self.assertEqual(await stream.__anext__(), 1)
+        flights._streams["k"].task.cancel()
+        with self.assertRaises(FlightCancelled):
+            await stream.__anext__()
+
+
+if __name__ == "__main__":
+    unittest.main()
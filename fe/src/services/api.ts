@@ -96,7 +96,82 @@ export const renameThread = async (id: string, title: string): Promise<Thread> =
   };
 };
 
-// 发送消息（SSE 流式响应）
+// SSE 流的续传状态
+interface StreamState {
+  generationId?: string;
+  lastEventId?: string;
+  finished: boolean;
+}
+
+// 断线后最多续传次数
+const MAX_RESUME_ATTEMPTS = 3;
+
+// 读取 SSE 响应，直到收到结束/错误事件或连接断开
+const consumeStream = async (
+  response: Response,
+  state: StreamState,
+  onChunk: (chunk: string) => void,
+  onDone: () => void,
+  onError: (error: Error) => void
+): Promise<void> => {
+  const reader = response.body?.getReader();
+  const decoder = new TextDecoder();
+
+  if (!reader) {
+    throw new Error('No response body');
+  }
+
+  let buffer = '';
+
+  while (true) {
+    const { done, value } = await reader.read();
+
+    if (done) {
+      return;
+    }
+
+    buffer += decoder.decode(value, { stream: true });
+    const events = buffer.split('\n\n');
+    buffer = events.pop() || '';
+
+    for (const event of events) {
+      let data = '';
+      for (const line of event.split('\n')) {
+        if (line.startsWith('id: ')) {
+          state.lastEventId = line.slice(4);
+        } else if (line.startsWith('data: ')) {
+          data += line.slice(6);
+        }
+      }
+      if (!data) {
+        continue;
+      }
+      try {
+        const json = JSON.parse(data);
+        if (json.generation_id) {
+          state.generationId = json.generation_id;
+        }
+        if (json.done) {
+          state.finished = true;
+          onDone();
+          return;
+        }
+        if (json.content) {
+          onChunk(json.content);
+        }
+        if (json.error) {
+          state.finished = true;
+          onError(new Error(json.error));
+          return;
+        }
+      } catch (e) {
+        // 忽略解析错误
+      }
+    }
+  }
+};
+
+// 发送消息（SSE 流式响应），连接中断时按 Last-Event-ID 续传
 export const sendMessage = async (
   threadId: string,
   content: string,
@@ -104,6 +179,8 @@ export const sendMessage = async (
   onDone: () => void,
   onError: (error: Error) => void
 ): Promise<void> => {
+  const state: StreamState = { finished: false };
+
   try {
     const response = await fetch(`${API_BASE_URL}/api/threads/${threadId}/messages`, {
       method: 'POST',
@@ -117,50 +194,26 @@ export const sendMessage = async (
       throw new Error('Failed to send message');
     }
 
-    const reader = response.body?.getReader();
-    const decoder = new TextDecoder();
-
-    if (!reader) {
-      throw new Error('No response body');
-    }
-
-    let buffer = '';
+    await consumeStream(response, state, onChunk, onDone, onError).catch(() => undefined);
 
-    while (true) {
-      const { done, value } = await reader.read();
-
-      if (done) {
-        break;
+    for (let attempt = 0; !state.finished && state.generationId && attempt < MAX_RESUME_ATTEMPTS; attempt++) {
+      const headers: Record<string, string> = {};
+      if (state.lastEventId) {
+        headers['Last-Event-ID'] = state.lastEventId;
       }
-
-      buffer += decoder.decode(value, { stream: true });
-      const lines = buffer.split('\n\n');
-      buffer = lines.pop() || '';
-
-      for (const line of lines) {
-        if (line.startsWith('data: ')) {
-          const data = line.slice(6);
-          try {
-            const json = JSON.parse(data);
-            if (json.done) {
-              onDone();
-              return;
-            }
-            if (json.content) {
-              onChunk(json.content);
-            }
-            if (json.error) {
-              onError(new Error(json.error));
-              return;
-            }
-          } catch (e) {
-            // 忽略解析错误
-          }
-        }
+      const resumed = await fetch(
+        `${API_BASE_URL}/api/threads/${threadId}/messages/stream/${state.generationId}`,
+        { headers }
+      ).catch(() => null);
+      if (!resumed || !resumed.ok) {
+        break;
       }
+      await consumeStream(resumed, state, onChunk, onDone, onError).catch(() => undefined);
     }
 
-    onDone();
+    if (!state.finished) {
+      onDone();
+    }
   } catch (error) {
     onError(error instanceof Error ? error : new Error('Unknown error'));
   }